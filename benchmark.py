@@ -0,0 +1,415 @@
+# Offline load test for the bot.
+#
+# Runs the real command handlers from bot.py against fake Minecraft servers
+# (speaking real RCON on localhost, with configurable latency, packet loss and
+# players) and a stubbed EC2 backend, firing bursts of concurrent commands and
+# reporting latency percentiles, throughput and event loop lag.
+#
+# Nothing here talks to Discord or AWS. Run it with e.g.
+#   python3 benchmark.py --bursts 20 --burst-size 50 --rcon-latency 30 --packet-loss 0.01
+import os
+import sys
+import json
+import time
+import random
+import struct
+import logging
+import asyncio
+import argparse
+import tempfile
+import threading
+import statistics
+
+# Everything below is configured from the environment at import time, so set
+# up a throwaway environment before importing any of the bot's modules
+BENCHMARK_DIR = tempfile.mkdtemp(prefix="mcbot-benchmark-")
+BENCHMARK_ENV = {
+	'DISCORD_TOKEN': "benchmark",
+	'ADMIN': "1",
+	'ADMIN_NAME': "benchmark",
+	'PREFIX': "!",
+	'ERROR_LOG_CHANNEL': "0",
+	'AWS_DEFAULT_REGION': "us-east-1",
+	'AWS_ACCESS_KEY_ID': "benchmark",
+	'AWS_SECRET_ACCESS_KEY': "benchmark",
+	'SERVERS_FILE': os.path.join(BENCHMARK_DIR, "servers.json"),
+	'START_HISTORY_FILE': os.path.join(BENCHMARK_DIR, "start_history.jsonl"),
+	'PRESENCE_DIR': os.path.join(BENCHMARK_DIR, "presence"),
+	'STATE_FILE': os.path.join(BENCHMARK_DIR, "state.db"),
+	'LOG_DIR': os.path.join(BENCHMARK_DIR, "logs"),
+	'METRICS_PORT': "",
+	'STOP_GRACE': "0.1",
+	'EC2_WAITER_DELAY': "1",
+}
+
+RCON_LOGIN = 3
+RCON_COMMAND = 2
+RCON_RESPONSE = 0
+
+COMMANDS = ('status', 'list', 'start', 'stop')
+
+
+################################################################################
+#
+### Fake Minecraft server
+
+
+# A Minecraft server that only speaks RCON. It listens while its (stubbed) EC2
+# instance is running and it has "loaded", and goes away when told to stop.
+class FakeMinecraftServer:
+
+	def __init__(self, name, port, players, max_players, latency, packet_loss, load_time):
+		self.name = name
+		self.port = port
+		self.players = players
+		self.max_players = max_players
+		self.latency = latency
+		self.packet_loss = packet_loss
+		self.load_time = load_time
+		self.running = False
+		self.commands_served = 0
+		self.responses_dropped = 0
+		self._server = None
+		self._writers = set()
+
+	async def start(self, delay=0):
+		await asyncio.sleep(delay)
+		if self._server is None:
+			self._server = await asyncio.start_server(self._handle, "127.0.0.1", self.port)
+		self.running = True
+
+	def stop(self):
+		self.running = False
+		if self._server is not None:
+			self._server.close()
+			self._server = None
+		for writer in list(self._writers):
+			writer.close()
+
+	async def _handle(self, reader, writer):
+		self._writers.add(writer)
+		# the response to the latest command on this connection
+		last_response = None
+		try:
+			while True:
+				(length,) = struct.unpack("<i", await reader.readexactly(4))
+				request_id, packet_type = struct.unpack("<ii", await reader.readexactly(8))
+				body = (await reader.readexactly(length - 8))[:-2].decode()
+				if packet_type == RCON_LOGIN:
+					writer.write(_encode(request_id, RCON_COMMAND, ""))
+					continue
+				if packet_type != RCON_COMMAND:
+					# like Minecraft, answer packets it doesn't know in order,
+					# after the command before them
+					asyncio.ensure_future(self._respond_unknown(writer, request_id, packet_type, last_response))
+					continue
+				last_response = asyncio.ensure_future(self._respond(writer, request_id, body))
+		except (asyncio.IncompleteReadError, OSError):
+			pass
+		finally:
+			self._writers.discard(writer)
+			writer.close()
+
+	# Returns whether it answered
+	async def _respond(self, writer, request_id, body):
+		await asyncio.sleep(random.expovariate(1 / self.latency) if self.latency else 0)
+		if random.random() < self.packet_loss:
+			self.responses_dropped += 1
+			return False
+		self.commands_served += 1
+		if body == "list":
+			response = f"There are {len(self.players)} of a max of {self.max_players} players online: {', '.join(self.players)}"
+		elif body == "time query daytime":
+			response = f"The time is {random.randrange(24000)}"
+		elif body == "stop":
+			response = "Stopping the server"
+		else:
+			response = ""
+		if writer.is_closing():
+			return False
+		writer.write(_encode(request_id, RCON_RESPONSE, response))
+		if body == "stop":
+			# save, then close RCON and exit
+			await asyncio.sleep(self.latency)
+			self.stop()
+		return True
+
+	async def _respond_unknown(self, writer, request_id, packet_type, last_response):
+		# a server that didn't answer the command doesn't answer this either
+		if last_response is not None and not await last_response:
+			return
+		if not writer.is_closing():
+			writer.write(_encode(request_id, RCON_RESPONSE, f"Unknown request {packet_type:x}"))
+
+
+def _encode(request_id, packet_type, body):
+	payload = struct.pack("<ii", request_id, packet_type) + body.encode() + b"\x00\x00"
+	return struct.pack("<i", len(payload)) + payload
+
+
+################################################################################
+#
+### Stubbed EC2
+
+
+# Stands in for boto3's EC2 client. Calls block for the configured latency,
+# like the real thing, and instances take boot_time to go from pending to
+# running (and start their Minecraft server load_time after that).
+class FakeEC2:
+
+	def __init__(self, minecraft_servers, latency, boot_time, loop):
+		# instance id -> FakeMinecraftServer
+		self.minecraft_servers = minecraft_servers
+		self.latency = latency
+		self.boot_time = boot_time
+		self.loop = loop
+		self.states = {instance_id: "running" for instance_id in minecraft_servers}
+		self.calls = {}
+		self._lock = threading.Lock()
+
+	def _call(self, name):
+		with self._lock:
+			self.calls[name] = self.calls.get(name, 0) + 1
+		time.sleep(random.expovariate(1 / self.latency) if self.latency else 0)
+
+	def _transition(self, instance_id, state, delay, then=None):
+		def apply():
+			self.states[instance_id] = state
+			if then is not None:
+				then()
+		self.loop.call_soon_threadsafe(self.loop.call_later, delay, apply)
+
+	def get_paginator(self, name):
+		return FakePaginator(self)
+
+	def start_instances(self, InstanceIds):
+		self._call("start_instances")
+		for instance_id in InstanceIds:
+			if self.states[instance_id] == "stopped":
+				self.states[instance_id] = "pending"
+				minecraft = self.minecraft_servers[instance_id]
+				self._transition(instance_id, "running", self.boot_time,
+					lambda minecraft=minecraft: asyncio.ensure_future(minecraft.start(minecraft.load_time)))
+
+	def stop_instances(self, InstanceIds, **kwargs):
+		self._call("stop_instances")
+		for instance_id in InstanceIds:
+			if self.states[instance_id] in ("running", "pending"):
+				self.states[instance_id] = "stopping"
+				self.minecraft_servers[instance_id].stop()
+				self._transition(instance_id, "stopped", self.boot_time)
+
+
+class FakePaginator:
+
+	def __init__(self, ec2):
+		self.ec2 = ec2
+
+	def paginate(self, InstanceIds):
+		self.ec2._call("describe_instances")
+		yield {'Reservations': [
+			{'Instances': [{'InstanceId': instance_id, 'State': {'Name': self.ec2.states[instance_id]}}]}
+			for instance_id in InstanceIds
+		]}
+
+
+################################################################################
+#
+### Driver
+
+
+# Just enough of a discord.py Context for the command handlers
+class FakeAuthor:
+
+	def __init__(self, id, name):
+		self.id = id
+		self.name = name
+
+
+class FakeMessage:
+
+	async def edit(self, content=None, **kwargs):
+		await asyncio.sleep(0)
+
+
+class FakeContext:
+
+	def __init__(self, author):
+		self.author = author
+		self.messages = []
+
+	async def send(self, content=None, **kwargs):
+		await asyncio.sleep(0)
+		self.messages.append(content)
+		return FakeMessage()
+
+
+# Sleep in short steps and record how late each wakeup is. Anything that
+# blocks the event loop shows up here.
+async def measure_loop_lag(lags, interval=0.01):
+	while True:
+		before = time.perf_counter()
+		await asyncio.sleep(interval)
+		lags.append(time.perf_counter() - before - interval)
+
+
+def percentile(values, q):
+	if not values:
+		return float('nan')
+	values = sorted(values)
+	return values[min(int(q * len(values)), len(values) - 1)]
+
+
+def parse_mix(mix):
+	weights = {}
+	for part in mix.split(","):
+		name, _, weight = part.partition("=")
+		if name not in COMMANDS:
+			raise argparse.ArgumentTypeError(f"unknown command {name!r}, expected one of {', '.join(COMMANDS)}")
+		weights[name] = float(weight or 1)
+	return weights
+
+
+async def run_benchmark(args):
+	import bot
+	import ec2_utils
+	from fleet_utils import SERVERS
+
+	loop = asyncio.get_running_loop()
+	minecraft_servers = {}
+	for i, server in enumerate(SERVERS.values()):
+		players = [f"player_{i}_{n}" for n in range(args.players)]
+		minecraft = FakeMinecraftServer(
+			server.name, server.rcon_port, players, max(args.players, 20),
+			args.rcon_latency / 1000, args.packet_loss, args.load_time
+		)
+		await minecraft.start()
+		minecraft_servers[server.instance_id] = minecraft
+	fake_ec2 = FakeEC2(minecraft_servers, args.ec2_latency / 1000, args.boot_time, loop)
+	ec2_utils.ec2 = fake_ec2
+
+	handlers = {
+		'status': bot.serverstatus.callback,
+		'list': bot.playerlist.callback,
+		'start': bot.startserver.callback,
+		'stop': bot.stopserver.callback,
+	}
+	admin = FakeAuthor(bot.ADMIN, "benchmark")
+	names = list(SERVERS)
+	weights = parse_mix(args.mix)
+
+	latencies = {name: [] for name in weights}
+	errors = {name: 0 for name in weights}
+
+	async def invoke(command):
+		handler_args = [random.choice(names)] if len(names) > 1 else []
+		if command == 'stop':
+			handler_args.append("--force")
+		start = time.perf_counter()
+		try:
+			await handlers[command](FakeContext(admin), *handler_args)
+		except Exception:
+			logging.getLogger("bot").exception(f"benchmark: {command} raised")
+			errors[command] += 1
+		latencies[command].append(time.perf_counter() - start)
+
+	lags = []
+	lag_task = asyncio.ensure_future(measure_loop_lag(lags))
+	started = time.perf_counter()
+	for _ in range(args.bursts):
+		burst = random.choices(list(weights), weights=list(weights.values()), k=args.burst_size)
+		await asyncio.gather(*[invoke(command) for command in burst])
+		await asyncio.sleep(args.burst_interval)
+	elapsed = time.perf_counter() - started
+	lag_task.cancel()
+
+	invocations = sum(len(values) for values in latencies.values())
+	return {
+		'invocations': invocations,
+		'elapsed': elapsed,
+		'throughput': invocations / elapsed,
+		'commands': {
+			name: {
+				'count': len(values),
+				'errors': errors[name],
+				'p50': percentile(values, 0.5),
+				'p99': percentile(values, 0.99),
+				'max': max(values, default=float('nan')),
+			}
+			for name, values in latencies.items()
+		},
+		'loop_lag': {
+			'p50': percentile(lags, 0.5),
+			'p99': percentile(lags, 0.99),
+			'max': max(lags, default=float('nan')),
+			'mean': statistics.mean(lags) if lags else float('nan'),
+		},
+		'ec2_calls': fake_ec2.calls,
+		'rcon_commands_served': sum(minecraft.commands_served for minecraft in minecraft_servers.values()),
+		'rcon_responses_dropped': sum(minecraft.responses_dropped for minecraft in minecraft_servers.values()),
+	}
+
+
+def print_report(result):
+	print(f"{result['invocations']} commands in {result['elapsed']:.2f}s ({result['throughput']:.1f}/s)")
+	print()
+	print(f"{'command':<8} {'count':>6} {'errors':>6} {'p50 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+	for name, stats in result['commands'].items():
+		print(
+			f"{name:<8} {stats['count']:>6} {stats['errors']:>6} {stats['p50'] * 1000:>8.1f} " +
+			f"{stats['p99'] * 1000:>8.1f} {stats['max'] * 1000:>8.1f}"
+		)
+	print()
+	lag = result['loop_lag']
+	print(f"event loop lag: p50 {lag['p50'] * 1000:.2f}ms, p99 {lag['p99'] * 1000:.2f}ms, max {lag['max'] * 1000:.2f}ms")
+	print(f"EC2 API calls: {', '.join(f'{name} {count}' for name, count in sorted(result['ec2_calls'].items())) or 'none'}")
+	print(f"RCON commands served: {result['rcon_commands_served']} ({result['rcon_responses_dropped']} responses dropped)")
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Load test the bot's command handlers against fake servers")
+	parser.add_argument("--servers", type=int, default=1, help="number of fake Minecraft servers")
+	parser.add_argument("--players", type=int, default=3, help="players online on each server")
+	parser.add_argument("--bursts", type=int, default=10, help="number of bursts of commands")
+	parser.add_argument("--burst-size", type=int, default=50, help="concurrent commands per burst")
+	parser.add_argument("--burst-interval", type=float, default=0.5, help="pause between bursts, in seconds")
+	parser.add_argument("--mix", default="status=10,list=10,start=1,stop=1", help="relative weights of the commands to send")
+	parser.add_argument("--rcon-latency", type=float, default=5, help="mean RCON response time, in ms")
+	parser.add_argument("--packet-loss", type=float, default=0, help="chance of an RCON response never arriving")
+	parser.add_argument("--ec2-latency", type=float, default=100, help="mean EC2 API call time, in ms")
+	parser.add_argument("--boot-time", type=float, default=2, help="seconds for an instance to start or stop")
+	parser.add_argument("--load-time", type=float, default=1, help="seconds for Minecraft to load after boot")
+	parser.add_argument("--base-port", type=int, default=35565, help="first port for the fake RCON servers")
+	parser.add_argument("--seed", type=int, default=None, help="random seed, for repeatable runs")
+	parser.add_argument("--json", action="store_true", help="print the results as JSON")
+	parser.add_argument("--verbose", action="store_true", help="show the bot's log output")
+	args = parser.parse_args()
+	parse_mix(args.mix)
+
+	random.seed(args.seed)
+	for key, value in BENCHMARK_ENV.items():
+		os.environ[key] = value
+	with open(os.environ['SERVERS_FILE'], "w") as f:
+		json.dump([
+			{
+				'name': f"server{i}",
+				'instance_id': f"i-benchmark{i}",
+				'rcon_url': "127.0.0.1",
+				'rcon_password': "benchmark",
+				'rcon_port': args.base_port + i,
+			}
+			for i in range(args.servers)
+		], f)
+	if not args.verbose:
+		logging.disable(logging.INFO)
+
+	result = asyncio.run(run_benchmark(args))
+	if args.json:
+		json.dump(result, sys.stdout, indent=2)
+		print()
+	else:
+		print_report(result)
+
+
+if __name__ == '__main__':
+	main()
@@ -1,4 +1,7 @@
 # General stuff
+import time
+# when the bot started, for the startup timings
+PROCESS_STARTED = time.monotonic()
 import os
 import datetime as dt
 import sys
@@ -6,13 +9,14 @@ import traceback
 import aiohttp
 import asyncio
 import socket
-import logging
 import re
+import json
+import hashlib
 from dotenv import load_dotenv
 
 # Discord stuff
 import discord
-from discord import User
+from discord import User, app_commands
 from discord.ext import commands
 
 ################################################################################
@@ -38,6 +42,13 @@ KILL_EMOTE      = os.getenv('KILL_EMOTE')
 EC2_EMOTE       = os.getenv('EC2_EMOTE')
 MINECRAFT_EMOTE = os.getenv('MINECRAFT_EMOTE')
 
+# Register slash command versions of the slow commands with Discord on startup
+SLASH_COMMANDS  = os.getenv('SLASH_COMMANDS', 'true').lower() in ('1', 'true', 'yes')
+
+# Log how long startup took, from the process starting to serving the first
+# command, and then exit, so startup can be timed repeatedly from a script
+MEASURE_STARTUP = os.getenv('MEASURE_STARTUP', '').lower() in ('1', 'true', 'yes')
+
 # Dedicated error log channel
 # Have to set this later, after the bot is ready (on_ready())
 ERROR_LOG_CHANNEL = None
@@ -45,52 +56,136 @@ ERROR_LOG_CHANNEL = None
 # The server URL is only used for display purposes in this file
 RCON_URL = os.getenv('RCON_URL')
 
-# Polling rate and timeout for stopping the server automatically
-INACTIVITY_POLLING_RATE = int(os.getenv('INACTIVITY_POLLING_RATE'))
-INACTIVITY_TIMEOUT      = int(os.getenv('INACTIVITY_TIMEOUT'))
-
-# global flag to indicate that a stop is going to occur soon
-# active during the wait between "stop MC server" and "stop EC2 instance"
-# this is lazy programming, you shouldn't do this
-EC2_WAITING_TO_STOP = False
+# Initialize logging stuff - log to console, but also a rotating file under logs/
+# (both written from a background thread, see log_utils.py). Done before the
+# imports below, so that what they log while loading isn't lost.
+from log_utils import setup_logging
+log = setup_logging()
 
 # Import server management stuff (depends on dotenv)
-from rcon_utils import get_rcon_status, get_player_list, submit_rcon_command
-from ec2_utils import get_ec2_status, start_ec2_instance, stop_ec2_instance
-
-# Initialize logging stuff - log to console, but also a file under logs/
-log = logging.getLogger("bot")
-log.setLevel(logging.DEBUG)
-log_format = "%(asctime)s %(levelname)-8s %(message)s"
-date_format = "%Y-%m-%d %H:%M:%S"
-logging.basicConfig(
-    format=log_format,
-    level=logging.INFO,
-    datefmt=date_format
-)
-fh = logging.FileHandler("logs/" + dt.datetime.now().strftime(date_format) + ".log")
-formatter = logging.Formatter(log_format, datefmt=date_format)
-fh.setFormatter(formatter)
-fh.setLevel(logging.DEBUG)
-log.addHandler(fh)
+from rcon_utils import TICK_MSPT_BUDGET, format_player_list, submit_rcon_command
+from snapshot_utils import server_snapshot
+from fleet_utils import SERVERS, get_server, is_fleet
+from stop_utils import StopState, STOP_TIMEOUT, is_stopping, start_stop, resume_stops, cancel_stop
+from start_utils import StartPhase, start_server, load_start_records, expected_start_time, start_history
+from worker_utils import monitor_link
+from ec2_utils import warm_up_ec2
+from whitelist_utils import get_whitelist
+from presence_utils import presence_store
+from feed_utils import PLAYER_FEED_CHANNEL, player_feed
+from prewarm_utils import prewarm_scheduler
+from metrics_utils import metrics
+from state_utils import state_store
+from watchdog_utils import loop_watchdog
 
 # let the bot access discord Intents to do its thing
 intents = discord.Intents.default()
 intents.members = True
 intents.guilds = True
+# needed to read `!` commands in servers (off by default since discord.py 2.0)
+intents.message_content = True
 
 # finally, create the bot object 
 bot = commands.Bot(command_prefix=PREFIX, intents=intents)
 
+# time every request to the Discord API (sends, edits, ...), by route
+discord_request = bot.http.request
+async def timed_discord_request(route, **kwargs):
+    async with metrics.timed("discord", method=route.method, route=route.path):
+        return await discord_request(route, **kwargs)
+bot.http.request = timed_discord_request
+
 
 ################################################################################
 #
 ### Basic behavioral functions
 
 
-# Startup function
+# Seconds from the process starting to each step of getting going
+startup_timings = {}
+
+
+def mark_startup(step):
+    if step in startup_timings:
+        return
+    startup_timings[step] = time.monotonic() - PROCESS_STARTED
+    metrics.observe("startup", startup_timings[step], step=step)
+    log.info(f"Startup: {step} after {startup_timings[step]:.2f}s")
+
+
+# The first command has been answered: in MEASURE_STARTUP mode, that's the
+# end of the measurement
+async def first_command_served():
+    if "first command" in startup_timings:
+        return
+    mark_startup("first command")
+    if MEASURE_STARTUP:
+        log.info("Startup timings: " + ", ".join(f"{step} {seconds:.2f}s" for step, seconds in startup_timings.items()))
+        await bot.close()
+
+
+# Runs once, after logging in and before connecting to the gateway (unlike
+# on_ready, which runs again after every reconnect). Everything here happens in
+# the background, so it doesn't hold up the connection.
+@bot.event
+async def setup_hook():
+    mark_startup("logged in")
+    # Build the AWS client and connect to RCON while the gateway connects, so
+    # the first command doesn't have to
+    asyncio.ensure_future(warm_up())
+    # Read the start history off the event loop before a start needs it
+    asyncio.ensure_future(start_history.load())
+    if SLASH_COMMANDS:
+        asyncio.ensure_future(sync_slash_commands())
+    # Watch for anything blocking the event loop
+    loop_watchdog.on_stall = post_stall_to_log_channel
+    loop_watchdog.start()
+    # Serve metrics over HTTP
+    asyncio.ensure_future(metrics.serve())
+    # Post people joining and leaving, if there's somewhere to post them
+    if PLAYER_FEED_CHANNEL:
+        player_feed.on_delta = post_player_changes
+    # Start writing player history to disk
+    asyncio.ensure_future(presence_store.run())
+    # Answer from the state saved before the last restart until there's fresh
+    # data, and finish any stop the restart interrupted
+    server_snapshot.restore()
+    asyncio.ensure_future(resume_stops())
+    # Keep an eye on how well each server keeps up, if it can tell us
+    for server in SERVERS.values():
+        server.rcon.ticks.on_lag = lambda sampler, unreported, server=server: post_lag_to_log_channel(server, sampler, unreported)
+        server.rcon.ticks.start()
+    # Start servers ahead of the usual crowd, if asked to
+    if prewarm_scheduler.enabled:
+        prewarm_scheduler.on_prewarm = lambda server, probability: monitor_link.wake(server)
+        asyncio.ensure_future(prewarm_scheduler.run())
+    # Kick off the server inactivity check (usually in a worker process),
+    # restarted if it ever fails
+    monitor_link.start()
+
+
+async def warm_up():
+    try:
+        await warm_up_ec2()
+    except Exception:
+        # the first EC2 call will just have to build it
+        log.exception("warm_up: couldn't set up the EC2 client")
+        return
+    mark_startup("EC2 client ready")
+    # Then fetch a snapshot, which connects to every running server's RCON,
+    # so the first command doesn't pay for the handshake either (this joins
+    # the refresh a restored snapshot has already started, if there is one)
+    try:
+        await server_snapshot.refresh()
+    except Exception:
+        log.exception("warm_up: couldn't fetch a server snapshot")
+        return
+    mark_startup("RCON connected")
+
+
 @bot.event
 async def on_ready():
+    mark_startup("ready")
     # Log the servers that the bot is connected to
     log.info(f'{bot.user} is connected to the following server(s):')
     for guild in bot.guilds:
@@ -98,8 +193,6 @@ async def on_ready():
     # Get the log channel
     global ERROR_LOG_CHANNEL
     ERROR_LOG_CHANNEL = bot.get_channel(int(os.getenv('ERROR_LOG_CHANNEL')))
-    # Kick off the server inactivity check
-    await server_inactivity_check()
 
 
 # Post a traceback to the dedicated error log channel
@@ -115,6 +208,58 @@ async def post_error_to_log_channel(ctx, error):
     )
 
 
+# Post a blocked event loop to the dedicated error log channel
+async def post_stall_to_log_channel(stall, unreported):
+    message = (
+        f"<@{ADMIN}>\n" +
+        f"Event loop blocked for {stall.duration * 1000:.0f}ms at " +
+        f"{dt.datetime.fromtimestamp(stall.started_at).strftime('%Y-%m-%d %H:%M:%S')}" +
+        (f" ({unreported} more since the last report)" if unreported else "") + "\n"
+    )
+    # keep the innermost frames if the stack doesn't fit in one message
+    stack = stall.stack[-(1900 - len(message)):]
+    await ERROR_LOG_CHANNEL.send(message + f"```\n{stack}\n```")
+
+
+# Post a server that has been falling behind to the dedicated error log channel
+async def post_lag_to_log_channel(server, sampler, unreported):
+    lagging = sampler.lagging
+    latest = lagging[-1]
+    await ERROR_LOG_CHANNEL.send(
+        f"<@{ADMIN}>\n" +
+        (f"Server: {server.name}\n" if is_fleet() else "") +
+        f"Ticks have taken over {TICK_MSPT_BUDGET:g}ms for the last {len(lagging)} samples " +
+        f"(latest {latest.mspt:.1f}ms" +
+        (f", {latest.tps:.1f} TPS" if latest.tps is not None else "") +
+        (f", {latest.entities} entities" if latest.entities is not None else "") + ")" +
+        (f" ({unreported} more since the last report)" if unreported else "")
+    )
+
+
+# Post who joined and left a server to the player feed channel
+async def post_player_changes(server_name, joined, left):
+    prefix = f"**{server_name}**: " if is_fleet() else ""
+    changes = []
+    if joined:
+        changes.append(f"📥 {', '.join(joined)} joined")
+    if left:
+        changes.append(f"📤 {', '.join(left)} left")
+    message = (prefix + " · ".join(changes)).replace('_', '\\_')
+    await bot.get_channel(int(PLAYER_FEED_CHANNEL)).send(message[:2000])
+
+
+# Time every command from dispatch until the handler is done
+@bot.before_invoke
+async def start_command_timer(ctx):
+    ctx.metrics_call = metrics.begin("command", command=ctx.command.name)
+
+
+@bot.after_invoke
+async def stop_command_timer(ctx):
+    metrics.end(ctx.metrics_call, "failed" if ctx.command_failed else None)
+    await first_command_served()
+
+
 # Error handling function
 @bot.event
 async def on_command_error(ctx, error):      
@@ -155,43 +300,6 @@ async def on_command_error(ctx, error):
         await post_error_to_log_channel(ctx, error)
 
 
-# continually poll the server status, and close it if it's inactive for too long
-async def server_inactivity_check():
-    global EC2_WAITING_TO_STOP
-    last_active_time = dt.datetime.now()
-    while True:
-        await asyncio.sleep(60*INACTIVITY_POLLING_RATE)
-        now = dt.datetime.now()
-        log.info(f"server_inactivity_check: checking for inactivity...")
-        if get_ec2_status() == "running":
-            rcon_status = get_rcon_status()
-            if not rcon_status or submit_rcon_command("list").startswith('There are 0'):
-                inactivity_time = int((now - last_active_time).total_seconds())
-                log.info(f"server_inactivity_check: inactivity detected (inactivity_time = {inactivity_time})")
-                if not EC2_WAITING_TO_STOP and inactivity_time > (INACTIVITY_TIMEOUT * 60):
-                    log.info(f"server_inactivity_check: TIMEOUT EXCEEDED")
-                    EC2_WAITING_TO_STOP = True
-                    try:
-                        if rcon_status:
-                            log.info(f"server_inactivity_check: stopping Minecraft server...")
-                            submit_rcon_command(f"stop")
-                            log.info(f"server_inactivity_check: allowing the server 120 seconds to exit cleanly before stopping EC2...")
-                            await asyncio.sleep(120)
-                            log.info(f"server_inactivity_check: stopping EC2...")
-                        else:
-                            log.info(f"server_inactivity_check: Minecraft server not responsive, skipping straight to stopping EC2...")
-                        stop_ec2_instance()
-                    finally:
-                        EC2_WAITING_TO_STOP = False
-                        last_active_time = now
-            else:
-                last_active_time = now
-                log.info(f"server_inactivity_check: server is active")
-        else:
-            last_active_time = now
-            log.info(f"server_inactivity_check: server not running.")
-
-
 ################################################################################
 #
 ### Bot maintenance commands 
@@ -223,11 +331,40 @@ async def about(ctx):
         f"**Libraries used:**\n" +
         f"• **discord.py** for general bot functionality: <https://discordpy.readthedocs.io/>\n" +
         f"• **boto3** for AWS administration: <https://github.com/boto/boto3>\n" +
-        f"• **mcrcon** for Minecraft administration: <https://pypi.org/project/mcrcon/>\n" +
+        f"• **asyncio** for talking to the Minecraft server over RCON: <https://wiki.vg/RCON>\n" +
         f"\nThe Minecraft server itself ({RCON_URL}) is hosted on an AWS EC2 instance (instance type `t4g.large`). It has 2 ARM CPU cores and 8GB RAM.\n"
     )
 
 
+# summary of the latency metrics (admin only)
+@bot.command(name='perf', help=f"Show call latencies and error counts (admin only)")
+async def perf(ctx):
+    if ctx.author.id != ADMIN:
+        await ctx.send(f"{ERROR_EMOTE} Only {ADMIN_NAME} can do that.")
+        return
+    rows = []
+    for (name, labels), histogram in sorted(metrics.histograms.items()):
+        series = name + "".join(f" {value}" for _, value in labels)
+        rows.append(
+            f"{series[:32]:<32} {histogram.count:>6} {metrics.error_count(name, labels):>5} " +
+            f"{histogram.quantile(0.5) * 1000:>7.0f} {histogram.quantile(0.99) * 1000:>7.0f} " +
+            f"{metrics.in_flight.get((name, labels), 0):>4}"
+        )
+    if not rows:
+        await ctx.send("📈 Nothing measured yet.")
+        return
+    header = f"{'call':<32} {'count':>6} {'errs':>5} {'p50 ms':>7} {'p99 ms':>7} {'busy':>4}"
+    stalls = ", ".join(
+        f"{count} in the last {window} ({seconds:.1f}s blocked)"
+        for window, (count, seconds) in loop_watchdog.summary().items()
+    )
+    footer = f"Event loop stalls: {stalls}. Worst lag: {loop_watchdog.max_lag * 1000:.0f}ms."
+    # stay under Discord's 2000 character message limit
+    while len("\n".join([header] + rows + [footer])) > 1900:
+        rows.pop()
+    await ctx.send("📈 **Performance since startup**\n```\n" + "\n".join([header] + rows) + "\n```\n" + footer)
+
+
 ################################################################################
 #
 ### Minecraft server management
@@ -235,24 +372,64 @@ async def about(ctx):
 # Note: EC2 is called "Machine" in user-facing commands,
 # and "EC2" in admin-only commands. 
 # Output for admin commands is also more terse.
+#
+# Every command takes an optional server name as its last argument, and uses the
+# first configured server if it's left out.
 
 
-# Print the player list
+# Find the server a command is about
+# Tells the user off and returns None if there's no such server
+async def find_server(ctx, name=None):
+    server = get_server(name)
+    if server is None:
+        await ctx.send(
+            f"{ERROR_EMOTE} I don't know a server called `{name}`. " +
+            f"Try one of: " + ", ".join(f"`{server_name}`" for server_name in SERVERS)
+        )
+    return server
+
+
+# Split lines into pages that each fit in one Discord message
+def paginate(lines, limit=1900, separator="\n"):
+    pages = [[]]
+    length = 0
+    for line in lines:
+        if pages[-1] and length + len(separator) + len(line) > limit:
+            pages.append([])
+            length = 0
+        pages[-1].append(line)
+        length += len(separator) + len(line)
+    return [separator.join(page) for page in pages]
+
+
+# A stop in progress, whether from a command or the inactivity monitor
+def stop_in_progress(server):
+    return is_stopping(server) or monitor_link.is_stopping(server)
+
+
+# Print the server address
 @bot.command(name='ip', aliases=['url'], help='Get server IP/URL')
-async def getip(ctx):
+async def getip(ctx, server_name: str=None):
+    server = await find_server(ctx, server_name)
+    if server is None:
+        return
     await ctx.send(
-        f"Connect to `{RCON_URL}` in your Minecraft client to play!\n" +
+        f"Connect to `{server.rcon_url}` in your Minecraft client to play!\n" +
         f"Check server status with `{PREFIX}status`."
     )
 
 
 # Print the player list
 @bot.command(name='list', aliases=['l', 'players', 'playerlist', 'listplayers', 'playerslist'], help='List current players')
-async def playerlist(ctx):
+async def playerlist(ctx, server_name: str=None):
     log.info(f"playerlist: user {ctx.author.name} requested player list")
-    if get_ec2_status() != "running": 
+    server = await find_server(ctx, server_name)
+    if server is None:
+        return
+    snapshot = await server_snapshot.get(server)
+    if not snapshot.is_running: 
         await ctx.send(f"{EC2_EMOTE} 🛑 Machine is not currently running, try `{PREFIX}status`.")
-    elif not get_rcon_status():
+    elif not snapshot.rcon_status:
         await ctx.send(
             f"{MINECRAFT_EMOTE} ⚠️ Machine is running, but Minecraft server is not responsive.\n" +
             f"If the server was just started, wait about a minute for it to become ready.\n" +
@@ -260,7 +437,7 @@ async def playerlist(ctx):
             f"Get {ADMIN_NAME} to investigate if it takes much longer."
         )
     else:
-        await ctx.send(get_player_list())
+        await ctx.send(format_player_list(snapshot.players))
 
 
 # Minecraft daytime ticks to human-readable 12-hour time string
@@ -287,19 +464,21 @@ def ticks_to_time(ticks):
 
 
 # returns the ingame time of the Minecraft server as a human-readable string
-def get_ingame_time():
-    resp = submit_rcon_command("time query daytime")
-    ticks = int(re.search(r"\d+", resp).group(0))
+def format_ingame_time(ticks):
     return f"The ingame time is **{ticks_to_time(ticks)}**"
 
 
 # Print the player list
 @bot.command(name='time', aliases=['t'], help='Get current ingame time')
-async def gettime(ctx):
+async def gettime(ctx, server_name: str=None):
     log.info(f"playerlist: user {ctx.author.name} requested ingame time")
-    if get_ec2_status() != "running": 
+    server = await find_server(ctx, server_name)
+    if server is None:
+        return
+    snapshot = await server_snapshot.get(server)
+    if not snapshot.is_running: 
         await ctx.send(f"{EC2_EMOTE} 🛑 Machine is not currently running, try `{PREFIX}status`.")
-    elif not get_rcon_status():
+    elif not snapshot.rcon_status:
         await ctx.send(
             f"{MINECRAFT_EMOTE} ⚠️ Machine is running, but Minecraft server is not responsive.\n" +
             f"If the server was just started, wait about a minute for it to become ready.\n" +
@@ -307,34 +486,66 @@ async def gettime(ctx):
             f"Get {ADMIN_NAME} to investigate if it takes much longer."
         )
     else:
-        await ctx.send(get_ingame_time())
+        await ctx.send(format_ingame_time(snapshot.daytime))
 
 
-# add someone to the Minecraft server whitelist
-@bot.command(name='whitelist', help=f"Add someone to the whitelist (admin only)")
-async def whitelist(ctx, name: str):    
-    log.info(f"whitelist: user {ctx.author.name} requested {name} be added to whitelist")
+# add (or remove) people to/from the Minecraft server whitelist, several at once
+# e.g. `whitelist alice bob`, `whitelist remove carol`, `whitelist add dave modded`
+@bot.command(name='whitelist', help=f"Add (or remove) people to/from the whitelist (admin only)")
+async def whitelist(ctx, *args):
+    args = list(args)
+    action = args.pop(0).lower() if args and args[0].lower() in ("add", "remove") else "add"
+    server_name = args.pop() if is_fleet() and len(args) > 1 and get_server(args[-1]) is not None else None
+    names = list(dict.fromkeys(args))
+    log.info(f"whitelist: user {ctx.author.name} requested whitelist {action} {', '.join(names)}")
     if ctx.author.id != ADMIN:
         await ctx.send(f"{ERROR_EMOTE} Only {ADMIN_NAME} can do that.")
-    elif not re.fullmatch(r"^\w{3,16}$", name):
-        await ctx.send(f"{ERROR_EMOTE} That's not a valid Minecraft username.")
-    elif get_ec2_status() != "running": 
+        return
+    server = await find_server(ctx, server_name)
+    if server is None:
+        return
+    snapshot = await server_snapshot.get(server)
+    invalid = [name for name in names if not re.fullmatch(r"^\w{3,16}$", name)]
+    if not names:
+        await ctx.send(f"{ERROR_EMOTE} Who should I {action}? Try `{PREFIX}whitelist {action} <name> [<name>...]`.")
+    elif invalid:
+        await ctx.send(f"{ERROR_EMOTE} Not valid Minecraft usernames: " + ", ".join(f"`{name}`" for name in invalid))
+    elif not snapshot.is_running: 
         await ctx.send(f"{EC2_EMOTE} 🛑 EC2 not running, try `{PREFIX}status`.")
-    elif not get_rcon_status():
+    elif not snapshot.rcon_status:
         await ctx.send(f"{MINECRAFT_EMOTE} ⚠️ EC2 running but server not responsive, try `{PREFIX}status`.\n")
     else:
-        await ctx.send(f"Adding {name} to the whitelist...")
-        resp = submit_rcon_command(f"whitelist add {name}")
-        await ctx.send("`" + resp + "`")
+        index = get_whitelist(server)
+        if action == "add":
+            await ctx.send(f"Adding {', '.join(names)} to the whitelist...")
+            results = await index.add(names)
+        else:
+            await ctx.send(f"Removing {', '.join(names)} from the whitelist...")
+            results = await index.remove(names)
+        changed = {name for name, _ in results}
+        lines = [f"• {name}: `{resp}`" for name, resp in results]
+        unchanged = [name for name in names if name not in changed]
+        if unchanged:
+            lines.append(
+                f"Already {'on' if action == 'add' else 'not on'} the whitelist: " + ", ".join(unchanged)
+            )
+        for page in paginate(lines):
+            await ctx.send(page.replace('_', '\\_'))
 
 
-# print the Minecraft server whitelist
+# print the Minecraft server whitelist, a page at a time
 @bot.command(name='printwhitelist', aliases=['getwhitelist', 'showwhitelist'], help=f"Print the current whitelist")
-async def printwhitelist(ctx):    
+async def printwhitelist(ctx, *args):
     log.info(f"whitelist: user {ctx.author.name} requested to see the whitelist")
-    if get_ec2_status() != "running": 
+    page_number = next((int(arg) for arg in args if arg.isdigit()), 1)
+    server_names = [arg for arg in args if not arg.isdigit()]
+    server = await find_server(ctx, server_names[0] if server_names else None)
+    if server is None:
+        return
+    snapshot = await server_snapshot.get(server)
+    if not snapshot.is_running: 
         await ctx.send(f"{EC2_EMOTE} 🛑 Machine is not currently running, try `{PREFIX}status`.")
-    elif not get_rcon_status():
+    elif not snapshot.rcon_status:
         await ctx.send(
             f"{MINECRAFT_EMOTE} ⚠️ Machine is running, but Minecraft server is not responsive.\n" +
             f"If the server was just started, wait about a minute for it to become ready.\n" +
@@ -342,35 +553,102 @@ async def printwhitelist(ctx):
             f"Get {ADMIN_NAME} to investigate if it takes much longer."
         )
     else:
-        resp = submit_rcon_command(f"whitelist list")
-        await ctx.send("`" + resp + "`")
+        names = await get_whitelist(server).names()
+        if not names:
+            await ctx.send("The whitelist is empty.")
+            return
+        pages = paginate([name.replace('_', '\\_') for name in names], limit=1800, separator=", ")
+        page_number = min(max(page_number, 1), len(pages))
+        message = f"**Whitelist** ({len(names)} players)"
+        if len(pages) > 1:
+            message += f", page {page_number}/{len(pages)}"
+        message += ":\n" + pages[page_number - 1]
+        if page_number < len(pages):
+            message += f"\nUse `{PREFIX}printwhitelist {page_number + 1}{' ' + server.name if is_fleet() else ''}` for more."
+        await ctx.send(message)
 
 
 # send any command through RCON
 @bot.command(name='rcon', help=f"Manual RCON command (admin only)")
-async def whitelist(ctx, cmd: str):    
+async def whitelist(ctx, cmd: str, server_name: str=None):
     log.info(f"whitelist: user {ctx.author.name} running RCON command \"{cmd}\"")
     if ctx.author.id != ADMIN:
         await ctx.send(f"{ERROR_EMOTE} Only {ADMIN_NAME} can do that.")
-    elif get_ec2_status() != "running": 
+        return
+    server = await find_server(ctx, server_name)
+    if server is None:
+        return
+    snapshot = await server_snapshot.get(server)
+    if not snapshot.is_running: 
         await ctx.send(f"{EC2_EMOTE} 🛑 EC2 not running, try `{PREFIX}status`.")
-    elif not get_rcon_status():
+    elif not snapshot.rcon_status:
         await ctx.send(f"{MINECRAFT_EMOTE} ⚠️ EC2 running but server not responsive, try `{PREFIX}status`.\n")
     else:
-        resp = submit_rcon_command(cmd)
+        resp = await submit_rcon_command(cmd, server.rcon)
+        # who knows what the command did, so don't trust the cached state
+        server_snapshot.invalidate()
+        get_whitelist(server).invalidate()
         await ctx.send("`" + resp + "`")
 
 
+# Post progress updates for a stop to the channel the command came from
+def stop_progress_reporter(ctx):
+    async def report(pipeline, state):
+        if state == StopState.SAVING:
+            await ctx.send(f"{MINECRAFT_EMOTE} 💾 Saving the world...")
+        elif state == StopState.STOPPING_SERVER:
+            await ctx.send(f"{MINECRAFT_EMOTE} 🛑 Stopping server...")
+        elif state == StopState.WAITING_FOR_EXIT:
+            await ctx.send(f"{MINECRAFT_EMOTE} 🛑 ⏳ Waiting for server to exit cleanly before stopping EC2 (at most {STOP_TIMEOUT:.0f} seconds)...")
+        elif state == StopState.HIBERNATING:
+            await ctx.send(f"{EC2_EMOTE} 💤 Hibernating EC2...")
+        elif state == StopState.STOPPING_EC2 and (pipeline.rcon_status or pipeline.server.hibernate):
+            await ctx.send(f"{EC2_EMOTE} 🛑 Stopping EC2...")
+        elif state == StopState.DONE and pipeline.hibernated:
+            await ctx.send(f"{EC2_EMOTE} 💤 ⏳ EC2 is hibernating, the next start will pick up where it left off.")
+        elif state == StopState.DONE:
+            await ctx.send(f"{EC2_EMOTE} 🛑 ⏳ EC2 is stopping, should be stopped in about 1 minute.")
+        elif state == StopState.FAILED:
+            await ctx.send(f"{ERROR_EMOTE} Stopping the server failed: `{pipeline.error!r}`")
+    return report
+
+
 # manually stop both the minecraft server and the EC2 instance
 # If there are players online, require a --force flag to boot them out
+# --cancel calls off a stop that's still saving the world
 @bot.command(name='stop', help=f"Manually stop the server (admin only)")
-async def stopserver(ctx, force: str=None):
+async def stopserver(ctx, *args):
     log.info(f"stopserver: user {ctx.author.name} requested a server stop")
-    ec2_status = get_ec2_status()
-    global EC2_WAITING_TO_STOP
+    force = "--force" in args
+    cancel = "--cancel" in args
+    server_names = [arg for arg in args if not arg.startswith("--")]
     if ctx.author.id != ADMIN:
         await ctx.send(f"{ERROR_EMOTE} Only {ADMIN_NAME} can do that.")
-    elif EC2_WAITING_TO_STOP:
+        return
+    server = await find_server(ctx, server_names[0] if server_names else None)
+    if server is None:
+        return
+    snapshot = await server_snapshot.get(server)
+    ec2_status = snapshot.ec2_status
+    if cancel:
+        # the stop might be ours, or the inactivity monitor's
+        state = await cancel_stop(server)
+        if state is None and monitor_link.is_stopping(server):
+            try:
+                state = await monitor_link.cancel_stop(server)
+            except (OSError, asyncio.TimeoutError) as e:
+                log.info(f"stopserver: couldn't ask the monitor to cancel ({e!r})")
+                await ctx.send(f"{ERROR_EMOTE} Couldn't reach the inactivity monitor to cancel its stop, try again in a moment.")
+                return
+        if state is None:
+            await ctx.send(f"{EC2_EMOTE} ❓ EC2 isn't waiting to stop, nothing to cancel.")
+        elif state == StopState.CANCELLED:
+            await ctx.send(f"{EC2_EMOTE} ✋ Stop cancelled, EC2 left running.")
+        elif state in (StopState.STOPPING_SERVER, StopState.WAITING_FOR_EXIT):
+            await ctx.send(f"{MINECRAFT_EMOTE} 🛑 ⏳ Too late to cancel, the Minecraft server has already been told to stop. EC2 will stop once it has exited.")
+        else:
+            await ctx.send(f"{EC2_EMOTE} 🛑 ⏳ Too late to cancel, EC2 is already stopping.")
+    elif stop_in_progress(server):
         await ctx.send(f"{EC2_EMOTE} 🛑 ⏳ EC2 is already waiting to stop.")
     elif ec2_status == "stopping":
         await ctx.send(f"{EC2_EMOTE} 🛑 ⏳ EC2 is already stopping.")
@@ -381,50 +659,79 @@ async def stopserver(ctx, force: str=None):
     elif ec2_status != "running": 
         await ctx.send(f"{EC2_EMOTE} ❓ Unrecognised EC2 status, try `{PREFIX}status`?")
     else:
-        rcon_status = get_rcon_status()
-        if rcon_status and not get_player_list().startswith("There are no") and force != "--force":
+        rcon_status = snapshot.rcon_status
+        if rcon_status and not snapshot.is_empty and not force:
             await ctx.send(f"{MINECRAFT_EMOTE} ⚠️ Server not empty! Use `--force` to stop server anyway.")
-            await ctx.send(get_player_list())
+            await ctx.send(format_player_list(snapshot.players))
         else:
-            try:
-                if rcon_status:
-                    EC2_WAITING_TO_STOP = True
-                    await ctx.send(f"{MINECRAFT_EMOTE} 🛑 Stopping server...")
-                    submit_rcon_command(f"stop")
-                    await ctx.send(f"{MINECRAFT_EMOTE} 🛑 ⏳ Allowing server 120 seconds to exit cleanly before stopping EC2...")
-                    await asyncio.sleep(120)
-                    await ctx.send(f"{EC2_EMOTE} 🛑 Stopping EC2...")
-                else:
-                    await ctx.send(f"{MINECRAFT_EMOTE} ⚠️ Server not responding. Stopping EC2...")
-                stop_ec2_instance()
-                await ctx.send(f"{EC2_EMOTE} 🛑 ⏳ EC2 is stopping, should be stopped in about 1 minute.")
-            finally:
-                EC2_WAITING_TO_STOP = False
-
+            if not rcon_status:
+                await ctx.send(f"{MINECRAFT_EMOTE} ⚠️ Server not responding. Stopping EC2...")
+            pipeline = start_stop(server, rcon_status, stop_progress_reporter(ctx))
+            monitor_link.wake(server)
+            await pipeline.wait()
 
-# Query the status of the server
-@bot.command(name='status', aliases=['s', 'serverstatus', 'server'], help='Get server status')
-async def serverstatus(ctx):
-    log.info(f"serverstatus: user {ctx.author.name} requested a server status check")
-    ec2_status = get_ec2_status()
-    log.info(f"EC2 instance status = {ec2_status}")
 
+# emoji to go with an EC2 instance state
+def ec2_status_emoji(ec2_status):
     if ec2_status == 'pending':
-        status_emoji = "⏳"
+        return "⏳"
     elif ec2_status == 'running':
-        status_emoji = "✅"
+        return "✅"
     elif ec2_status == 'stopping':
-        status_emoji = "🛑 ⏳"
+        return "🛑 ⏳"
     elif ec2_status == 'stopped':
-        status_emoji = "🛑"
+        return "🛑"
     else:
-        status_emoji = "❓"
+        return "❓"
+
+
+# One line per server, all from a single snapshot of the fleet
+async def fleet_status_message():
+    snapshots = await server_snapshot.get_all(warm=True)
+    lines = [f"{EC2_EMOTE} **Server status:**"]
+    for name, snapshot in snapshots.items():
+        line = f"• **{name}**: {ec2_status_emoji(snapshot.ec2_status)} {snapshot.ec2_status}"
+        if stop_in_progress(SERVERS[name]):
+            line += f", {MINECRAFT_EMOTE} 🛑 ⏳ stopping"
+        elif snapshot.is_running and not snapshot.rcon_status and snapshot.busy:
+            line += f", {MINECRAFT_EMOTE} ⏳ busy"
+        elif snapshot.is_running and not snapshot.rcon_status:
+            line += f", {MINECRAFT_EMOTE} ⚠️ unresponsive"
+        elif snapshot.is_running and snapshot.players is not None:
+            line += f", {MINECRAFT_EMOTE} {snapshot.players.count}/{snapshot.players.max} players"
+        lines.append(line)
+    lines.append(f"Use `{PREFIX}status <server>` for more details.")
+    restored = next((snapshot for snapshot in snapshots.values() if snapshot.restored), None)
+    if restored is not None:
+        lines.append(restored_note(restored))
+    return "\n".join(lines)
+
+
+# For answers based on the state saved before the bot restarted
+def restored_note(snapshot):
+    return f"*(as of {snapshot.age:.0f}s ago, from before the bot restarted; checking again now)*"
+
+
+# Query the status of the server
+# With several servers and none named, gives a one-line summary of each
+@bot.command(name='status', aliases=['s', 'serverstatus', 'server'], help='Get server status')
+async def serverstatus(ctx, server_name: str=None):
+    log.info(f"serverstatus: user {ctx.author.name} requested a server status check")
+    if server_name is None and is_fleet():
+        await ctx.send(await fleet_status_message())
+        return
+    server = await find_server(ctx, server_name)
+    if server is None:
+        return
+    snapshot = await server_snapshot.get(server, warm=True)
+    ec2_status = snapshot.ec2_status
+    log.info(f"EC2 instance status = {ec2_status}")
 
     # start with this message, 
     # and we're going to add stuff onto it to send all as one message.
-    status_message = f"{EC2_EMOTE} Machine status: {status_emoji} **{ec2_status}**\n"
+    status_message = f"{EC2_EMOTE} Machine status: {ec2_status_emoji(ec2_status)} **{ec2_status}**\n"
 
-    if EC2_WAITING_TO_STOP:
+    if stop_in_progress(server):
         status_message += "\n".join([
             f"{MINECRAFT_EMOTE} Minecraft server status: 🛑 ⏳ **stopping**",
             f"The server will automatically stop when inactive to save money.",
@@ -452,31 +759,94 @@ async def serverstatus(ctx):
         status_message += f"{ERROR_EMOTE} That seems bad, <@{ADMIN}> should probably investigate."
     else:
         log.info("Getting server status...")
-        if get_rcon_status(): 
+        if snapshot.rcon_status: 
             log.info(f"Server status: running")
-            status_message += "\n".join([
+            status_lines = [
                 f"{MINECRAFT_EMOTE} Minecraft server status: ✅ **running**",
-                get_player_list(),
-                get_ingame_time(),
-                f"Connect to `{RCON_URL}` in your Minecraft client to play!"
+                format_player_list(snapshot.players),
+                format_ingame_time(snapshot.daytime)
+            ]
+            ticks = server.rcon.ticks.latest
+            if ticks is not None and ticks.tps is not None:
+                status_lines.append(
+                    f"Server TPS: **{ticks.tps:.1f}**" +
+                    (f", **{ticks.mspt:.1f}ms** per tick" if ticks.mspt is not None else "") +
+                    (f", {ticks.entities} entities loaded" if ticks.entities is not None else "")
+                )
+            elif snapshot.tps is not None:
+                status_lines.append(f"Server TPS: **{snapshot.tps:.1f}**")
+            status_lines.append(f"Connect to `{server.rcon_url}` in your Minecraft client to play!")
+            status_message += "\n".join(status_lines)
+        elif snapshot.busy:
+            log.info(f"Server status: busy")
+            status_message += "\n".join([
+                f"{MINECRAFT_EMOTE} Minecraft server status: ⏳ **busy**",
+                f"The bot has too many requests waiting on the server to ask it right now, try again shortly."
             ])
         else:
             log.info(f"Server status: unresponsive")
-            status_message += "\n".join([
+            status_lines = [
                 f"{MINECRAFT_EMOTE} Minecraft server status: ⚠️ **unresponsive**",
                 f"If the server has just been started, wait a minute and try again.",
                 f"Otherwise, consider asking {ADMIN_NAME} to investigate."
-            ])
+            ]
+            breaker = server.rcon.breaker
+            if breaker.opened_at is not None and not breaker.allow():
+                since = dt.datetime.fromtimestamp(breaker.opened_at).strftime("%H:%M")
+                retry_in = breaker.retry_in
+                status_lines.append(
+                    f"*(not answering since {since}, " +
+                    (f"checking again in {retry_in:.0f}s)*" if retry_in is not None else "checking now)*")
+                )
+            status_message += "\n".join(status_lines)
+    if snapshot.restored:
+        status_message += "\n" + restored_note(snapshot)
     await ctx.send(status_message)
 
 
+# Keep one message up to date as a start progresses
+def start_progress_reporter(message, server):
+    async def report(tracker, phase):
+        if phase == StartPhase.STARTING_EC2:
+            content = f"{EC2_EMOTE} {MINECRAFT_EMOTE} ⏳ Starting up the server..."
+        elif phase == StartPhase.LOADING_WORLD:
+            content = (
+                f"{EC2_EMOTE} ✅ Machine running after {tracker.elapsed:.0f}s.\n" +
+                f"{MINECRAFT_EMOTE} ⏳ Waiting for the Minecraft server to load..."
+            )
+        elif phase == StartPhase.READY:
+            record = tracker.record
+            cold_start = expected_start_time(server, resumed=False) if record.resumed else None
+            content = (
+                f"{EC2_EMOTE} ✅ Machine {'resumed' if record.resumed else 'running'} after {record.ec2_boot:.0f}s.\n" +
+                f"{MINECRAFT_EMOTE} ✅ Minecraft server ready after another {record.world_load:.0f}s " +
+                f"(**{record.total:.0f}s** total" +
+                (f", a cold start usually takes {cold_start:.0f}s" if cold_start is not None else "") + ").\n" +
+                f"Connect to `{server.rcon_url}` in your Minecraft client to play!"
+            )
+        else:
+            content = (
+                f"{ERROR_EMOTE} Starting the server failed: `{tracker.error!r}`\n" +
+                f"<@{ADMIN}> should probably investigate."
+            )
+        await message.edit(content=content)
+    return report
+
+
 # Start the EC2 instance
 # A @reboot cronjob will automatically start the Minecraft server on boot
+# --wait keeps one message updated until the server is playable
 @bot.command(name='start', help=f"Start the Minecraft server")
-async def startserver(ctx):
+async def startserver(ctx, *args):
     log.info(f"startserver: user {ctx.author.name} requested a server start")
-    ec2_status = get_ec2_status()
-    if EC2_WAITING_TO_STOP:
+    wait = "--wait" in args
+    server_names = [arg for arg in args if not arg.startswith("--")]
+    server = await find_server(ctx, server_names[0] if server_names else None)
+    if server is None:
+        return
+    snapshot = await server_snapshot.get(server)
+    ec2_status = snapshot.ec2_status
+    if stop_in_progress(server):
         await ctx.send(
             f"{MINECRAFT_EMOTE} 🛑 ⏳ The server is already stopping.\n" +
             f"Wait a couple of minutes for it to come to a total stop before starting it again.\n" + 
@@ -495,10 +865,10 @@ async def startserver(ctx):
             f"Use `{PREFIX}status` to get updates."
         )
     elif ec2_status == "running":
-        if get_rcon_status():
+        if snapshot.rcon_status:
             await ctx.send(
                 f"{MINECRAFT_EMOTE} ✅ Minecraft server is already running.\n" +
-                get_player_list()
+                format_player_list(snapshot.players)
             )
         else: 
             await ctx.send(
@@ -513,18 +883,215 @@ async def startserver(ctx):
             f"{EC2_EMOTE} ⚠️ Unable to get the current state of the server!" + 
             f"<@{ADMIN}> should probably investigate."
         )
+    elif wait:
+        message = await ctx.send(f"{EC2_EMOTE} {MINECRAFT_EMOTE} ⏳ Starting up the server...")
+        tracker = await start_server(server, start_progress_reporter(message, server))
+        monitor_link.wake(server)
+        await tracker.wait()
     else:
         await ctx.send(f"{EC2_EMOTE} {MINECRAFT_EMOTE} ⏳ Starting up the server...")
-        start_ec2_instance()
+        await start_server(server)
+        monitor_link.wake(server)
         await ctx.send(
             f"{EC2_EMOTE} {MINECRAFT_EMOTE} ⏳ Server is starting! Give it about two minutes to become playable.\n" + 
-            f"Use `{PREFIX}status` to get updates."
+            f"Use `{PREFIX}status` to get updates, or `{PREFIX}start --wait` next time to be told when it's ready."
         )
 
 
+# Show how long recent starts took, to keep an eye on time-to-playable
+@bot.command(name='starttimes', aliases=['boottimes'], help='Show how long recent server starts took')
+async def starttimes(ctx, server_name: str=None):
+    server = await find_server(ctx, server_name)
+    if server is None:
+        return
+    records = load_start_records(server)[-10:]
+    if not records:
+        await ctx.send(f"{EC2_EMOTE} No starts recorded yet, try `{PREFIX}start --wait`.")
+        return
+    lines = [f"{EC2_EMOTE} **Recent starts** (machine boot + Minecraft load = total):"]
+    for record in reversed(records):
+        started = dt.datetime.fromtimestamp(record.started_at).strftime("%Y-%m-%d %H:%M")
+        tags = [tag for tag, applies in (("pre-warm", record.trigger == "prewarm"), ("resumed", record.resumed)) if applies]
+        tags = f" ({', '.join(tags)})" if tags else ""
+        lines.append(f"• {started}{tags}: {record.ec2_boot:.0f}s + {record.world_load:.0f}s = **{record.total:.0f}s**")
+    cold_start = expected_start_time(server, resumed=False)
+    resume = expected_start_time(server, resumed=True)
+    if cold_start is not None and resume is not None:
+        lines.append(
+            f"Median time to playable: **{resume:.0f}s** resuming from hibernation, " +
+            f"**{cold_start:.0f}s** from cold (**{cold_start - resume:.0f}s** saved)"
+        )
+    else:
+        lines.append(f"Median time to playable: **{resume if cold_start is None else cold_start:.0f}s**")
+    await ctx.send("\n".join(lines))
+
+
+# Player stats over the past day/week/month/year, from the presence history
+STATS_PERIODS = {'day': 1, 'week': 7, 'month': 30, 'year': 365}
+
+@bot.command(name='stats', help=f"Player stats for the past day, week (default), month or year")
+async def stats(ctx, *args):
+    period = next((arg.lower() for arg in args if arg.lower() in STATS_PERIODS), 'week')
+    server_names = [arg for arg in args if arg.lower() not in STATS_PERIODS]
+    server = await find_server(ctx, server_names[0] if server_names else None)
+    if server is None:
+        return
+    since = (dt.datetime.now() - dt.timedelta(days=STATS_PERIODS[period])).timestamp()
+    [(peak, player_sum, samples)] = await presence_store.summary(server.name, since)
+    if not samples:
+        await ctx.send(f"{MINECRAFT_EMOTE} No player history for the past {period} yet.")
+        return
+    lines = [
+        f"{MINECRAFT_EMOTE} **Player stats for the past {period}**" + (f" ({server.name})" if is_fleet() else "") + ":",
+        f"Peak: **{peak}** player{'s' if peak != 1 else ''}"
+    ]
+    busiest = await presence_store.busiest_hour(server.name, since)
+    if peak and busiest:
+        hour = dt.datetime.fromtimestamp(busiest[0][0] * 3600, dt.timezone.utc).strftime("%Y-%m-%d %H:00 UTC")
+        lines[-1] += f" (most recently {hour})"
+    lines.append(f"Average while checked: {player_sum / samples:.1f} players")
+    time_online = await presence_store.time_online(server.name, since)
+    if time_online:
+        lines.append("Hours online:")
+        for player, seconds in time_online:
+            lines.append(f"• {player}: {seconds / 3600:.1f}h".replace('_', '\\_'))
+    await ctx.send("\n".join(lines))
+
+
+################################################################################
+#
+### Slash commands
+#
+# /status, /start and /stop run the same code as their prefix versions, but
+# acknowledge the interaction straight away and then keep one reply up to date
+# instead of sending a message for every step.
+
+
+# Stands in for a command context so that a prefix command's handler can answer
+# a slash command: every message the handler sends becomes part of the one
+# deferred reply, which is edited in place as messages are sent or edited
+class InteractionReply:
+
+    def __init__(self, interaction):
+        self.interaction = interaction
+        self.author = interaction.user
+        self.guild = interaction.guild
+        self.channel = interaction.channel
+        # the content of each message sent so far, in order
+        self.sections = []
+
+    async def send(self, content):
+        self.sections.append(content)
+        await self._update()
+        return InteractionReplySection(self, len(self.sections) - 1)
+
+    async def _update(self):
+        content = "\n".join(self.sections)
+        # keep the latest news if it's all grown too long for one message
+        if len(content) > 2000:
+            content = "…" + content[-1999:]
+        await self.interaction.edit_original_response(content=content)
+
+
+# One message sent to an InteractionReply, so it can be edited like a message
+class InteractionReplySection:
+
+    def __init__(self, reply, index):
+        self.reply = reply
+        self.index = index
+
+    async def edit(self, content):
+        self.reply.sections[self.index] = content
+        await self.reply._update()
+
+
+# Acknowledge a slash command (Discord shows "thinking..." until the first
+# update) and run a prefix command's handler to answer it
+async def run_as_slash_command(interaction, command, *args):
+    await interaction.response.defer(thinking=True)
+    log.info(f"slash command: /{command.name} {' '.join(args)} from {interaction.user.name}")
+    async with metrics.timed("command", command=command.name, slash="true"):
+        await command.callback(InteractionReply(interaction), *args)
+    await first_command_served()
+
+
+async def server_name_autocomplete(interaction, current):
+    return [
+        app_commands.Choice(name=server.name, value=server.name)
+        for server in SERVERS.values() if server.name.lower().startswith(current.lower())
+    ]
+
+
+@bot.tree.command(name='status', description='Get server status')
+@app_commands.describe(server="Which server (default: all of them, or the only one)")
+@app_commands.autocomplete(server=server_name_autocomplete)
+async def slash_status(interaction: discord.Interaction, server: str=None):
+    await run_as_slash_command(interaction, serverstatus, *([server] if server else []))
+
+
+@bot.tree.command(name='start', description='Start the Minecraft server')
+@app_commands.describe(
+    server="Which server (default: the first one)",
+    wait="Keep the reply updated until the server is playable (default: yes)"
+)
+@app_commands.autocomplete(server=server_name_autocomplete)
+async def slash_start(interaction: discord.Interaction, server: str=None, wait: bool=True):
+    args = ([server] if server else []) + (["--wait"] if wait else [])
+    await run_as_slash_command(interaction, startserver, *args)
+
+
+@bot.tree.command(name='stop', description='Manually stop the server (admin only)')
+@app_commands.describe(
+    server="Which server (default: the first one)",
+    force="Stop even if people are playing",
+    cancel="Call off a stop that's still saving the world"
+)
+@app_commands.autocomplete(server=server_name_autocomplete)
+async def slash_stop(interaction: discord.Interaction, server: str=None, force: bool=False, cancel: bool=False):
+    args = ([server] if server else []) + (["--force"] if force else []) + (["--cancel"] if cancel else [])
+    await run_as_slash_command(interaction, stopserver, *args)
+
+
+@bot.tree.error
+async def on_app_command_error(interaction, error):
+    error = getattr(error, 'original', error)
+    log.error("".join(traceback.format_exception(type(error), error, error.__traceback__)))
+    message = f"{ERROR_EMOTE} An unknown error occurred. <@{ADMIN}> should probably go check the server log."
+    try:
+        if interaction.response.is_done():
+            await interaction.edit_original_response(content=message)
+        else:
+            await interaction.response.send_message(message)
+    except discord.HTTPException:
+        pass
+    await post_error_to_log_channel(InteractionReply(interaction), error)
+
+
+# Register the slash commands with Discord (started from setup_hook).
+# Discord rate limits registering commands, so it's only done when they've
+# changed since the last time, going by a hash of their definitions.
+async def sync_slash_commands():
+    definitions = json.dumps([command.to_dict(bot.tree) for command in bot.tree.get_commands()], sort_keys=True)
+    digest = hashlib.sha256(definitions.encode()).hexdigest()
+    synced_digest, _ = state_store.load("slash_commands")
+    if synced_digest == digest:
+        log.info("Slash commands unchanged since they were last registered")
+        return
+    try:
+        synced = await bot.tree.sync()
+    except discord.HTTPException:
+        log.exception("Couldn't register the slash commands")
+        return
+    state_store.save("slash_commands", digest)
+    log.info(f"Registered {len(synced)} slash commands")
+
+
 ################################################################################
 #
 ### Main function
 
 if __name__ == "__main__":
-    bot.run(DISCORD_TOKEN)
+    mark_startup("imported")
+    # logging is already set up (see log_utils.py), so don't let discord.py
+    # add its own handler
+    bot.run(DISCORD_TOKEN, log_handler=None)
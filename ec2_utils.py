@@ -1,33 +1,219 @@
 import os
 import logging
-import boto3
+import asyncio
+import functools
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pprint import pformat
-from botocore.exceptions import ClientError
+from botocore.exceptions import ClientError, ConnectionError as BotoConnectionError, ReadTimeoutError
+
+from metrics_utils import metrics
 
 log = logging.getLogger("bot")
 
-ec2 = boto3.client('ec2')
+# Timeouts and retries for EC2 API calls.
+# boto3 is blocking, so every call runs on a small dedicated thread pool to keep
+# it off the event loop. botocore's own retries are switched off: they would
+# sleep inside a pool thread, so we back off on the event loop instead.
+EC2_TIMEOUT      = float(os.getenv('EC2_TIMEOUT', '10'))
+EC2_MAX_ATTEMPTS = int(os.getenv('EC2_MAX_ATTEMPTS', '5'))
+EC2_MAX_WORKERS  = int(os.getenv('EC2_MAX_WORKERS', '4'))
+EC2_BACKOFF_BASE = 0.5
+EC2_BACKOFF_CAP  = 20
+
+# How often wait_for_ec2_running() polls, and when it gives up, in seconds
+EC2_WAITER_DELAY   = int(os.getenv('EC2_WAITER_DELAY', '5'))
+EC2_WAITER_TIMEOUT = float(os.getenv('EC2_WAITER_TIMEOUT', '300'))
+
+# Error codes that mean "try again later" rather than "you did something wrong"
+RETRYABLE_ERROR_CODES = {
+	'RequestLimitExceeded',
+	'Throttling',
+	'ThrottlingException',
+	'TooManyRequestsException',
+	'InternalError',
+	'ServiceUnavailable',
+	'Unavailable',
+}
+
+# Error codes from a hibernating stop that mean the instance can't hibernate
+# (not launched with hibernation on, not ready yet, or an unsupported setup),
+# so it should be stopped the normal way instead
+HIBERNATE_UNSUPPORTED_CODES = {
+	'UnsupportedHibernationConfiguration',
+	'UnsupportedOperation',
+}
+
+# What DescribeInstances gives as the state reason of a hibernated instance
+HIBERNATED_STATE_REASON = 'Client.UserInitiatedHibernate'
+
+# States an instance can't get from to running without being started again
+# (the same ones boto3's instance_running waiter gives up on)
+NOT_STARTING_STATES = {'shutting-down', 'terminated', 'stopping'}
+
+
+# raised when an instance that's being waited for goes somewhere other than running
+class EC2StateError(Exception):
+	pass
+
+# The boto3 client, built on first use by get_ec2_client(). Importing boto3
+# and building a client take the best part of a second, which would otherwise
+# hold up starting the bot.
+ec2 = None
+_ec2_lock = threading.Lock()
+
+ec2_executor = ThreadPoolExecutor(max_workers=EC2_MAX_WORKERS, thread_name_prefix="ec2")
 
 # boto3 reads the AWS credentials from environment variables automatically,
 # so we only need the info about the EC2 instance.
 EC2_INSTANCE_ID = os.getenv('EC2_INSTANCE_ID')
-	
+
+
+# The EC2 client, building it if this is the first call.
+# Blocks while it's built, so call it from the EC2 thread pool.
+def get_ec2_client():
+	global ec2
+	with _ec2_lock:
+		if ec2 is None:
+			import boto3
+			from botocore.config import Config
+			ec2 = boto3.client('ec2', config=Config(
+				connect_timeout=EC2_TIMEOUT,
+				read_timeout=EC2_TIMEOUT,
+				retries={'max_attempts': 1, 'mode': 'standard'},
+			))
+	return ec2
+
+
+# Build the EC2 client in the background, so the first command doesn't wait for it
+async def warm_up_ec2():
+	loop = asyncio.get_running_loop()
+	await loop.run_in_executor(ec2_executor, get_ec2_client)
+	log.info("warm_up_ec2: EC2 client ready")
+
+
+def _call_client(method, *args, **kwargs):
+	return getattr(get_ec2_client(), method)(*args, **kwargs)
+
+
+# Run a blocking boto3 call on the EC2 thread pool, with a timeout per attempt
+# and exponential backoff (with full jitter) on throttling and transient errors.
+# func is a function to run, or the name of an EC2 client method.
+async def call_ec2(func, *args, timeout=EC2_TIMEOUT, attempts=EC2_MAX_ATTEMPTS, **kwargs):
+	name = func if isinstance(func, str) else getattr(func, '__name__', repr(func))
+	if isinstance(func, str):
+		func, args = _call_client, (func,) + args
+	async with metrics.timed("ec2", call=name):
+		return await _call_ec2(name, func, args, kwargs, timeout, attempts)
+
+
+async def _call_ec2(name, func, args, kwargs, timeout, attempts):
+	loop = asyncio.get_running_loop()
+	for attempt in range(1, attempts + 1):
+		try:
+			return await asyncio.wait_for(
+				loop.run_in_executor(ec2_executor, functools.partial(func, *args, **kwargs)),
+				timeout
+			)
+		except ClientError as e:
+			code = e.response.get('Error', {}).get('Code')
+			if code not in RETRYABLE_ERROR_CODES or attempt == attempts:
+				log.error(f"call_ec2: {name} failed: {pformat(e.response.get('Error'))}")
+				raise
+			metrics.count_error("ec2_attempt", code, call=name)
+			log.info(f"call_ec2: {name} got {code} (attempt {attempt}/{attempts}), backing off...")
+		except (asyncio.TimeoutError, BotoConnectionError, ReadTimeoutError) as e:
+			if attempt == attempts:
+				raise
+			metrics.count_error("ec2_attempt", type(e).__name__, call=name)
+			log.info(f"call_ec2: {name} failed with {e!r} (attempt {attempt}/{attempts}), backing off...")
+		await asyncio.sleep(random.uniform(0, min(EC2_BACKOFF_CAP, EC2_BACKOFF_BASE * 2 ** attempt)))
+
+
+# Get the current state of several instances in one DescribeInstances call
+# (following pagination if AWS splits the answer up)
+# Returns a dict of instance id -> state name
+def _describe_instance_states(instance_ids):
+	states = {}
+	paginator = get_ec2_client().get_paginator('describe_instances')
+	for page in paginator.paginate(InstanceIds=list(instance_ids)):
+		for reservation in page['Reservations']:
+			for instance in reservation['Instances']:
+				states[instance['InstanceId']] = instance['State']['Name']
+	return states
+
+
+async def get_ec2_statuses(instance_ids):
+	log.info(f"get_ec2_statuses: checking status of {', '.join(instance_ids)}...")
+	return await call_ec2(_describe_instance_states, instance_ids)
+
 
 # Get the current state of the instance
 # one of 'pending'|'running'|'shutting-down'|'terminated'|'stopping'|'stopped'
-def get_ec2_status():
-	log.info(f"get_ec2_status: checking status of {EC2_INSTANCE_ID}...")
-	resp = ec2.describe_instances(InstanceIds=[EC2_INSTANCE_ID])
-	return resp['Reservations'][0]['Instances'][0]['State']['Name']
+async def get_ec2_status(instance_id=None):
+	instance_id = instance_id or EC2_INSTANCE_ID
+	return (await get_ec2_statuses([instance_id]))[instance_id]
 
 
 # Start the instance
-def start_ec2_instance():
-	log.info(f"start_ec2_instance: starting instance {EC2_INSTANCE_ID}...")
-	ec2.start_instances(InstanceIds=[EC2_INSTANCE_ID])
+async def start_ec2_instance(instance_id=None):
+	instance_id = instance_id or EC2_INSTANCE_ID
+	log.info(f"start_ec2_instance: starting instance {instance_id}...")
+	await call_ec2('start_instances', InstanceIds=[instance_id])
+
+
+# Wait for the instance to reach the running state.
+# Polls with ordinary status calls, sleeping on the event loop in between,
+# rather than with boto3's waiter, which would hold a pool thread the whole
+# time and leave the other EC2 calls queueing behind a few starts.
+async def wait_for_ec2_running(instance_id=None, timeout=EC2_WAITER_TIMEOUT):
+	instance_id = instance_id or EC2_INSTANCE_ID
+	log.info(f"wait_for_ec2_running: waiting for instance {instance_id}...")
+	await asyncio.wait_for(_poll_until_running(instance_id), timeout)
+
+
+async def _poll_until_running(instance_id):
+	while True:
+		state = (await get_ec2_statuses([instance_id])).get(instance_id)
+		if state == 'running':
+			return
+		if state in NOT_STARTING_STATES:
+			raise EC2StateError(f"instance {instance_id} is {state}, it won't reach running")
+		await asyncio.sleep(EC2_WAITER_DELAY)
 
 
 # Stop the instance
-def stop_ec2_instance():
-	log.info(f"stop_ec2_instance: stopping instance {EC2_INSTANCE_ID}...")
-	ec2.stop_instances(InstanceIds=[EC2_INSTANCE_ID])
\ No newline at end of file
+async def stop_ec2_instance(instance_id=None):
+	instance_id = instance_id or EC2_INSTANCE_ID
+	log.info(f"stop_ec2_instance: stopping instance {instance_id}...")
+	await call_ec2('stop_instances', InstanceIds=[instance_id])
+
+
+# Hibernate the instance: its memory is saved to the root volume, so the next
+# start resumes the running Minecraft server instead of booting from scratch.
+# Returns False, without stopping anything, if the instance can't hibernate.
+async def hibernate_ec2_instance(instance_id=None):
+	instance_id = instance_id or EC2_INSTANCE_ID
+	log.info(f"hibernate_ec2_instance: hibernating instance {instance_id}...")
+	try:
+		await call_ec2('stop_instances', InstanceIds=[instance_id], Hibernate=True)
+	except ClientError as e:
+		code = e.response.get('Error', {}).get('Code')
+		if code not in HIBERNATE_UNSUPPORTED_CODES:
+			raise
+		log.info(f"hibernate_ec2_instance: {instance_id} can't hibernate ({code})")
+		return False
+	return True
+
+
+def _state_reason(instance_id):
+	reservations = get_ec2_client().describe_instances(InstanceIds=[instance_id])['Reservations']
+	return reservations[0]['Instances'][0].get('StateReason', {}).get('Code')
+
+
+# Whether the instance is stopped because it was hibernated (so starting it
+# will resume it)
+async def is_ec2_hibernated(instance_id=None):
+	instance_id = instance_id or EC2_INSTANCE_ID
+	return await call_ec2(_state_reason, instance_id) == HIBERNATED_STATE_REASON
@@ -0,0 +1,88 @@
+import os
+import time
+import logging
+import asyncio
+
+log = logging.getLogger("bot")
+
+# Discord channel id to post people joining and leaving to. Leave blank to turn
+# the feed off.
+PLAYER_FEED_CHANNEL = os.getenv('PLAYER_FEED_CHANNEL', '')
+
+# Changes are collected for this many seconds before being posted, so that a
+# crowd logging in at once makes one message rather than one each
+PLAYER_FEED_WINDOW = float(os.getenv('PLAYER_FEED_WINDOW', '10'))
+
+# How often the inactivity monitor looks at a running server while the feed is
+# on, in seconds (it otherwise only looks every INACTIVITY_POLLING_RATE minutes)
+PLAYER_FEED_POLLING_RATE = float(os.getenv('PLAYER_FEED_POLLING_RATE', '60'))
+
+
+# Turns successive player lists into "who joined, who left".
+# Every sample is compared with the one before it for the same server, and the
+# differences are held for PLAYER_FEED_WINDOW before going to on_delta. Someone
+# who leaves and comes back (or the other way round) within the window cancels
+# out and isn't reported at all.
+class PlayerFeed:
+
+	def __init__(self, window=PLAYER_FEED_WINDOW):
+		self.window = window
+		# async function taking (server name, joined, left), each a sorted list
+		# of names. Nothing is collected while it's unset.
+		self.on_delta = None
+		# function taking (server name, names, wall clock time) that gets the
+		# samples instead, e.g. to pass them from the worker process to the bot
+		self.on_sample = None
+		# server name -> (wall clock time, frozenset of names) of the latest sample
+		self._last = {}
+		# server name -> (joined, left) sets not posted yet
+		self._pending = {}
+		self._flush_task = None
+
+	# Take a new sample of who's on a server (an empty set if it's offline)
+	def observe(self, server_name, names, at=None):
+		at = at if at is not None else time.time()
+		if self.on_sample is not None:
+			self.on_sample(server_name, names, at)
+			return
+		if self.on_delta is None:
+			return
+		last = self._last.get(server_name)
+		# samples from the worker can arrive after newer ones from the bot
+		if last is not None and at < last[0]:
+			return
+		self._last[server_name] = (at, names)
+		# the first sample is just where the feed starts from
+		if last is None or names == last[1]:
+			return
+
+		joined, left = self._pending.setdefault(server_name, (set(), set()))
+		for name in names - last[1]:
+			if name in left:
+				left.discard(name)
+			else:
+				joined.add(name)
+		for name in last[1] - names:
+			if name in joined:
+				joined.discard(name)
+			else:
+				left.add(name)
+		if self._flush_task is None:
+			self._flush_task = asyncio.ensure_future(self._flush_later())
+
+	async def _flush_later(self):
+		await asyncio.sleep(self.window)
+		pending, self._pending = self._pending, {}
+		self._flush_task = None
+		for server_name, (joined, left) in pending.items():
+			if not joined and not left:
+				continue
+			log.info(f"PlayerFeed: {server_name}: joined {sorted(joined)}, left {sorted(left)}")
+			try:
+				await self.on_delta(server_name, sorted(joined, key=str.lower), sorted(left, key=str.lower))
+			except Exception:
+				log.exception("PlayerFeed: posting changes failed")
+
+
+# the one feed, fed by every player list the bot or the monitor fetches
+player_feed = PlayerFeed()
@@ -0,0 +1,73 @@
+import os
+import json
+import logging
+from dataclasses import dataclass, field
+
+from rcon_utils import RconClient, get_rcon_client, RCON_PORT, RCON_TIMEOUT
+
+log = logging.getLogger("bot")
+
+# Optional JSON file describing several Minecraft servers (see
+# servers.json.template). Without it, the bot manages the single server
+# described by EC2_INSTANCE_ID/RCON_URL/RCON_PASSWORD in .env.
+SERVERS_FILE = os.getenv('SERVERS_FILE')
+
+
+# One Minecraft server: the EC2 instance it runs on, where to reach it over
+# RCON, and how long it can sit empty before being stopped
+@dataclass
+class Server:
+	name: str
+	instance_id: str
+	rcon_url: str
+	rcon_password: str = field(repr=False)
+	rcon_port: int = RCON_PORT
+	rcon_timeout: float = RCON_TIMEOUT
+	# minutes
+	inactivity_timeout: int = int(os.getenv('INACTIVITY_TIMEOUT', '30'))
+	# hibernate the instance instead of stopping it, so that starting it again
+	# resumes the running Minecraft server (the instance has to be launched
+	# with hibernation enabled; stops fall back to a normal stop otherwise)
+	hibernate: bool = os.getenv('EC2_HIBERNATE', '').lower() in ('1', 'true', 'yes')
+
+	@property
+	def rcon(self) -> RconClient:
+		return get_rcon_client(self.rcon_url, self.rcon_password, self.rcon_port, self.rcon_timeout)
+
+
+def _load_servers():
+	if SERVERS_FILE:
+		log.info(f"fleet_utils: loading servers from {SERVERS_FILE}")
+		with open(SERVERS_FILE) as f:
+			servers = [Server(**entry) for entry in json.load(f)]
+	else:
+		servers = [Server(
+			name=os.getenv('SERVER_NAME', 'main'),
+			instance_id=os.getenv('EC2_INSTANCE_ID'),
+			rcon_url=os.getenv('RCON_URL'),
+			rcon_password=os.getenv('RCON_PASSWORD')
+		)]
+	if not servers:
+		raise ValueError("No servers configured")
+	return {server.name: server for server in servers}
+
+
+# name -> Server, in the order they were configured.
+# The first one is the default for commands that don't name a server.
+SERVERS = _load_servers()
+DEFAULT_SERVER = next(iter(SERVERS.values()))
+# lowercased name -> Server, for get_server only. Everything else keys servers
+# by server.name as configured.
+_SERVERS_BY_LOWER_NAME = {name.lower(): server for name, server in SERVERS.items()}
+
+
+# Look up a server by name (case insensitive), or the default server if no
+# name is given. Returns None if there's no server by that name.
+def get_server(name=None):
+	if name is None:
+		return DEFAULT_SERVER
+	return _SERVERS_BY_LOWER_NAME.get(name.lower())
+
+
+def is_fleet():
+	return len(SERVERS) > 1
@@ -0,0 +1,140 @@
+import os
+import sys
+import gzip
+import json
+import time
+import queue
+import atexit
+import shutil
+import logging
+import logging.handlers
+
+# Where the log files go. The current one is always bot.log (monitor.log for
+# the monitor worker); older ones are compressed to bot.log.<timestamp>.gz
+LOG_DIR = os.getenv('LOG_DIR', 'logs')
+
+# "text" for the usual one line per message, or "json" for one JSON object
+# per line (easier to feed into other tools)
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text')
+
+# Start a new log file once the current one reaches this many megabytes, or is
+# this many hours old, whichever comes first
+LOG_MAX_MB         = float(os.getenv('LOG_MAX_MB', '10'))
+LOG_ROTATE_HOURS   = float(os.getenv('LOG_ROTATE_HOURS', '24'))
+
+# Keep at most this many old log files, taking up at most this many megabytes
+LOG_BACKUP_COUNT   = int(os.getenv('LOG_BACKUP_COUNT', '30'))
+LOG_BACKUP_MAX_MB  = float(os.getenv('LOG_BACKUP_MAX_MB', '100'))
+
+TEXT_FORMAT = "%(asctime)s %(levelname)-8s %(message)s"
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+# no colons, so the names work on every filesystem
+ROTATED_SUFFIX_FORMAT = "%Y-%m-%d_%H-%M-%S"
+
+
+# One JSON object per line: time, level, logger, message, and the traceback if
+# there is one
+class JsonFormatter(logging.Formatter):
+
+	def format(self, record):
+		entry = {
+			'time': self.formatTime(record, DATE_FORMAT),
+			'level': record.levelname,
+			'logger': record.name,
+			'message': record.getMessage(),
+		}
+		if record.exc_info:
+			entry['exception'] = self.formatException(record.exc_info)
+		return json.dumps(entry, ensure_ascii=False)
+
+
+# A log file that starts over when it gets too big or too old.
+# Old files are gzipped, and the oldest are deleted to keep the log directory
+# under LOG_BACKUP_COUNT files and LOG_BACKUP_MAX_MB megabytes. All of this
+# happens on the logging thread, never on the event loop.
+class CompressingRotatingFileHandler(logging.handlers.RotatingFileHandler):
+
+	def __init__(self, filename, max_bytes, interval, backup_count, backup_max_bytes):
+		super().__init__(filename, maxBytes=max_bytes, encoding="utf-8", delay=True)
+		self.interval = interval
+		self.backup_count = backup_count
+		self.backup_max_bytes = backup_max_bytes
+		self.rollover_at = time.time() + interval
+
+	def shouldRollover(self, record):
+		if time.time() >= self.rollover_at:
+			return True
+		return super().shouldRollover(record)
+
+	def doRollover(self):
+		if self.stream:
+			self.stream.close()
+			self.stream = None
+		if os.path.exists(self.baseFilename) and os.path.getsize(self.baseFilename) > 0:
+			rotated = f"{self.baseFilename}.{time.strftime(ROTATED_SUFFIX_FORMAT)}"
+			# more than one rollover in the same second
+			n = 1
+			while os.path.exists(rotated + ".gz"):
+				rotated = f"{self.baseFilename}.{time.strftime(ROTATED_SUFFIX_FORMAT)}-{n}"
+				n += 1
+			os.rename(self.baseFilename, rotated)
+			with open(rotated, "rb") as src, gzip.open(rotated + ".gz", "wb") as dst:
+				shutil.copyfileobj(src, dst)
+			os.remove(rotated)
+		self._prune()
+		self.rollover_at = time.time() + self.interval
+
+	# Delete the oldest compressed logs beyond the count and size limits
+	def _prune(self):
+		directory, base = os.path.split(self.baseFilename)
+		backups = sorted(
+			(os.path.join(directory, name) for name in os.listdir(directory)
+				if name.startswith(base + ".") and name.endswith(".gz")),
+			key=os.path.getmtime,
+			reverse=True
+		)
+		total = 0
+		for i, path in enumerate(backups):
+			total += os.path.getsize(path)
+			if i >= self.backup_count or total > self.backup_max_bytes:
+				os.remove(path)
+
+
+# Send every log message through a queue to a background thread that does the
+# actual writing (console and file), so logging never blocks the event loop.
+# Returns the bot's logger.
+def setup_logging(filename="bot.log"):
+	os.makedirs(LOG_DIR, exist_ok=True)
+	if LOG_FORMAT == "json":
+		formatter = JsonFormatter()
+	else:
+		formatter = logging.Formatter(TEXT_FORMAT, datefmt=DATE_FORMAT)
+
+	console = logging.StreamHandler(sys.stderr)
+	console.setFormatter(logging.Formatter(TEXT_FORMAT, datefmt=DATE_FORMAT))
+	console.setLevel(logging.INFO)
+
+	file = CompressingRotatingFileHandler(
+		os.path.join(LOG_DIR, filename),
+		max_bytes=int(LOG_MAX_MB * 1024 * 1024),
+		interval=LOG_ROTATE_HOURS * 3600,
+		backup_count=LOG_BACKUP_COUNT,
+		backup_max_bytes=LOG_BACKUP_MAX_MB * 1024 * 1024
+	)
+	file.setFormatter(formatter)
+	file.setLevel(logging.DEBUG)
+	# a fresh file for every run of the bot, like before
+	file.doRollover()
+
+	log_queue = queue.SimpleQueue()
+	root = logging.getLogger()
+	root.setLevel(logging.INFO)
+	root.handlers = [logging.handlers.QueueHandler(log_queue)]
+	listener = logging.handlers.QueueListener(log_queue, console, file, respect_handler_level=True)
+	listener.start()
+	# write out whatever's still queued when the bot exits
+	atexit.register(listener.stop)
+
+	log = logging.getLogger("bot")
+	log.setLevel(logging.DEBUG)
+	return log
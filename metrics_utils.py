@@ -0,0 +1,176 @@
+import os
+import time
+import bisect
+import logging
+import asyncio
+from contextlib import asynccontextmanager
+
+log = logging.getLogger("bot")
+
+# Where to serve metrics in Prometheus text format. Leave METRICS_PORT empty to
+# turn the endpoint off (!perf still works).
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = os.getenv('METRICS_PORT', '9108')
+
+# Histogram bucket upper bounds, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+
+# Latency distribution of one kind of call, in fixed buckets
+class Histogram:
+
+	def __init__(self, buckets=LATENCY_BUCKETS):
+		self.buckets = buckets
+		# counts[i] is the number of observations <= buckets[i] (and > the
+		# bucket before it); the last one is everything bigger
+		self.counts = [0] * (len(buckets) + 1)
+		self.sum = 0.0
+		self.count = 0
+
+	def observe(self, value):
+		self.counts[bisect.bisect_left(self.buckets, value)] += 1
+		self.sum += value
+		self.count += 1
+
+	# Estimate a quantile (0-1) by interpolating within its bucket
+	def quantile(self, q):
+		if self.count == 0:
+			return None
+		rank = q * self.count
+		seen = 0
+		for i, count in enumerate(self.counts):
+			if count and seen + count >= rank:
+				lower = self.buckets[i - 1] if i > 0 else 0.0
+				if i == len(self.buckets):
+					return lower
+				return lower + (self.buckets[i] - lower) * (rank - seen) / count
+			seen += count
+		return self.buckets[-1]
+
+
+# Latency histograms, error counters and in-flight gauges for every kind of
+# call the bot makes, keyed by (metric name, label tuple)
+class Metrics:
+
+	def __init__(self):
+		self.histograms = {}
+		self.errors = {}
+		self.in_flight = {}
+
+	# Time a block of code, counting it as in flight while it runs, and as an
+	# error (by exception type) if it raises
+	@asynccontextmanager
+	async def timed(self, name, **labels):
+		call = self.begin(name, **labels)
+		try:
+			yield
+		except BaseException as e:
+			self.end(call, type(e).__name__)
+			raise
+		self.end(call)
+
+	# For calls that start and finish in different places: begin() returns a
+	# token to hand to end() when the call is over
+	def begin(self, name, **labels):
+		key = (name, tuple(sorted(labels.items())))
+		self.in_flight[key] = self.in_flight.get(key, 0) + 1
+		return key, time.perf_counter()
+
+	def end(self, call, error=None):
+		key, start = call
+		self.in_flight[key] -= 1
+		self._observe(key, time.perf_counter() - start)
+		if error is not None:
+			self._count_error(key, error)
+
+	# Record a duration that was measured some other way
+	def observe(self, name, seconds, **labels):
+		self._observe((name, tuple(sorted(labels.items()))), seconds)
+
+	def _observe(self, key, seconds):
+		if key not in self.histograms:
+			self.histograms[key] = Histogram()
+		self.histograms[key].observe(seconds)
+
+	# Count an error that didn't end a call, e.g. an attempt that gets retried
+	def count_error(self, name, error, **labels):
+		self._count_error((name, tuple(sorted(labels.items()))), error)
+
+	def _count_error(self, key, error):
+		error_key = (key[0], key[1] + (('error', error),))
+		self.errors[error_key] = self.errors.get(error_key, 0) + 1
+
+	# Total errors for one series, across all error types
+	def error_count(self, name, labels):
+		return sum(
+			count for (error_name, error_labels), count in self.errors.items()
+			if error_name == name and error_labels[:-1] == labels
+		)
+
+	# Everything, in Prometheus text exposition format
+	def render(self):
+		lines = []
+		for name in sorted({name for name, _ in self.histograms}):
+			lines.append(f"# TYPE {name}_seconds histogram")
+			for (series, labels), histogram in sorted(self.histograms.items()):
+				if series != name:
+					continue
+				cumulative = 0
+				for bound, count in zip(list(histogram.buckets) + ["+Inf"], histogram.counts):
+					cumulative += count
+					lines.append(f"{name}_seconds_bucket{_labels(labels + (('le', bound),))} {cumulative}")
+				lines.append(f"{name}_seconds_sum{_labels(labels)} {histogram.sum}")
+				lines.append(f"{name}_seconds_count{_labels(labels)} {histogram.count}")
+		for name in sorted({name for name, _ in self.errors}):
+			lines.append(f"# TYPE {name}_errors_total counter")
+			for (series, labels), count in sorted(self.errors.items()):
+				if series == name:
+					lines.append(f"{name}_errors_total{_labels(labels)} {count}")
+		for name in sorted({name for name, _ in self.in_flight}):
+			lines.append(f"# TYPE {name}_in_flight gauge")
+			for (series, labels), count in sorted(self.in_flight.items()):
+				if series == name:
+					lines.append(f"{name}_in_flight{_labels(labels)} {count}")
+		return "\n".join(lines) + "\n"
+
+	# Serve render() over HTTP until cancelled. Any request gets the metrics.
+	async def serve(self, host=METRICS_HOST, port=METRICS_PORT):
+		if not port:
+			return
+		server = await asyncio.start_server(self._handle_http, host, int(port))
+		log.info(f"Metrics: serving on http://{host}:{port}/metrics")
+		async with server:
+			await server.serve_forever()
+
+	async def _handle_http(self, reader, writer):
+		try:
+			# read the request line and headers, and ignore them
+			while (await asyncio.wait_for(reader.readline(), 5)).strip():
+				pass
+			body = self.render().encode()
+			writer.write(
+				b"HTTP/1.1 200 OK\r\n" +
+				b"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n" +
+				f"Content-Length: {len(body)}\r\n".encode() +
+				b"Connection: close\r\n\r\n" +
+				body
+			)
+			await writer.drain()
+		except (asyncio.TimeoutError, OSError):
+			pass
+		finally:
+			writer.close()
+
+
+def _labels(labels):
+	if not labels:
+		return ""
+	return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels) + "}"
+
+
+def _escape(value):
+	return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+# the one set of metrics for the whole bot
+metrics = Metrics()
@@ -0,0 +1,236 @@
+import os
+import time
+import logging
+import asyncio
+
+from ec2_utils import get_ec2_statuses
+from rcon_utils import Priority, ServerProbe, probe_server
+from snapshot_utils import server_snapshot, record_presence, EC2_DOWN_STATES
+from fleet_utils import SERVERS
+from start_utils import get_start
+from stop_utils import get_stop, start_stop, resume_stops
+from feed_utils import PLAYER_FEED_CHANNEL, PLAYER_FEED_POLLING_RATE
+from state_utils import state_store, to_monotonic, to_wall_clock
+
+log = logging.getLogger("bot")
+
+# How often to look at a running server, in minutes. Servers with nobody on are
+# also checked right at their inactivity deadline, so this no longer decides
+# how late a shutdown can be.
+INACTIVITY_POLLING_RATE = float(os.getenv('INACTIVITY_POLLING_RATE', '5'))
+
+# How often to look at a stopped server, in minutes. Starting it through the bot
+# wakes the monitor anyway, so this only catches starts from outside the bot.
+INACTIVITY_STOPPED_POLLING_RATE = float(os.getenv('INACTIVITY_STOPPED_POLLING_RATE', '60'))
+
+# How often to look at a server that's between states (pending, stopping), in seconds
+INACTIVITY_TRANSITION_POLLING_RATE = 30
+
+# Never sleep less than this between checks, in seconds
+INACTIVITY_MIN_SLEEP = 1
+
+
+# Watches every server and stops the ones that have had nobody on for longer
+# than their inactivity timeout.
+# Each server has its own next check time: rarely while stopped, every
+# INACTIVITY_POLLING_RATE while running, and exactly at the deadline when
+# empty. Commands that start or stop a server call wake() so the monitor picks
+# up the change straight away instead of at its next scheduled check.
+class InactivityMonitor:
+
+	def __init__(self, servers):
+		now = time.monotonic()
+		self.servers = servers
+		# server name -> monotonic time somebody was last seen (or the server
+		# was last seen not running)
+		self.last_active = {name: now for name in servers}
+		# server name -> monotonic time of the next check
+		self.next_check = {name: now for name in servers}
+		# server name -> last known EC2 state, to pick the cheapest probe
+		self.ec2_statuses = {}
+		# optional async function called with (server, StopState) as stops
+		# started by the monitor progress
+		self.on_stop_state = None
+		self._wake = None
+		self._following = set()
+
+	# When a server will be stopped if nobody turns up
+	def deadline(self, server):
+		return self.last_active[server.name] + server.inactivity_timeout * 60
+
+	# Check a server (or every server) as soon as possible.
+	# touch also counts the server as active just now, for when the monitor
+	# can't see the start or stop that prompted the wake (see worker_utils.py).
+	def wake(self, server=None, touch=False):
+		now = time.monotonic()
+		for name in ([server.name] if server is not None else self.servers):
+			self.next_check[name] = now
+			if touch:
+				self.last_active[name] = now
+		if touch:
+			self._save()
+		if self._wake is not None:
+			self._wake.set()
+
+	# Pick up the idle clocks from before a restart, so restarting doesn't give
+	# an empty server another full inactivity timeout
+	def restore(self):
+		saved, saved_at = state_store.load("monitor")
+		if not saved:
+			return
+		for name, last_active in saved["last_active"].items():
+			if name in self.last_active:
+				self.last_active[name] = to_monotonic(last_active)
+		self.ec2_statuses.update(saved["ec2_statuses"])
+		log.info(f"InactivityMonitor: restored state saved {time.time() - saved_at:.0f}s ago")
+
+	def _save(self):
+		state_store.save("monitor", {
+			'last_active': {name: to_wall_clock(last_active) for name, last_active in self.last_active.items()},
+			'ec2_statuses': self.ec2_statuses
+		})
+
+	# Finish any stops that a restart interrupted, if they still need finishing
+	async def resume_stops(self):
+		for pipeline in await resume_stops(self._stop_state_changed):
+			self._follow(pipeline.server, pipeline)
+
+	async def run(self):
+		self.restore()
+		asyncio.ensure_future(self.resume_stops())
+		self._wake = asyncio.Event()
+		while True:
+			now = time.monotonic()
+			due = [server for name, server in self.servers.items() if self.next_check[name] <= now]
+			if due:
+				try:
+					await self._check(due)
+				except Exception:
+					log.exception("InactivityMonitor: check failed")
+					for server in due:
+						self._schedule(server, 60 * INACTIVITY_POLLING_RATE)
+			sleep = max(min(self.next_check.values()) - time.monotonic(), INACTIVITY_MIN_SLEEP)
+			self._wake.clear()
+			try:
+				await asyncio.wait_for(self._wake.wait(), sleep)
+			except asyncio.TimeoutError:
+				pass
+
+	def _schedule(self, server, delay):
+		self.next_check[server.name] = time.monotonic() + delay
+
+	# How long until a running server is looked at again
+	def _running_delay(self, delay):
+		# keep the join/leave feed reasonably current
+		if PLAYER_FEED_CHANNEL:
+			return min(delay, PLAYER_FEED_POLLING_RATE)
+		return delay
+
+	async def _check(self, servers):
+		results = await self._probe(servers)
+		now = time.monotonic()
+		for server in servers:
+			ec2_status, online, players, busy = results[server.name]
+			name = server.name
+			# started since the last check, somewhere the monitor didn't hear
+			# about (e.g. the AWS console), so its idle clock starts now
+			if ec2_status == "running" and self.ec2_statuses.get(name) != "running":
+				self.last_active[name] = now
+			self.ec2_statuses[name] = ec2_status
+			if ec2_status == "running" or ec2_status in EC2_DOWN_STATES:
+				server.rcon.set_machine_running(ec2_status == "running")
+			in_progress = get_start(server) or get_stop(server)
+			if in_progress is not None:
+				# whatever started or stopped it will wake us when it's done
+				self.last_active[name] = now
+				self._follow(server, in_progress)
+				self._schedule(server, 60 * INACTIVITY_POLLING_RATE)
+			elif ec2_status != "running":
+				self.last_active[name] = now
+				log.info(f"InactivityMonitor: {server.name} not running ({ec2_status}).")
+				if ec2_status in ("stopped", "terminated"):
+					self._schedule(server, 60 * INACTIVITY_STOPPED_POLLING_RATE)
+				else:
+					self._schedule(server, INACTIVITY_TRANSITION_POLLING_RATE)
+			elif busy:
+				# our queue for it is full, so we can't tell who's on; don't
+				# count that as nobody
+				log.info(f"InactivityMonitor: {server.name} too busy to ask, checking again soon")
+				self._schedule(server, INACTIVITY_TRANSITION_POLLING_RATE)
+			elif online and players is not None and players.count > 0:
+				self.last_active[name] = now
+				log.info(f"InactivityMonitor: {server.name} is active")
+				self._schedule(server, self._running_delay(60 * INACTIVITY_POLLING_RATE))
+			else:
+				remaining = self.deadline(server) - now
+				log.info(f"InactivityMonitor: {server.name} inactivity detected ({server.inactivity_timeout * 60 - remaining:.0f}s, stopping in {max(remaining, 0):.0f}s)")
+				if remaining > 0:
+					# look again at the deadline itself (or sooner, to notice
+					# anyone who comes and goes in the meantime)
+					self._schedule(server, self._running_delay(min(remaining, 60 * INACTIVITY_POLLING_RATE)))
+				else:
+					log.info(f"InactivityMonitor: {server.name} TIMEOUT EXCEEDED")
+					self.last_active[name] = now
+					# runs in the background, so it doesn't hold up the other servers
+					self._follow(server, start_stop(server, online, self._stop_state_changed))
+					self._schedule(server, 60 * INACTIVITY_POLLING_RATE)
+		self._save()
+
+	# Find out (ec2 status, rcon status, players, busy) for some servers as cheaply as
+	# possible: reuse a fresh snapshot if a command just fetched one, ask
+	# servers believed to be running for their player list alone (an answer
+	# means EC2 is running too), and only ask EC2 about the rest, in one call.
+	async def _probe(self, servers):
+		results = {}
+		snapshots = server_snapshot.latest or {}
+		unknown = []
+		for server in servers:
+			snapshot = snapshots.get(server.name)
+			if snapshot is not None and snapshot.age <= server_snapshot.ttl:
+				results[server.name] = (snapshot.ec2_status, snapshot.rcon_status, snapshot.players, snapshot.busy)
+			else:
+				unknown.append(server)
+
+		believed_running = [server for server in unknown if self.ec2_statuses.get(server.name) == "running"]
+		probes = await asyncio.gather(*[
+			probe_server(server.rcon, daytime=False, priority=Priority.BACKGROUND) for server in believed_running
+		])
+		for server, probe in zip(believed_running, probes):
+			if probe.online or probe.busy:
+				record_presence(server, probe, "running")
+				results[server.name] = ("running", probe.online, probe.players, probe.busy)
+				unknown.remove(server)
+
+		if unknown:
+			ec2_statuses = await get_ec2_statuses([server.instance_id for server in unknown])
+			for server in unknown:
+				ec2_status = ec2_statuses.get(server.instance_id, "unknown")
+				if ec2_status == "running" and server not in believed_running:
+					probe = await probe_server(server.rcon, daytime=False, priority=Priority.BACKGROUND)
+				else:
+					probe = ServerProbe(False)
+				record_presence(server, probe, ec2_status)
+				results[server.name] = (ec2_status, probe.online, probe.players, probe.busy)
+		return results
+
+	async def _stop_state_changed(self, pipeline, state):
+		if self.on_stop_state is not None:
+			await self.on_stop_state(pipeline.server, state)
+
+	# Check a server again once its start or stop has finished
+	def _follow(self, server, job):
+		if server.name in self._following:
+			return
+		self._following.add(server.name)
+
+		async def follow():
+			try:
+				await job.wait()
+			finally:
+				self._following.discard(server.name)
+				self.wake(server)
+		asyncio.ensure_future(follow())
+
+
+# the one monitor for the whole fleet, started by the bot once it's connected
+inactivity_monitor = InactivityMonitor(SERVERS)
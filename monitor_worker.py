@@ -0,0 +1,26 @@
+# Runs the inactivity monitor in its own process, with its own AWS and RCON
+# connections. The bot starts this itself when MONITOR_WORKER is "spawn" (the
+# default); with MONITOR_WORKER="external", run it yourself alongside the bot:
+#   python3 monitor_worker.py
+# See worker_utils.py for how the two talk to each other.
+import asyncio
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from log_utils import setup_logging
+log = setup_logging("monitor.log")
+
+from monitor_utils import inactivity_monitor
+from worker_utils import MonitorWorker
+from state_utils import state_store
+
+
+async def main():
+	# keep the stops this process runs apart from the bot's own
+	state_store.scope = "monitor"
+	await MonitorWorker(inactivity_monitor).run()
+
+
+if __name__ == '__main__':
+	asyncio.run(main())
@@ -0,0 +1,225 @@
+import os
+import time
+import struct
+import sqlite3
+import logging
+import asyncio
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger("bot")
+
+# Where to keep player presence history: a SQLite database of hourly and daily
+# rollups, plus one append-only binary file of raw samples per server
+PRESENCE_DIR = os.getenv('PRESENCE_DIR', 'logs/presence')
+
+# How often buffered samples are written to disk, in seconds
+PRESENCE_FLUSH_INTERVAL = float(os.getenv('PRESENCE_FLUSH_INTERVAL', '60'))
+
+# Samples closer together than this (with the same players) add nothing, in seconds
+PRESENCE_MIN_INTERVAL = 30
+
+# The longest gap between two samples that still counts as the players having
+# been online the whole time, in seconds. Longer gaps (the bot was down, or
+# nobody was looking) only credit this much.
+PRESENCE_MAX_GAP = 15 * 60
+
+# One raw sample: unix time (uint32) and player count (uint16)
+RAW_SAMPLE = struct.Struct("<IH")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS rollup (
+	server     TEXT NOT NULL,
+	-- 'hour' or 'day'
+	period     TEXT NOT NULL,
+	-- unix time // 3600 or // 86400 (UTC)
+	bucket     INTEGER NOT NULL,
+	peak       INTEGER NOT NULL,
+	samples    INTEGER NOT NULL,
+	player_sum INTEGER NOT NULL,
+	PRIMARY KEY (server, period, bucket)
+);
+CREATE TABLE IF NOT EXISTS player_rollup (
+	server     TEXT NOT NULL,
+	player     TEXT NOT NULL,
+	period     TEXT NOT NULL,
+	bucket     INTEGER NOT NULL,
+	seconds    REAL NOT NULL,
+	PRIMARY KEY (server, player, period, bucket)
+);
+"""
+
+PERIODS = {'hour': 3600, 'day': 86400}
+
+
+# Collects player counts as the bot sees them, and keeps them as hourly/daily
+# rollups so that questions about the last week or year only ever read a few
+# hundred rows.
+# Recording is cheap and happens on the event loop: samples go into in-memory
+# arrays and rollup deltas, which a background task writes out every
+# PRESENCE_FLUSH_INTERVAL seconds on its own thread.
+class PresenceStore:
+
+	def __init__(self, directory=PRESENCE_DIR):
+		self.directory = directory
+		self._db = None
+		# SQLite connections belong to the thread that made them, so all disk
+		# access happens on this one thread
+		self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="presence")
+		# server name -> (array of unix times, array of counts) not yet on disk
+		self._raw = {}
+		# (server, period, bucket) -> [peak, samples, player_sum] not yet on disk
+		self._rollups = {}
+		# (server, player, period, bucket) -> seconds not yet on disk
+		self._player_rollups = {}
+		# server name -> (unix time, frozenset of names) of the latest sample
+		self._last = {}
+		# function taking (server name, players, unix time) that gets the
+		# samples instead, e.g. to pass them from the worker process to the
+		# bot, so that only one process ever writes the history
+		self.on_sample = None
+
+	# Note how many players (and who) a server had just now.
+	# players is a PlayerList, or None if the server isn't running.
+	def record(self, server_name, players, now=None):
+		now = int(now if now is not None else time.time())
+		if self.on_sample is not None:
+			self.on_sample(server_name, players, now)
+			return
+		names = players.names if players is not None else frozenset()
+		count = players.count if players is not None else 0
+		last = self._last.get(server_name)
+		# samples from the worker can arrive after newer ones from the bot
+		if last is not None and now < last[0]:
+			return
+		if last is not None and now - last[0] < PRESENCE_MIN_INTERVAL and last[1] == names:
+			return
+
+		times, counts = self._raw.setdefault(server_name, (array('I'), array('H')))
+		times.append(now)
+		counts.append(min(count, 0xFFFF))
+
+		for period, length in PERIODS.items():
+			rollup = self._rollups.setdefault((server_name, period, now // length), [0, 0, 0])
+			rollup[0] = max(rollup[0], count)
+			rollup[1] += 1
+			rollup[2] += count
+
+		# everyone in the previous sample has been on since then (as far as
+		# we know), so credit them with the time in between
+		if last is not None:
+			seconds = min(now - last[0], PRESENCE_MAX_GAP)
+			for name in last[1]:
+				for period, length in PERIODS.items():
+					key = (server_name, name, period, last[0] // length)
+					self._player_rollups[key] = self._player_rollups.get(key, 0) + seconds
+		self._last[server_name] = (now, names)
+
+	# Write everything recorded so far to disk
+	async def flush(self):
+		raw, self._raw = self._raw, {}
+		rollups, self._rollups = self._rollups, {}
+		player_rollups, self._player_rollups = self._player_rollups, {}
+		if not (raw or rollups or player_rollups):
+			return
+		loop = asyncio.get_running_loop()
+		await loop.run_in_executor(self._executor, self._write, raw, rollups, player_rollups)
+
+	# Flush every PRESENCE_FLUSH_INTERVAL seconds, forever
+	async def run(self):
+		while True:
+			await asyncio.sleep(PRESENCE_FLUSH_INTERVAL)
+			try:
+				await self.flush()
+			except (OSError, sqlite3.Error):
+				log.exception("PresenceStore: flush failed, samples since the last flush are lost")
+
+	# Peak player count, average player count and total samples for a server
+	# since the given unix time, from the daily rollups
+	async def summary(self, server_name, since):
+		await self.flush()
+		return await self._query(
+			"SELECT MAX(peak), SUM(player_sum), SUM(samples) FROM rollup "
+			"WHERE server = ? AND period = 'day' AND bucket >= ?",
+			(server_name, int(since) // PERIODS['day'])
+		)
+
+	# The hour with the most players since the given unix time, as
+	# [(hour bucket, peak)], or [] if there's no history
+	async def busiest_hour(self, server_name, since):
+		await self.flush()
+		return await self._query(
+			"SELECT bucket, peak FROM rollup "
+			"WHERE server = ? AND period = 'hour' AND bucket >= ? "
+			"ORDER BY peak DESC, bucket DESC LIMIT 1",
+			(server_name, int(since) // PERIODS['hour'])
+		)
+
+	# [(player, seconds online)] since the given unix time, most online first
+	async def time_online(self, server_name, since, limit=10):
+		await self.flush()
+		return await self._query(
+			"SELECT player, SUM(seconds) AS total FROM player_rollup "
+			"WHERE server = ? AND period = 'day' AND bucket >= ? "
+			"GROUP BY player ORDER BY total DESC LIMIT ?",
+			(server_name, int(since) // PERIODS['day'], limit)
+		)
+
+	# Every raw (unix time, player count) sample for a server since the given
+	# unix time, oldest first
+	async def samples(self, server_name, since=0):
+		await self.flush()
+		loop = asyncio.get_running_loop()
+		return await loop.run_in_executor(self._executor, read_samples, self.directory, server_name, since)
+
+	async def _query(self, sql, params):
+		loop = asyncio.get_running_loop()
+		return await loop.run_in_executor(self._executor, self._fetch, sql, params)
+
+	def _connect(self):
+		if self._db is None:
+			os.makedirs(self.directory, exist_ok=True)
+			self._db = sqlite3.connect(os.path.join(self.directory, "presence.db"))
+			self._db.executescript(SCHEMA)
+		return self._db
+
+	def _fetch(self, sql, params):
+		return self._connect().execute(sql, params).fetchall()
+
+	def _write(self, raw, rollups, player_rollups):
+		db = self._connect()
+		with db:
+			db.executemany(
+				"INSERT INTO rollup VALUES (?, ?, ?, ?, ?, ?) "
+				"ON CONFLICT (server, period, bucket) DO UPDATE SET "
+				"peak = MAX(peak, excluded.peak), "
+				"samples = samples + excluded.samples, "
+				"player_sum = player_sum + excluded.player_sum",
+				[key + tuple(value) for key, value in rollups.items()]
+			)
+			db.executemany(
+				"INSERT INTO player_rollup VALUES (?, ?, ?, ?, ?) "
+				"ON CONFLICT (server, player, period, bucket) DO UPDATE SET "
+				"seconds = seconds + excluded.seconds",
+				[key + (value,) for key, value in player_rollups.items()]
+			)
+		for server_name, (times, counts) in raw.items():
+			with open(os.path.join(self.directory, f"{server_name}.bin"), "ab") as f:
+				f.write(b"".join(RAW_SAMPLE.pack(t, c) for t, c in zip(times, counts)))
+
+
+# Raw samples straight from a server's file, for when there's no PresenceStore
+# running (e.g. offline analysis)
+def read_samples(directory, server_name, since=0):
+	try:
+		with open(os.path.join(directory, f"{server_name}.bin"), "rb") as f:
+			data = f.read()
+	except FileNotFoundError:
+		return []
+	# a torn write at the end is ignored
+	data = data[:len(data) - len(data) % RAW_SAMPLE.size]
+	return [sample for sample in RAW_SAMPLE.iter_unpack(data) if sample[0] >= since]
+
+
+# the one presence store for the whole fleet
+presence_store = PresenceStore()
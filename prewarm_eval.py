@@ -0,0 +1,117 @@
+# Offline evaluation of the pre-warm predictor (see prewarm_utils.py).
+#
+# Replays the recorded player history and start history of a server day by
+# day: at every step the scheduler's decision is made from the history before
+# that moment only, and compared with when people actually turned up. Reports,
+# for a range of thresholds, how many arrivals a pre-warm would have covered,
+# how much waiting that saves, and how many hours pre-warms would have cost.
+#
+# Reads the same files the bot writes (PRESENCE_DIR, START_HISTORY_FILE), so
+# run it next to the bot, e.g.
+#   python3 prewarm_eval.py --server main --days 28
+import sys
+import time
+import bisect
+import argparse
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from fleet_utils import get_server, DEFAULT_SERVER
+from presence_utils import read_samples, PRESENCE_DIR
+from start_utils import load_start_records, expected_start_time
+from prewarm_utils import (
+	DemandModel, DAY, WEEK, DEMAND_HISTORY_DAYS, PREWARM_BUDGET_HOURS, PREWARM_CHECK_INTERVAL,
+	PREWARM_COOLDOWN, PREWARM_DEFAULT_START_TIME, PREWARM_MARGIN, PREWARM_THRESHOLD, PREWARM_WINDOW
+)
+
+
+# Run the scheduler over [start, end) at one threshold.
+# A pre-warm at time t has the server playable at t + lead, and running until
+# the inactivity timeout after that if nobody comes. Anyone who turns up in
+# that time is covered and waits only for whatever is left of the start.
+def simulate(model, start, end, threshold, budget_hours, start_time, timeout, step):
+	lead = start_time + PREWARM_MARGIN
+	arrivals = [at for at in model.arrivals if start <= at < end]
+	prewarms = []
+	covered = {}
+	idle_hours = 0.0
+	t = start
+	while t < end:
+		spent = sum(hours for at, hours in prewarms if t - at < WEEK)
+		cost = (lead + timeout) / 3600
+		if (
+			(not prewarms or t - prewarms[-1][0] >= PREWARM_COOLDOWN) and
+			spent + cost <= budget_hours and
+			model.probability(t + lead, t + lead + PREWARM_WINDOW) >= threshold
+		):
+			prewarms.append((t, cost))
+			i = bisect.bisect_left(arrivals, t)
+			if i < len(arrivals) and arrivals[i] < t + lead + timeout:
+				covered[arrivals[i]] = max(t + lead - arrivals[i], 0)
+				idle_hours += max(arrivals[i] - t - lead, 0) / 3600
+			else:
+				idle_hours += timeout / 3600
+		t += step
+	hits = len(covered)
+	return {
+		'threshold': threshold,
+		'prewarms': len(prewarms),
+		'hits': hits,
+		'arrivals': len(arrivals),
+		'saved_minutes': sum(start_time - wait for wait in covered.values()) / 60,
+		'idle_hours': idle_hours,
+	}
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Evaluate the pre-warm predictor against recorded history")
+	parser.add_argument("--server", default=None, help="server to evaluate (default: the first one)")
+	parser.add_argument("--days", type=int, default=28, help="how many of the most recent days to replay")
+	parser.add_argument("--thresholds", default=None, help="comma separated thresholds to try (default: a sweep around PREWARM_THRESHOLD)")
+	parser.add_argument("--budget", type=float, default=PREWARM_BUDGET_HOURS, help="weekly budget in hours")
+	parser.add_argument("--step", type=float, default=PREWARM_CHECK_INTERVAL, help="seconds between scheduler checks")
+	args = parser.parse_args()
+
+	server = get_server(args.server) if args.server else DEFAULT_SERVER
+	if server is None:
+		sys.exit(f"No server called {args.server}")
+	samples = read_samples(PRESENCE_DIR, server.name)
+	records = load_start_records(server)
+	model = DemandModel.from_history(samples, records)
+	if not model.arrivals:
+		sys.exit(f"No recorded history for {server.name} yet")
+
+	end = time.time()
+	start = max(end - args.days * DAY, model.since)
+	start_time = expected_start_time(server) or PREWARM_DEFAULT_START_TIME
+	timeout = server.inactivity_timeout * 60
+	if args.thresholds:
+		thresholds = [float(threshold) for threshold in args.thresholds.split(",")]
+	else:
+		thresholds = sorted({0.3, 0.4, 0.5, 0.6, 0.7, 0.8, PREWARM_THRESHOLD})
+
+	print(
+		f"{server.name}: {(end - model.since) / DAY:.0f} days of history, replaying the last " +
+		f"{(end - start) / DAY:.0f} (the model looks back up to {DEMAND_HISTORY_DAYS} days)"
+	)
+	print(f"start takes {start_time:.0f}s, inactivity timeout {timeout / 60:.0f} minutes, budget {args.budget:g} hours/week")
+	print()
+	print(f"{'threshold':>9} {'prewarms':>8} {'useful':>7} {'covered':>12} {'saved min':>9} {'idle h/wk':>9}")
+	weeks = max((end - start) / WEEK, 1 / 7)
+	for threshold in thresholds:
+		result = simulate(model, start, end, threshold, args.budget, start_time, timeout, args.step)
+		useful = result['hits'] / result['prewarms'] if result['prewarms'] else 0
+		covered = f"{result['hits']}/{result['arrivals']}"
+		print(
+			f"{threshold:>9.2f} {result['prewarms']:>8} {useful:>7.0%} {covered:>12} " +
+			f"{result['saved_minutes']:>9.0f} {result['idle_hours'] / weeks:>9.1f}"
+		)
+	print()
+	print("useful: pre-warms someone turned up for; covered: arrivals that found the server starting or ready;")
+	print("saved min: waiting avoided in total; idle h/wk: running time nobody was on for, per week")
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,214 @@
+import os
+import time
+import bisect
+import logging
+import asyncio
+
+from presence_utils import presence_store
+from start_utils import load_start_records, expected_start_time, get_start, start_server
+from stop_utils import is_stopping
+from snapshot_utils import server_snapshot
+from fleet_utils import get_server
+from state_utils import state_store
+
+log = logging.getLogger("bot")
+
+# Servers to start ahead of when people usually turn up, by name, separated by
+# commas. Leave blank to turn pre-warming off.
+PREWARM_SERVERS = os.getenv('PREWARM_SERVERS', '')
+
+# Only pre-warm when at least this share of comparable past days (see
+# DemandModel) had someone turn up around that time
+PREWARM_THRESHOLD = float(os.getenv('PREWARM_THRESHOLD', '0.5'))
+
+# Most hours of running per week that pre-warming may cost. Each pre-warm is
+# charged as if nobody came: the start time plus the inactivity timeout.
+PREWARM_BUDGET_HOURS = float(os.getenv('PREWARM_BUDGET_HOURS', '5'))
+
+# Aim to be playable this long before people are expected, in seconds
+PREWARM_MARGIN = 120
+
+# How long after the server is playable to look for people turning up, in seconds
+PREWARM_WINDOW = 30 * 60
+
+# Don't pre-warm the same server again within this long, in seconds (e.g. after
+# an admin stopped the last pre-warm)
+PREWARM_COOLDOWN = 3 * 3600
+
+# How long a start is assumed to take until there's start history, in seconds
+PREWARM_DEFAULT_START_TIME = 120
+
+# How often the scheduler looks ahead, and how often it re-reads the history
+# it predicts from, in seconds
+PREWARM_CHECK_INTERVAL = 60
+PREWARM_MODEL_TTL = 3600
+
+# A sample with players after at least this long with nobody on counts as
+# someone turning up, in seconds
+ARRIVAL_GAP = 30 * 60
+
+# How many past days the demand model looks at, how much a day that isn't the
+# same day of the week counts for (the same weekday counts 1), and how quickly
+# older days stop mattering (each one counts half as much as one this many days
+# more recent)
+DEMAND_HISTORY_DAYS = 56
+DEMAND_OTHER_DAY_WEIGHT = 0.3
+DEMAND_HALF_LIFE_DAYS = 28
+
+# Don't predict anything with less history than this, in days
+DEMAND_MIN_DAYS = 7
+
+DAY = 86400
+WEEK = 7 * DAY
+
+
+# When people turned up at a server, as sorted unix times: a sample with players
+# after a quiet spell, or a start someone asked for (pre-warms don't count, or
+# the model would end up predicting itself)
+def find_arrivals(samples, start_records):
+	times = []
+	last_busy = None
+	for at, count in samples:
+		if count > 0:
+			if last_busy is None or at - last_busy >= ARRIVAL_GAP:
+				times.append(at)
+			last_busy = at
+	times += [record.started_at for record in start_records if record.trigger != "prewarm"]
+	times.sort()
+	# a start and the players that follow it are the same arrival
+	arrivals = []
+	for at in times:
+		if not arrivals or at - arrivals[-1] >= ARRIVAL_GAP:
+			arrivals.append(at)
+	return arrivals
+
+
+# Predicts whether someone will turn up in a stretch of time from whether they
+# did in the same stretch on past days. The same day of the week counts most,
+# other days less (so a daily habit still shows up with little history), and
+# recent days more than old ones.
+# Only looks at whole days back, so it never sees anything after the time it's
+# asked about; the offline evaluation relies on that.
+class DemandModel:
+
+	def __init__(self, arrivals, since):
+		self.arrivals = arrivals
+		# unix time history starts at
+		self.since = since
+
+	@classmethod
+	def from_history(cls, samples, start_records):
+		firsts = [samples[0][0]] if samples else []
+		if start_records:
+			firsts.append(start_records[0].started_at)
+		return cls(find_arrivals(samples, start_records), min(firsts, default=time.time()))
+
+	# Chance (0-1) of someone turning up between the given unix times
+	def probability(self, start, end):
+		hits = 0.0
+		total = 0.0
+		days_seen = 0
+		for days in range(1, DEMAND_HISTORY_DAYS + 1):
+			offset = days * DAY
+			if start - offset < self.since:
+				break
+			weight = (1.0 if days % 7 == 0 else DEMAND_OTHER_DAY_WEIGHT) * 0.5 ** (days / DEMAND_HALF_LIFE_DAYS)
+			i = bisect.bisect_left(self.arrivals, start - offset)
+			if i < len(self.arrivals) and self.arrivals[i] < end - offset:
+				hits += weight
+			total += weight
+			days_seen += 1
+		if days_seen < DEMAND_MIN_DAYS:
+			return 0.0
+		return hits / total
+
+
+# Starts servers shortly before people usually turn up, so they don't have to
+# wait through the boot. Pre-warmed servers are left to the inactivity monitor,
+# which stops them as usual if nobody comes.
+class PrewarmScheduler:
+
+	def __init__(self, server_names=PREWARM_SERVERS):
+		self.servers = []
+		for name in filter(None, (name.strip() for name in server_names.split(","))):
+			server = get_server(name)
+			if server is None:
+				log.error(f"PrewarmScheduler: no server called {name}, not pre-warming it")
+			else:
+				self.servers.append(server)
+		# optional function called with (server, probability) after a pre-warm
+		# has been started
+		self.on_prewarm = None
+		# [server name, unix time, hours charged] for each recent pre-warm
+		self.history = []
+		# server name -> (monotonic time built, DemandModel, expected start time)
+		self._models = {}
+
+	@property
+	def enabled(self):
+		return bool(self.servers)
+
+	# Hours of the budget used over the past week
+	def spent(self, now=None):
+		now = now if now is not None else time.time()
+		return sum(hours for _, at, hours in self.history if now - at < WEEK)
+
+	async def run(self):
+		saved, _ = state_store.load("prewarm")
+		self.history = saved or []
+		log.info(
+			f"PrewarmScheduler: pre-warming {', '.join(server.name for server in self.servers)} " +
+			f"({self.spent():.1f} of {PREWARM_BUDGET_HOURS:g} hours used this week)"
+		)
+		while True:
+			for server in self.servers:
+				try:
+					await self._consider(server)
+				except Exception:
+					log.exception(f"PrewarmScheduler: {server.name}: check failed")
+			await asyncio.sleep(PREWARM_CHECK_INTERVAL)
+
+	async def _model(self, server):
+		built_at, model, start_time = self._models.get(server.name, (None, None, None))
+		if built_at is None or time.monotonic() - built_at > PREWARM_MODEL_TTL:
+			since = time.time() - DEMAND_HISTORY_DAYS * DAY - DAY
+			samples = await presence_store.samples(server.name, since)
+			records = [record for record in load_start_records(server) if record.started_at >= since]
+			model = DemandModel.from_history(samples, records)
+			start_time = expected_start_time(server) or PREWARM_DEFAULT_START_TIME
+			self._models[server.name] = (time.monotonic(), model, start_time)
+		return model, start_time
+
+	async def _consider(self, server):
+		now = time.time()
+		model, start_time = await self._model(server)
+		lead = start_time + PREWARM_MARGIN
+		probability = model.probability(now + lead, now + lead + PREWARM_WINDOW)
+		if probability < PREWARM_THRESHOLD:
+			return
+		last = max((at for name, at, _ in self.history if name == server.name), default=None)
+		if last is not None and now - last < PREWARM_COOLDOWN:
+			return
+		cost = (lead + server.inactivity_timeout * 60) / 3600
+		if self.spent(now) + cost > PREWARM_BUDGET_HOURS:
+			log.debug(f"PrewarmScheduler: {server.name}: would pre-warm, but the weekly budget is used up")
+			return
+		if get_start(server) is not None or is_stopping(server):
+			return
+		snapshot = await server_snapshot.get(server)
+		if snapshot.ec2_status != "stopped":
+			return
+
+		log.info(
+			f"PrewarmScheduler: {server.name}: {probability:.0%} chance of players in the next " +
+			f"{(lead + PREWARM_WINDOW) / 60:.0f} minutes, starting"
+		)
+		self.history = [entry for entry in self.history if now - entry[1] < WEEK] + [[server.name, now, cost]]
+		state_store.save("prewarm", self.history)
+		await start_server(server, trigger="prewarm")
+		if self.on_prewarm is not None:
+			self.on_prewarm(server, probability)
+
+
+# the scheduler for the servers in PREWARM_SERVERS
+prewarm_scheduler = PrewarmScheduler()
@@ -1,41 +1,852 @@
 import os
+import re
+import time
 import logging
-import socket
-from mcrcon import MCRcon
+import asyncio
+import heapq
+import struct
+import itertools
+from enum import Enum, IntEnum
+from collections import deque
+from dataclasses import dataclass
+from typing import NamedTuple, Optional
+
+from metrics_utils import metrics
 
 log = logging.getLogger("bot")
 
 # get RCON credentials
 RCON_URL      = os.getenv('RCON_URL')
 RCON_PASSWORD = os.getenv('RCON_PASSWORD')
+RCON_PORT     = int(os.getenv('RCON_PORT', '25575'))
+
+# how long to wait for the server to answer a single command, in seconds
+RCON_TIMEOUT  = float(os.getenv('RCON_TIMEOUT', '3'))
+
+# RCON packet types
+# https://wiki.vg/RCON
+PACKET_RESPONSE = 0
+PACKET_COMMAND  = 2
+PACKET_LOGIN    = 3
+# Any type the server doesn't know. It answers with an "Unknown request"
+# packet of its own, after the response to everything sent before it.
+PACKET_SENTINEL = 100
+
+# Minecraft splits long responses into several packets of this many bytes
+RESPONSE_FRAGMENT_SIZE = 4096
+
+# Command that reports tick rate, since it differs between server software:
+# "tick query" on vanilla 1.20.3+, "tps" on Paper/Spigot, "forge tps" on Forge.
+# Leave blank to not ask.
+RCON_TPS_COMMAND = os.getenv('RCON_TPS_COMMAND', '')
+
+# Command that reports milliseconds per tick, if the TPS command doesn't:
+# "mspt" on Paper. ("tick query" and "forge tps" report both.)
+RCON_MSPT_COMMAND = os.getenv('RCON_MSPT_COMMAND', '')
+
+# How often the tick sampler asks a server how it's keeping up, in seconds, and
+# how many samples it keeps
+TICK_SAMPLE_INTERVAL = float(os.getenv('TICK_SAMPLE_INTERVAL', '30'))
+TICK_HISTORY = 120
+
+# A tick taking longer than this many milliseconds puts the server behind
+# (20 ticks a second leaves 50ms each)
+TICK_MSPT_BUDGET = float(os.getenv('TICK_MSPT_BUDGET', '50'))
+
+# Raise a lag alert after this many samples in a row over budget, and at most
+# one alert per server every TICK_ALERT_INTERVAL seconds
+TICK_ALERT_AFTER = int(os.getenv('TICK_ALERT_AFTER', '3'))
+TICK_ALERT_INTERVAL = float(os.getenv('TICK_ALERT_INTERVAL', '900'))
+
+# After this many failed commands in a row, stop sending commands to the server
+# and let a background probe find out when it's back
+RCON_BREAKER_THRESHOLD = int(os.getenv('RCON_BREAKER_THRESHOLD', '2'))
+
+# How long the background probe waits before its first try, in seconds. It
+# doubles after each failed try, up to the max.
+RCON_BREAKER_RETRY     = float(os.getenv('RCON_BREAKER_RETRY', '5'))
+RCON_BREAKER_RETRY_MAX = float(os.getenv('RCON_BREAKER_RETRY_MAX', '60'))
+
+# How many exchanges can be waiting on one server's answers at once. Anything
+# more waits its turn, most important first.
+RCON_MAX_IN_FLIGHT = int(os.getenv('RCON_MAX_IN_FLIGHT', '4'))
+
+# How many requests can be waiting for a turn. Past this, the least important
+# request is turned away.
+RCON_MAX_QUEUED = int(os.getenv('RCON_MAX_QUEUED', '32'))
+
+# How long user and background requests wait for a turn before giving up, in
+# seconds. Shutdown and admin requests wait as long as it takes.
+RCON_QUEUE_DEADLINE = float(os.getenv('RCON_QUEUE_DEADLINE', '10'))
+
+
+class RconAuthError(Exception):
+	pass
+
+
+# raised straight away, without touching the network, while a server is known
+# to be unreachable
+class RconUnavailableError(ConnectionError):
+	pass
+
+
+# raised when a request gave up waiting for its turn
+class RconDeadlineError(asyncio.TimeoutError):
+	pass
+
+
+# raised when a request is turned away because too many are already waiting
+class RconBusyError(asyncio.TimeoutError):
+	pass
+
+
+# raised when a write fails on a connection that had already died
+class _StaleConnectionError(ConnectionResetError):
+	pass
+
+
+# Who's asking, most important first. Decides the order requests to a busy
+# server go out in.
+class Priority(IntEnum):
+	# stopping the server
+	SHUTDOWN   = 0
+	# admin commands, e.g. !rcon and !whitelist
+	ADMIN      = 1
+	# everyday commands, e.g. !status
+	USER       = 2
+	# polling nobody is waiting on, e.g. the inactivity monitor. Identical
+	# background requests share one exchange.
+	BACKGROUND = 3
+
+
+class BreakerState(Enum):
+	CLOSED    = "closed"
+	OPEN      = "open"
+	HALF_OPEN = "half-open"
+
+
+# Tracks whether a server is worth talking to.
+# Closed: commands go through as normal. Enough failures in a row open the
+# breaker, and then commands fail immediately instead of each waiting out the
+# timeout. While open, a single background probe tries the server now and then
+# (half-open while it's trying); the first success closes the breaker again.
+class CircuitBreaker:
+
+	def __init__(self, name, probe, threshold=RCON_BREAKER_THRESHOLD, retry=RCON_BREAKER_RETRY, retry_max=RCON_BREAKER_RETRY_MAX):
+		self.name = name
+		self.threshold = threshold
+		self.retry = retry
+		self.retry_max = retry_max
+		self.state = BreakerState.CLOSED
+		self.failures = 0
+		# wall clock time the breaker last opened, and monotonic time of the
+		# next background probe
+		self.opened_at = None
+		self.next_probe_at = None
+		# coroutine function returning whether the server answered
+		self._probe = probe
+		self._probe_task = None
+
+	def allow(self):
+		return self.state == BreakerState.CLOSED
+
+	# Seconds until the background probe next tries the server, if it's waiting
+	@property
+	def retry_in(self):
+		if self.state != BreakerState.OPEN or self.next_probe_at is None:
+			return None
+		return max(self.next_probe_at - time.monotonic(), 0)
+
+	def record_success(self):
+		self.failures = 0
+		if self.state != BreakerState.CLOSED:
+			log.info(f"CircuitBreaker: {self.name} answering again after {time.time() - self.opened_at:.0f}s, closing")
+			self.state = BreakerState.CLOSED
+			self.stop_probing()
+
+	def record_failure(self):
+		self.failures += 1
+		if self.state == BreakerState.CLOSED and self.failures >= self.threshold:
+			log.info(f"CircuitBreaker: {self.name} failed {self.failures} times in a row, opening")
+			self.state = BreakerState.OPEN
+			self.opened_at = time.time()
+			self._probe_task = asyncio.ensure_future(self._probe_loop())
+
+	def stop_probing(self):
+		if self._probe_task is not None and self._probe_task is not asyncio.current_task():
+			self._probe_task.cancel()
+		self._probe_task = None
+
+	# Stop probing a server that's known to be away (its machine is stopped),
+	# without closing the breaker
+	def pause(self):
+		self.stop_probing()
+		self.next_probe_at = None
+		if self.state == BreakerState.HALF_OPEN:
+			self.state = BreakerState.OPEN
+
+	# Start probing again after pause(), if the breaker is still open
+	def resume(self):
+		if self.state != BreakerState.CLOSED and self._probe_task is None:
+			self._probe_task = asyncio.ensure_future(self._probe_loop())
+
+	async def _probe_loop(self):
+		delay = self.retry
+		while True:
+			self.next_probe_at = time.monotonic() + delay
+			await asyncio.sleep(delay)
+			self.state = BreakerState.HALF_OPEN
+			if await self._probe():
+				self.record_success()
+				return
+			self.state = BreakerState.OPEN
+			delay = min(delay * 2, self.retry_max)
+
+
+# How well a server was keeping up at one moment.
+# Fields the server didn't report (or couldn't be parsed) are None.
+@dataclass(frozen=True)
+class TickSample:
+	# wall clock time
+	at: float
+	tps: Optional[float] = None
+	# milliseconds per tick
+	mspt: Optional[float] = None
+	entities: Optional[int] = None
+
+	@property
+	def over_budget(self):
+		return self.mspt is not None and self.mspt > TICK_MSPT_BUDGET
+
+
+# Samples a server's tick rate, tick time and entity count every
+# TICK_SAMPLE_INTERVAL, keeping the last TICK_HISTORY samples.
+# When tick time stays over TICK_MSPT_BUDGET for TICK_ALERT_AFTER samples in a
+# row, on_lag is called (at most once every TICK_ALERT_INTERVAL).
+# Samples are background requests, and skipped while the circuit breaker says
+# the server is away. Sampling stops altogether while paused, e.g. while the
+# server's machine isn't running.
+class TickSampler:
+
+	def __init__(self, client, interval=TICK_SAMPLE_INTERVAL):
+		self.client = client
+		self.interval = interval
+		self.samples = deque(maxlen=TICK_HISTORY)
+		# async function taking the TickSampler and the number of alerts held
+		# back since the last one
+		self.on_lag = None
+		self._last_alert = None
+		self._unreported = 0
+		self._task = None
+		self._resumed = None
+
+	# Whether there's anything to ask the server for
+	@property
+	def enabled(self):
+		return bool(RCON_TPS_COMMAND or RCON_MSPT_COMMAND)
+
+	# The latest sample, if it's recent enough to still mean something
+	@property
+	def latest(self):
+		if self.samples and time.time() - self.samples[-1].at <= 2 * self.interval:
+			return self.samples[-1]
+		return None
+
+	# The samples over budget at the end of the buffer, newest last
+	@property
+	def lagging(self):
+		run = []
+		for sample in reversed(self.samples):
+			if not sample.over_budget:
+				break
+			run.append(sample)
+		return run[::-1]
+
+	@property
+	def paused(self):
+		return self._resumed is not None and not self._resumed.is_set()
+
+	def start(self):
+		if self._task is None and self.enabled:
+			self._task = asyncio.ensure_future(self.run())
+
+	def pause(self):
+		if self._resumed is None:
+			self._resumed = asyncio.Event()
+		if not self.paused:
+			log.info(f"TickSampler: {self.client.host}:{self.client.port}: pausing")
+		self._resumed.clear()
+
+	def resume(self):
+		if self.paused:
+			log.info(f"TickSampler: {self.client.host}:{self.client.port}: resuming")
+			self._resumed.set()
+
+	async def run(self):
+		while True:
+			if self.paused:
+				await self._resumed.wait()
+			await asyncio.sleep(self.interval)
+			if self.paused:
+				continue
+			if not self.client.breaker.allow():
+				continue
+			try:
+				sample = await self.sample()
+			except (asyncio.TimeoutError, OSError) as e:
+				log.debug(f"TickSampler: {self.client.host}:{self.client.port}: no sample ({e!r})")
+				continue
+			self.samples.append(sample)
+			if sample.mspt is not None:
+				metrics.observe("minecraft_tick", sample.mspt / 1000, server=f"{self.client.host}:{self.client.port}")
+			if len(self.lagging) >= TICK_ALERT_AFTER:
+				await self._alert()
+
+	# Ask the server how it's keeping up, in one pipelined exchange
+	async def sample(self):
+		cmds = [cmd for cmd in (RCON_TPS_COMMAND, RCON_MSPT_COMMAND) if cmd]
+		# works on vanilla and everything built on it
+		cmds.append("execute if entity @e")
+		resps = await self.client.commands(cmds, priority=Priority.BACKGROUND)
+		tps = parse_tps(resps[0]) if RCON_TPS_COMMAND else None
+		mspt = next((parse_mspt(resp) for resp in resps[:-1] if parse_mspt(resp) is not None), None)
+		if tps is None and mspt:
+			tps = min(20.0, 1000 / mspt)
+		return TickSample(time.time(), tps, mspt, parse_entity_count(resps[-1]))
+
+	async def _alert(self):
+		now = time.monotonic()
+		if self._last_alert is not None and now - self._last_alert < TICK_ALERT_INTERVAL:
+			self._unreported += 1
+			return
+		self._last_alert = now
+		unreported, self._unreported = self._unreported, 0
+		lagging = self.lagging
+		log.warning(
+			f"TickSampler: {self.client.host}:{self.client.port}: over {TICK_MSPT_BUDGET:g}ms per tick for " +
+			f"{len(lagging)} samples, latest {lagging[-1].mspt:.1f}ms"
+		)
+		if self.on_lag is not None:
+			try:
+				await self.on_lag(self, unreported)
+			except Exception:
+				log.exception("TickSampler: reporting lag failed")
+
+
+# Asyncio RCON client that keeps one authenticated connection open.
+# Requests are tagged with their own ids, so any number of coroutines can share
+# the connection at once; a background reader task hands each response back to
+# whoever is waiting on that id. If the connection drops it is re-established
+# on the next command.
+# At most max_in_flight exchanges are outstanding at once; the rest queue up by
+# Priority, so a burst of commands waits its turn instead of piling onto the
+# server, and a stop doesn't wait behind background polls.
+class RconClient:
+
+	def __init__(self, host, password, port=RCON_PORT, timeout=RCON_TIMEOUT, max_in_flight=RCON_MAX_IN_FLIGHT, max_queued=RCON_MAX_QUEUED):
+		self.host     = host
+		self.password = password
+		self.port     = port
+		self.timeout  = timeout
+		self._reader      = None
+		self._writer      = None
+		self._reader_task = None
+		self._connect_lock = None
+		# set when the current connection goes away
+		self._disconnected = None
+		# request id -> (future, list of response fragments received so far)
+		self._pending = {}
+		# sentinel request id -> id of the request it follows
+		self._sentinels = {}
+		self._last_id = 0
+		self.breaker = CircuitBreaker(f"{host}:{port}", self._probe)
+		self.ticks = TickSampler(self)
+		self.max_in_flight = max_in_flight
+		self.max_queued = max_queued
+		self._in_flight = 0
+		# heap of [priority, sequence number, future] waiting for a turn; the
+		# future is resolved when the turn is handed over
+		self._queue = []
+		self._sequence = itertools.count()
+		# commands tuple -> task, for background requests that can be shared
+		self._background = {}
+
+	# Number of requests waiting for a turn
+	@property
+	def queued(self):
+		return sum(1 for _, _, future in self._queue if not future.done())
+
+	@property
+	def connected(self):
+		return self._writer is not None and not self._writer.is_closing()
+
+	def _next_id(self):
+		# ids are signed 32 bit, and -1 is reserved for failed logins
+		self._last_id = self._last_id % 0x7fffffff + 1
+		return self._last_id
+
+	async def _ensure_connected(self):
+		if self.connected:
+			return
+		# created lazily so it binds to the bot's event loop rather than
+		# whichever loop happened to exist at import time
+		if self._connect_lock is None:
+			self._connect_lock = asyncio.Lock()
+		async with self._connect_lock:
+			if not self.connected:
+				await asyncio.wait_for(self._connect(), self.timeout)
+
+	async def _connect(self):
+		log.info(f"RconClient: connecting to {self.host}:{self.port}...")
+		reader, writer = await asyncio.open_connection(self.host, self.port)
+		try:
+			login_id = self._next_id()
+			writer.write(_encode_packet(login_id, PACKET_LOGIN, self.password))
+			await writer.drain()
+			# Minecraft answers a login with a single packet, echoing our id on
+			# success or using -1 if the password was wrong
+			resp_id, _, _ = await _read_packet(reader)
+			if resp_id == -1:
+				raise RconAuthError(f"RCON login to {self.host}:{self.port} rejected (wrong password?)")
+			if resp_id != login_id:
+				raise ConnectionError(f"Unexpected RCON login response id {resp_id}")
+		except BaseException:
+			writer.close()
+			raise
+		self._reader = reader
+		self._writer = writer
+		self._disconnected = asyncio.Event()
+		self._reader_task = asyncio.ensure_future(self._read_loop(reader, writer))
+		log.info(f"RconClient: connected to {self.host}:{self.port}")
+
+	async def _read_loop(self, reader, writer):
+		try:
+			while True:
+				request_id, _, body = await _read_packet(reader)
+				follows = self._sentinels.pop(request_id, None)
+				if follows is not None:
+					# everything the server had to say about that request has
+					# arrived (this matters when it ended on a full-size fragment)
+					self._finish(follows)
+					continue
+				pending = self._pending.get(request_id)
+				if pending is None:
+					log.debug(f"RconClient: dropping response for unknown request {request_id}")
+					continue
+				pending[1].append(body)
+				# a full-size fragment means there may be more to come
+				if len(body) < RESPONSE_FRAGMENT_SIZE:
+					self._finish(request_id)
+		except asyncio.CancelledError:
+			raise
+		except (asyncio.IncompleteReadError, OSError) as e:
+			log.info(f"RconClient: connection to {self.host}:{self.port} lost ({e!r})")
+			self._disconnect(writer, ConnectionResetError(f"RCON connection to {self.host}:{self.port} lost"))
+
+	# Hand a complete response to whoever is waiting for it. Fragments are
+	# split by bytes, so they're only decoded once they've been put together.
+	def _finish(self, request_id):
+		pending = self._pending.pop(request_id, None)
+		if pending is None:
+			return
+		future, fragments = pending
+		if not future.done():
+			future.set_result(b"".join(fragments).decode("utf-8", "replace"))
+
+	# Tear down a connection and fail everything that was waiting on it.
+	# Only acts if the given writer is still the current connection, so a stale
+	# reader task can't close a newer connection.
+	def _disconnect(self, writer, exc):
+		if writer is not self._writer:
+			return
+		writer.close()
+		if self._reader_task is not None and self._reader_task is not asyncio.current_task():
+			self._reader_task.cancel()
+		self._reader = None
+		self._writer = None
+		self._reader_task = None
+		self._disconnected.set()
+		pending, self._pending = self._pending, {}
+		self._sentinels = {}
+		for future, _ in pending.values():
+			if not future.done():
+				future.set_exception(exc)
+
+	# Write several commands to the server in one go.
+	# Returns the request ids, the connection used, and a future for each response.
+	async def _send(self, cmds):
+		await self._ensure_connected()
+		writer = self._writer
+		loop = asyncio.get_running_loop()
+		request_ids = []
+		futures = []
+		packets = []
+		for cmd in cmds:
+			request_id = self._next_id()
+			future = loop.create_future()
+			self._pending[request_id] = (future, [])
+			request_ids.append(request_id)
+			futures.append(future)
+			packets.append(_encode_packet(request_id, PACKET_COMMAND, cmd))
+			sentinel_id = self._next_id()
+			self._sentinels[sentinel_id] = request_id
+			packets.append(_encode_packet(sentinel_id, PACKET_SENTINEL, ""))
+		try:
+			writer.write(b"".join(packets))
+			await writer.drain()
+		except OSError as e:
+			for request_id in request_ids:
+				self._pending.pop(request_id, None)
+			self._disconnect(writer, ConnectionResetError(str(e)))
+			raise _StaleConnectionError(str(e)) from e
+		return request_ids, writer, futures
+
+	# Submit several commands in one pipelined exchange and wait for all of the
+	# responses, which are returned in the same order as the commands.
+	# Raises RconUnavailableError straight away if the circuit breaker is open,
+	# unless force is set (for callers that need to see the server go away).
+	# deadline is how long to wait for a turn, in seconds (see
+	# RCON_QUEUE_DEADLINE); timeout is how long the server then has to answer.
+	async def commands(self, cmds, timeout=None, force=False, priority=Priority.USER, deadline=None):
+		# label by the first word only, to keep the number of series down
+		command = cmds[0].split(" ", 1)[0] if len(cmds) == 1 else "batch"
+		async with metrics.timed("rcon", command=command):
+			if not force and not self.breaker.allow():
+				raise RconUnavailableError(f"RCON at {self.host}:{self.port} is unreachable, waiting for it to come back")
+			if deadline is None and priority >= Priority.USER:
+				deadline = RCON_QUEUE_DEADLINE
+			if priority != Priority.BACKGROUND:
+				return await self._dispatch(cmds, timeout, priority, deadline)
+			# A background request that's already waiting (or out) gets the
+			# same answer this one would, so join it instead. Shielded so that
+			# one caller being cancelled doesn't cancel it for the others.
+			key = tuple(cmds)
+			task = self._background.get(key)
+			if task is None:
+				task = asyncio.ensure_future(self._dispatch(cmds, timeout, priority, deadline))
+				self._background[key] = task
+				task.add_done_callback(lambda _: self._background.pop(key, None))
+			else:
+				log.debug(f"RconClient: joining queued background request {cmds}")
+			return await asyncio.shield(task)
+
+	# Wait for a turn, then send the commands
+	async def _dispatch(self, cmds, timeout, priority, deadline):
+		await self._acquire(priority, deadline)
+		try:
+			try:
+				resps = await self._commands(cmds, timeout)
+			except (asyncio.TimeoutError, OSError):
+				self.breaker.record_failure()
+				raise
+			self.breaker.record_success()
+			return resps
+		finally:
+			self._release()
+
+	# Wait until fewer than max_in_flight exchanges are outstanding and nothing
+	# more important is waiting
+	async def _acquire(self, priority, deadline):
+		if self._in_flight < self.max_in_flight and not self.queued:
+			self._in_flight += 1
+			return
+		self._make_room(priority)
+		started = time.monotonic()
+		future = asyncio.get_running_loop().create_future()
+		heapq.heappush(self._queue, [priority, next(self._sequence), future])
+		try:
+			await asyncio.wait_for(asyncio.shield(future), deadline)
+		except RconBusyError:
+			# turned away by _make_room
+			raise
+		except asyncio.TimeoutError:
+			if future.done() and not future.cancelled() and future.exception() is None:
+				# handed a turn just as the deadline passed, so take it
+				return
+			future.cancel()
+			raise RconDeadlineError(f"RCON request to {self.host}:{self.port} not sent within {deadline:g}s, server busy")
+		except BaseException:
+			# cancelled while waiting, give back the turn if it was already handed over
+			if future.done() and not future.cancelled() and future.exception() is None:
+				self._release()
+			else:
+				future.cancel()
+			raise
+		finally:
+			metrics.observe("rcon_queue_wait", time.monotonic() - started, priority=priority.name.lower())
+
+	# Turn away the least important waiting request if the queue is full,
+	# which may be the one about to join it
+	def _make_room(self, priority):
+		waiting = [entry for entry in self._queue if not entry[2].done()]
+		if len(waiting) < self.max_queued:
+			return
+		worst = max(waiting)
+		if worst[0] <= priority:
+			raise RconBusyError(f"RCON queue for {self.host}:{self.port} is full, server busy")
+		log.info(f"RconClient: {self.host}:{self.port} queue full, turning away a {worst[0].name.lower()} request")
+		worst[2].set_exception(RconBusyError(f"RCON queue for {self.host}:{self.port} is full, server busy"))
+
+	# Hand the turn that just finished to the most important waiting request
+	def _release(self):
+		while self._queue:
+			_, _, future = heapq.heappop(self._queue)
+			if not future.done():
+				future.set_result(None)
+				return
+		self._in_flight -= 1
+
+	# The circuit breaker's background probe
+	async def _probe(self):
+		try:
+			await self._commands(["list"], None)
+			return True
+		except (asyncio.TimeoutError, OSError):
+			return False
+
+	async def _commands(self, cmds, timeout):
+		if timeout is None:
+			timeout = self.timeout
+		try:
+			request_ids, writer, futures = await self._send(cmds)
+		except _StaleConnectionError:
+			# the connection was already dead before the commands got out,
+			# so it's safe to reconnect and try exactly once more
+			log.info(f"RconClient: write failed, reconnecting...")
+			request_ids, writer, futures = await self._send(cmds)
+		try:
+			return await asyncio.wait_for(asyncio.gather(*futures), timeout)
+		except asyncio.TimeoutError:
+			# a server that stops answering on a live socket is probably hung,
+			# start from a fresh connection next time
+			for request_id in request_ids:
+				self._pending.pop(request_id, None)
+			self._disconnect(writer, ConnectionResetError("RCON request timed out"))
+			raise
+
+	# Tell the client whether the server's machine is running, as far as the
+	# rest of the bot knows. While it isn't there's nothing to answer, so tick
+	# sampling and the circuit breaker's background probe are paused.
+	def set_machine_running(self, running):
+		if running:
+			self.ticks.resume()
+			self.breaker.resume()
+		else:
+			self.ticks.pause()
+			self.breaker.pause()
+
+	# Submit a command and wait for the response
+	async def command(self, cmd: str, timeout=None, force=False, priority=Priority.USER, deadline=None):
+		(resp,) = await self.commands([cmd], timeout, force, priority, deadline)
+		return resp
+
+	# Wait for the current connection to go away, e.g. because the server is
+	# shutting down. Returns straight away if there is no connection.
+	async def wait_disconnected(self):
+		if self.connected:
+			await self._disconnected.wait()
+
+	async def close(self):
+		self.breaker.stop_probing()
+		if self._writer is not None:
+			writer = self._writer
+			self._disconnect(writer, ConnectionResetError("RCON client closed"))
+			try:
+				await writer.wait_closed()
+			except OSError:
+				pass
+
+
+def _encode_packet(request_id, packet_type, body):
+	payload = struct.pack("<ii", request_id, packet_type) + body.encode("utf-8") + b"\x00\x00"
+	return struct.pack("<i", len(payload)) + payload
+
+
+async def _read_packet(reader):
+	(length,) = struct.unpack("<i", await reader.readexactly(4))
+	data = await reader.readexactly(length)
+	request_id, packet_type = struct.unpack("<ii", data[:8])
+	return request_id, packet_type, data[8:-2]
+
+
+# one client per server, so everything talking to a server shares a connection
+rcon_clients = {}
+
+
+def get_rcon_client(host, password, port=RCON_PORT, timeout=RCON_TIMEOUT):
+	if (host, port) not in rcon_clients:
+		rcon_clients[(host, port)] = RconClient(host, password, port, timeout)
+	return rcon_clients[(host, port)]
+
+
+# the client for the server configured in .env
+rcon_client = get_rcon_client(RCON_URL, RCON_PASSWORD)
+
+
+# Parsed response to the `list` command
+class PlayerList(NamedTuple):
+	count: int
+	max: int
+	names: frozenset
+
+
+# Everything learned from one probe_server() call.
+# Fields for things that weren't asked for (or couldn't be parsed) are None.
+@dataclass(frozen=True)
+class ServerProbe:
+	online: bool
+	players: Optional[PlayerList] = None
+	daytime: Optional[int] = None
+	tps: Optional[float] = None
+	whitelist: Optional[frozenset] = None
+	# our own queue for the server was too congested to ask it at all, which
+	# says nothing about whether it's up
+	busy: bool = False
+
+
+# Ask the server for several things in one pipelined RCON exchange.
+# A successful `list` doubles as the liveness check, so there's no need to call
+# get_rcon_status() first; if the server doesn't answer, online is False.
+# If the request never got a turn in the client's queue, busy is set as well.
+async def probe_server(client=None, players=True, daytime=True, tps=False, whitelist=False, force=False, priority=Priority.USER):
+	client = client or rcon_client
+	cmds = ["list"]
+	if daytime:
+		cmds.append("time query daytime")
+	if tps and RCON_TPS_COMMAND:
+		cmds.append(RCON_TPS_COMMAND)
+	if whitelist:
+		cmds.append("whitelist list")
+	log.info(f"probe_server: probing with {cmds}...")
+	try:
+		resps = dict(zip(cmds, await client.commands(cmds, force=force, priority=priority)))
+	except (RconDeadlineError, RconBusyError) as e:
+		log.info(f"probe_server: {e}")
+		return ServerProbe(False, busy=True)
+	except asyncio.TimeoutError:
+		log.info(f"probe_server: Connection timed out, server offline")
+		return ServerProbe(False)
+	except RconUnavailableError:
+		log.info(f"probe_server: {client.host}:{client.port} known to be unreachable, server offline")
+		return ServerProbe(False)
+	except OSError as e:
+		log.info(f"probe_server: Connection failed ({e!r}), server offline")
+		return ServerProbe(False)
+	if not resps["list"].startswith("There"):
+		return ServerProbe(False)
+	return ServerProbe(
+		True,
+		players=parse_player_list(resps["list"]) if players else None,
+		daytime=parse_daytime(resps["time query daytime"]) if daytime else None,
+		tps=parse_tps(resps[RCON_TPS_COMMAND]) if RCON_TPS_COMMAND in resps else None,
+		whitelist=parse_whitelist(resps["whitelist list"]) if whitelist else None
+	)
 
 
 # check that the Minecraft server is responsive
-def get_rcon_status():
+async def get_rcon_status(client=None):
 	log.info(f"get_rcon_status: getting status...")
-	try:
-		return submit_rcon_command("list").startswith("There")
-	except socket.timeout:
-		log.info(f"get_rcon_status: Connection timed out, returning False")
-		return False
-	except ConnectionRefusedError:
-		log.info(f"get_rcon_status: Connection refused, returning False")
-		return False
+	return (await probe_server(client, daytime=False)).online
 
 
 # get player list
-# Use get_rcon_status() to check server is available before using
-def get_player_list():
-    resp = submit_rcon_command("list")
-    if resp.startswith('There are 0'): 
-        return "There are no players currently playing."
-    else:
-        return resp.replace('_', '\_')
+async def get_player_list(client=None):
+	return format_player_list((await probe_server(client, daytime=False)).players)
+
+
+# Minecraft colour/formatting codes, e.g. "§a"
+FORMATTING_CODE = re.compile(r"§.")
+
+
+# "There are 2 of a max of 20 players online: alice, bob"
+# (or "There are 2/20 players online:" on older versions)
+def parse_player_list(resp):
+	match = re.match(r"There are (\d+)(?: of a max of |/)(\d+) players online:(.*)", resp, re.DOTALL)
+	if not match:
+		return None
+	names = FORMATTING_CODE.sub("", match.group(3)).replace("\n", ",").split(",")
+	return PlayerList(
+		int(match.group(1)),
+		int(match.group(2)),
+		frozenset(name.strip() for name in names if name.strip())
+	)
+
+
+# "The time is 1234"
+def parse_daytime(resp):
+	match = re.search(r"\d+", resp)
+	return int(match.group(0)) if match else None
+
+
+# Pull the ticks per second out of whichever TPS command the server supports
+def parse_tps(resp):
+	resp = FORMATTING_CODE.sub("", resp)
+	# Forge: "Overall: Mean tick time: 1.234 ms. Mean TPS: 20.000"
+	match = re.search(r"Overall:.*?Mean TPS: ([\d.]+)", resp)
+	if match:
+		return float(match.group(1))
+	# Paper/Spigot: "TPS from last 1m, 5m, 15m: 20.0, 20.0, 20.0"
+	match = re.search(r"TPS from last [^:]*:\s*\*?([\d.]+)", resp)
+	if match:
+		return float(match.group(1))
+	# vanilla "tick query": "Target tick rate: 20.0 per second. Average time per tick: 1.2ms..."
+	target = re.search(r"Target tick rate: ([\d.]+)", resp)
+	mspt = re.search(r"Average time per tick: ([\d.]+)ms", resp)
+	if target and mspt:
+		rate = float(target.group(1))
+		return min(rate, 1000 / float(mspt.group(1))) if float(mspt.group(1)) > 0 else rate
+	return None
+
+
+# Pull the milliseconds per tick out of whichever command reported it
+def parse_mspt(resp):
+	resp = FORMATTING_CODE.sub("", resp)
+	# Forge: "Overall: Mean tick time: 1.234 ms. Mean TPS: 20.000"
+	match = re.search(r"Overall:.*?Mean tick time: ([\d.]+) ms", resp)
+	if match:
+		return float(match.group(1))
+	# vanilla "tick query": "... Average time per tick: 1.2ms ..."
+	match = re.search(r"Average time per tick: ([\d.]+)ms", resp)
+	if match:
+		return float(match.group(1))
+	# Paper "mspt": "Server tick times (avg/min/max) from last 5s, 10s, 1m:\n◴ 1.2/0.8/3.4, ..."
+	match = re.search(r"tick times[^:]*:\s*\D*([\d.]+)/", resp)
+	if match:
+		return float(match.group(1))
+	return None
+
+
+# "Test passed, count: 123" (or "Test failed" when there are none)
+def parse_entity_count(resp):
+	match = re.search(r"count: (\d+)", resp)
+	if match:
+		return int(match.group(1))
+	return 0 if resp.startswith("Test failed") else None
+
+
+# "There are 3 whitelisted player(s): alice, bob, carol"
+# (or "There are no whitelisted players")
+def parse_whitelist(resp):
+	if ":" not in resp:
+		return frozenset()
+	names = FORMATTING_CODE.sub("", resp.split(":", 1)[1]).split(",")
+	return frozenset(name.strip() for name in names if name.strip())
+
+
+# turn a parsed player list into something fit for Discord
+def format_player_list(players):
+	if players is None:
+		return "Couldn't make sense of the player list."
+	elif players.count == 0:
+		return "There are no players currently playing."
+	else:
+		names = ", ".join(sorted(players.names, key=str.lower))
+		return f"There are {players.count} of a max of {players.max} players online: {names}".replace('_', '\\_')
 
 
 # submit a command to the server
 # Use get_rcon_status() to check server is available before using
-def submit_rcon_command(cmd: str):
-	log.info(f"rcon_submit: submitting command {cmd} to url {RCON_URL}...")
-	with MCRcon(RCON_URL, RCON_PASSWORD) as mcr:
-		return mcr.command(cmd)
\ No newline at end of file
+async def submit_rcon_command(cmd: str, client=None, priority=Priority.ADMIN):
+	client = client or rcon_client
+	log.info(f"rcon_submit: submitting command {cmd} to url {client.host}...")
+	return await client.command(cmd, priority=priority)
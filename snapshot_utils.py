@@ -0,0 +1,231 @@
+import os
+import time
+import logging
+import asyncio
+from dataclasses import dataclass
+from typing import Optional
+
+from ec2_utils import get_ec2_statuses
+from rcon_utils import PlayerList, ServerProbe, probe_server
+from fleet_utils import SERVERS, get_server
+from presence_utils import presence_store
+from feed_utils import player_feed
+from state_utils import state_store, to_monotonic, to_wall_clock
+
+log = logging.getLogger("bot")
+
+# How long (in seconds) a snapshot of the server state can be reused for.
+# Keeps a burst of identical commands down to one round of AWS/RCON calls.
+SNAPSHOT_TTL = float(os.getenv('SNAPSHOT_TTL', '10'))
+
+
+# Everything the bot knows about one server at one point in time
+@dataclass(frozen=True)
+class ServerSnapshot:
+	server: str
+	ec2_status: str
+	rcon_status: bool
+	# these are only filled in if the server answered
+	players: Optional[PlayerList] = None
+	daytime: Optional[int] = None
+	tps: Optional[float] = None
+	fetched_at: float = 0.0
+	# loaded from the state store at startup rather than fetched by this process
+	restored: bool = False
+	# the server couldn't be asked because our RCON queue for it was full; the
+	# Minecraft fields are carried over from the previous snapshot, if any
+	busy: bool = False
+
+	@property
+	def age(self):
+		return time.monotonic() - self.fetched_at
+
+	@property
+	def is_running(self):
+		return self.ec2_status == "running"
+
+	@property
+	def is_empty(self):
+		return self.players is None or self.players.count == 0
+
+
+# Caches the latest ServerSnapshot of every server for a short time.
+# The whole fleet is refreshed together, so it costs one AWS call no matter how
+# many servers there are.
+# Only one refresh is ever in flight: anyone who asks while it's running waits
+# for that refresh rather than starting another one.
+class SnapshotCache:
+
+	def __init__(self, ttl=SNAPSHOT_TTL):
+		self.ttl = ttl
+		# server name -> ServerSnapshot
+		self._snapshots = None
+		self._fetched_at = 0.0
+		self._refresh_task = None
+		self._restored = False
+
+	@property
+	def latest(self):
+		return self._snapshots
+
+	# Get snapshots of every server, no older than max_age seconds (defaults
+	# to the TTL).
+	# warm accepts the snapshots saved before a restart, for read-only commands
+	# that would rather answer straight away; a refresh is started for next time.
+	async def get_all(self, max_age=None, warm=False):
+		if max_age is None:
+			max_age = self.ttl
+		if self._snapshots is not None and time.monotonic() - self._fetched_at <= max_age:
+			return self._snapshots
+		if warm and self._restored:
+			self._start_refresh()
+			return self._snapshots
+		return await self.refresh()
+
+	# Get a snapshot of one server (the default server if none is given)
+	async def get(self, server=None, max_age=None, warm=False):
+		name = server.name if server is not None else get_server().name
+		return (await self.get_all(max_age, warm))[name]
+
+	# Fetch a new snapshot, or join the fetch that's already happening
+	async def refresh(self):
+		# shielded so that one impatient caller being cancelled doesn't cancel
+		# the refresh for everyone else
+		return await asyncio.shield(self._start_refresh())
+
+	def _start_refresh(self):
+		if self._refresh_task is None:
+			self._refresh_task = asyncio.ensure_future(self._refresh())
+			self._refresh_task.add_done_callback(self._refresh_done)
+		return self._refresh_task
+
+	def _refresh_done(self, task):
+		# a refresh that was detached by invalidate() doesn't get cached
+		if task is not self._refresh_task:
+			return
+		self._refresh_task = None
+		if not task.cancelled() and task.exception() is None:
+			self._snapshots = task.result()
+			self._fetched_at = time.monotonic()
+			self._restored = False
+			self._save()
+		elif not task.cancelled():
+			log.info(f"SnapshotCache: refresh failed ({task.exception()!r})")
+
+	# Throw away the cached snapshot, e.g. after starting or stopping the server.
+	# A refresh that's already in flight may have seen the old state, so it's
+	# detached and the next caller starts a new one.
+	def invalidate(self):
+		self._snapshots = None
+		self._refresh_task = None
+		self._restored = False
+
+	# Load the snapshots saved before the bot last stopped, if there are any
+	# for the servers configured now, and refresh them in the background
+	def restore(self):
+		saved, _ = state_store.load("snapshots")
+		if not saved or self._snapshots is not None or set(saved) != set(SERVERS):
+			return
+		self._snapshots = {
+			name: ServerSnapshot(
+				name,
+				snapshot["ec2_status"],
+				snapshot["rcon_status"],
+				players=PlayerList(*snapshot["players"][:2], frozenset(snapshot["players"][2])) if snapshot["players"] else None,
+				daytime=snapshot["daytime"],
+				tps=snapshot["tps"],
+				fetched_at=to_monotonic(snapshot["fetched_at"]),
+				restored=True
+			)
+			for name, snapshot in saved.items()
+		}
+		# old enough that anything not asking for warm data fetches a new one
+		self._fetched_at = min(snapshot.fetched_at for snapshot in self._snapshots.values())
+		self._restored = True
+		log.info(f"SnapshotCache: restored snapshots from {time.monotonic() - self._fetched_at:.0f}s ago")
+		# and start finding out what's changed since
+		self._start_refresh()
+
+	def _save(self):
+		state_store.save("snapshots", {
+			name: {
+				'ec2_status': snapshot.ec2_status,
+				'rcon_status': snapshot.rcon_status,
+				'players': [snapshot.players.count, snapshot.players.max, sorted(snapshot.players.names)] if snapshot.players else None,
+				'daytime': snapshot.daytime,
+				'tps': snapshot.tps,
+				'fetched_at': to_wall_clock(snapshot.fetched_at)
+			}
+			for name, snapshot in self._snapshots.items()
+		})
+
+	async def _refresh(self):
+		log.info(f"SnapshotCache: refreshing server snapshots...")
+		servers = list(SERVERS.values())
+		ec2_statuses = await get_ec2_statuses([server.instance_id for server in servers])
+		# probe every running server at once, each on its own connection
+		probes = await asyncio.gather(*[
+			_probe_if_running(server, ec2_statuses.get(server.instance_id))
+			for server in servers
+		])
+		fetched_at = time.monotonic()
+		previous = self._snapshots or {}
+		snapshots = {}
+		for server, probe in zip(servers, probes):
+			ec2_status = ec2_statuses.get(server.instance_id, "unknown")
+			record_presence(server, probe, ec2_status)
+			if ec2_status == "running" or ec2_status in EC2_DOWN_STATES:
+				server.rcon.set_machine_running(ec2_status == "running")
+			last = previous.get(server.name)
+			if probe.busy and last is not None and last.rcon_status:
+				# too busy to answer isn't the same as gone, so go with what
+				# it said last time
+				snapshots[server.name] = ServerSnapshot(
+					server.name,
+					ec2_status,
+					True,
+					players=last.players,
+					daytime=last.daytime,
+					tps=last.tps,
+					fetched_at=fetched_at,
+					busy=True
+				)
+			else:
+				snapshots[server.name] = ServerSnapshot(
+					server.name,
+					ec2_status,
+					probe.online,
+					players=probe.players,
+					daytime=probe.daytime,
+					tps=probe.tps,
+					fetched_at=fetched_at,
+					busy=probe.busy
+				)
+		return snapshots
+
+
+# EC2 states in which nobody can be playing on the server
+EC2_DOWN_STATES = {"pending", "stopping", "stopped", "shutting-down", "terminated"}
+
+
+# Keep the player count for !stats and pass the names on to the join/leave feed.
+# Only a player list the server actually gave counts, or nobody on when EC2
+# isn't running: a probe that went unanswered (or was never sent because the
+# server was busy) says nothing about who's still on.
+def record_presence(server, probe, ec2_status):
+	if probe.players is not None:
+		presence_store.record(server.name, probe.players)
+		player_feed.observe(server.name, probe.players.names)
+	elif ec2_status in EC2_DOWN_STATES:
+		presence_store.record(server.name, None)
+		player_feed.observe(server.name, frozenset())
+
+
+async def _probe_if_running(server, ec2_status):
+	if ec2_status != "running":
+		return ServerProbe(False)
+	return await probe_server(server.rcon, tps=True)
+
+
+# the one snapshot cache that every command and the inactivity check read from
+server_snapshot = SnapshotCache()
@@ -0,0 +1,282 @@
+import os
+import json
+import time
+import logging
+import asyncio
+import statistics
+from enum import Enum
+from dataclasses import dataclass, asdict
+from concurrent.futures import ThreadPoolExecutor
+
+from ec2_utils import start_ec2_instance, wait_for_ec2_running, is_ec2_hibernated
+from rcon_utils import probe_server
+from snapshot_utils import server_snapshot
+
+log = logging.getLogger("bot")
+
+# Where to keep a record of how long each start took (one JSON object per line)
+START_HISTORY_FILE = os.getenv('START_HISTORY_FILE', 'logs/start_history.jsonl')
+
+# Give up waiting for the Minecraft server to answer after this long, in seconds
+READY_TIMEOUT = float(os.getenv('READY_TIMEOUT', '600'))
+
+# Bounds on the gap between RCON probes while waiting for the world to load
+READY_POLL_MIN = 1
+READY_POLL_MAX = 10
+
+# How many past starts to base the expected load time on
+HISTORY_WINDOW = 20
+
+
+class StartPhase(Enum):
+	STARTING_EC2  = "starting EC2"
+	LOADING_WORLD = "waiting for the Minecraft server to load"
+	READY         = "ready"
+	FAILED        = "failed"
+
+
+# How long one start took, split into phases (all in seconds)
+@dataclass
+class StartRecord:
+	server: str
+	# wall clock time the start was requested
+	started_at: float
+	# start_instances until EC2 reports the instance running
+	ec2_boot: float
+	# instance running until the Minecraft server answers RCON
+	# (OS boot, the @reboot cron job, JVM start and world load)
+	world_load: float
+	# what asked for the start: "command", or "prewarm" for the scheduler in
+	# prewarm_utils.py
+	trigger: str = "command"
+	# whether the instance resumed from hibernation rather than booting (the
+	# Minecraft server was still running, so world_load is just reconnecting)
+	resumed: bool = False
+
+	@property
+	def total(self):
+		return self.ec2_boot + self.world_load
+
+
+# Starts one server and follows it from pending, to running, to answering RCON.
+# Following it happens in its own task so that several commands can wait on the
+# same start.
+class StartTracker:
+
+	def __init__(self, server, on_phase_change=None, trigger="command"):
+		self.server = server
+		self.trigger = trigger
+		self.resumed = False
+		self.phase = StartPhase.STARTING_EC2
+		self.error = None
+		self.record = None
+		self.started_at = time.monotonic()
+		self.wall_started_at = time.time()
+		self.ec2_ready_at = None
+		self._on_phase_change = on_phase_change
+		self._task = None
+
+	@property
+	def active(self):
+		return self.phase in (StartPhase.STARTING_EC2, StartPhase.LOADING_WORLD)
+
+	@property
+	def elapsed(self):
+		return time.monotonic() - self.started_at
+
+	# Ask EC2 to start the instance, then follow it in the background.
+	# Errors starting the instance are raised here rather than in the background.
+	async def start(self):
+		await self._set_phase(StartPhase.STARTING_EC2)
+		if self.server.hibernate:
+			try:
+				self.resumed = await is_ec2_hibernated(self.server.instance_id)
+			except Exception:
+				# only used for the start history, not worth failing the start
+				log.exception(f"StartTracker: {self.server.name}: couldn't tell whether it's hibernated")
+		try:
+			await start_ec2_instance(self.server.instance_id)
+		except Exception as e:
+			self.error = e
+			await self._set_phase(StartPhase.FAILED)
+			raise
+		finally:
+			server_snapshot.invalidate()
+		self._task = asyncio.ensure_future(self._follow())
+
+	# Wait for the start to finish, and return the phase it ended up in
+	async def wait(self):
+		await asyncio.shield(self._task)
+		return self.phase
+
+	async def _set_phase(self, phase):
+		self.phase = phase
+		log.info(f"StartTracker: {self.server.name}: {phase.value} ({self.elapsed:.1f}s)")
+		if self._on_phase_change is not None:
+			# reporting progress is nice to have, it mustn't break the start
+			try:
+				await self._on_phase_change(self, phase)
+			except Exception:
+				log.exception(f"StartTracker: {self.server.name}: progress callback failed")
+
+	async def _follow(self):
+		try:
+			await wait_for_ec2_running(self.server.instance_id)
+			self.ec2_ready_at = time.monotonic()
+			server_snapshot.invalidate()
+
+			await self._set_phase(StartPhase.LOADING_WORLD)
+			await asyncio.wait_for(self._wait_for_rcon(), READY_TIMEOUT)
+			self.record = StartRecord(
+				self.server.name,
+				self.wall_started_at,
+				self.ec2_ready_at - self.started_at,
+				time.monotonic() - self.ec2_ready_at,
+				self.trigger,
+				self.resumed
+			)
+			save_start_record(self.record)
+			server_snapshot.invalidate()
+			self.server.rcon.set_machine_running(True)
+			await self._set_phase(StartPhase.READY)
+		except Exception as e:
+			self.error = e
+			log.exception(f"StartTracker: {self.server.name}: start failed")
+			await self._set_phase(StartPhase.FAILED)
+
+	# Probe RCON until the server answers.
+	# If past starts say loading takes a while, don't bother probing until
+	# it's nearly due; after that, back off gradually from frequent probes.
+	async def _wait_for_rcon(self):
+		expected = expected_world_load(self.server, self.resumed)
+		backoff = READY_POLL_MIN
+		# forced past the circuit breaker, since the server is expected to be
+		# unreachable until it's loaded
+		while not (await probe_server(self.server.rcon, daytime=False, force=True)).online:
+			waited = time.monotonic() - self.ec2_ready_at
+			if expected is not None and waited < expected * 0.8:
+				delay = min(expected * 0.8 - waited, READY_POLL_MAX)
+			else:
+				delay = backoff
+				backoff = min(backoff * 1.5, READY_POLL_MAX)
+			await asyncio.sleep(delay)
+
+
+# server name -> the latest StartTracker for that server
+start_trackers = {}
+
+
+# The start in progress for a server, or None
+def get_start(server):
+	tracker = start_trackers.get(server.name)
+	return tracker if tracker is not None and tracker.active else None
+
+
+# Start a server, or return the start that's already in progress
+async def start_server(server, on_phase_change=None, trigger="command"):
+	tracker = get_start(server)
+	if tracker is None:
+		tracker = StartTracker(server, on_phase_change, trigger)
+		start_trackers[server.name] = tracker
+		await tracker.start()
+	return tracker
+
+
+# Every recorded start, kept in memory so that working out how long a start
+# should take doesn't mean reading the whole history from disk each time.
+# The file is read once (load() does it off the event loop, at startup) and
+# new records are appended to it on a thread of its own.
+class StartHistory:
+
+	def __init__(self, path=START_HISTORY_FILE):
+		self.path = path
+		# server name -> StartRecords, oldest first
+		self._records = None
+		self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="start_history")
+
+	# Read the history in the background
+	async def load(self):
+		if self._records is None:
+			loop = asyncio.get_running_loop()
+			records = await loop.run_in_executor(self._executor, self._read)
+			if self._records is None:
+				self._records = records
+
+	# Past starts of a server, oldest first.
+	# Reads the file there and then if load() hasn't already.
+	def records(self, server):
+		return list(self._by_server().get(server.name, []))
+
+	def save(self, record):
+		self._by_server().setdefault(record.server, []).append(record)
+		future = self._executor.submit(self._write, record)
+		future.add_done_callback(self._write_done)
+
+	def _by_server(self):
+		if self._records is None:
+			self._records = self._read()
+		return self._records
+
+	def _read(self):
+		records = {}
+		try:
+			with open(self.path) as f:
+				for line in f:
+					try:
+						record = StartRecord(**json.loads(line))
+					except (ValueError, TypeError):
+						continue
+					records.setdefault(record.server, []).append(record)
+		except FileNotFoundError:
+			pass
+		except OSError:
+			log.exception(f"StartHistory: couldn't read {self.path}")
+		return records
+
+	def _write(self, record):
+		with open(self.path, "a") as f:
+			f.write(json.dumps(asdict(record)) + "\n")
+
+	def _write_done(self, future):
+		if future.exception() is not None:
+			log.error(f"StartHistory: couldn't write to {self.path} ({future.exception()!r})")
+
+
+# the one start history for this process
+start_history = StartHistory()
+
+
+def save_start_record(record):
+	start_history.save(record)
+
+
+# Past starts of a server, oldest first
+def load_start_records(server):
+	return start_history.records(server)
+
+
+# The latest HISTORY_WINDOW starts of a server that resumed from hibernation
+# (or that didn't). resumed=None means whichever kind the last start was.
+def recent_start_records(server, resumed=None):
+	records = load_start_records(server)
+	if resumed is None and records:
+		resumed = records[-1].resumed
+	return [record for record in records if record.resumed == resumed][-HISTORY_WINDOW:]
+
+
+# Typical time from EC2 running to the Minecraft server answering, or None if
+# there's no history yet
+def expected_world_load(server, resumed=None):
+	records = recent_start_records(server, resumed)
+	if not records:
+		return None
+	return statistics.median(record.world_load for record in records)
+
+
+# Typical time from asking for a start to the server being playable, or None
+# if there's no history yet
+def expected_start_time(server, resumed=None):
+	records = recent_start_records(server, resumed)
+	if not records:
+		return None
+	return statistics.median(record.total for record in records)
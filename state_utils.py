@@ -0,0 +1,103 @@
+import os
+import json
+import time
+import sqlite3
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger("bot")
+
+# Where to keep the state that should survive a restart: when each server was
+# last active, the last snapshot of every server, and stops in progress
+STATE_FILE = os.getenv('STATE_FILE', 'logs/state.db')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS state (
+	key      TEXT PRIMARY KEY,
+	-- JSON
+	value    TEXT NOT NULL,
+	-- unix time
+	saved_at REAL NOT NULL
+);
+"""
+
+
+# A small key -> JSON value store in SQLite, so the bot and the monitor worker
+# can pick up where they left off after a restart.
+# The database is in WAL mode so both processes can use it at once. Loading
+# only happens at startup and is done directly; saving goes through a thread
+# so it never holds up the event loop.
+class StateStore:
+
+	def __init__(self, path=STATE_FILE):
+		self.path = path
+		# which process this is ("bot" or "monitor"), for state that belongs to
+		# one process rather than the fleet, e.g. the stops it's running
+		self.scope = "bot"
+		self._db = None
+		# SQLite connections belong to the thread that made them, so the
+		# event loop and the writer thread have one each
+		self._loop_db = None
+		self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="state")
+
+	# The value saved under key and the unix time it was saved at, or (None, None)
+	def load(self, key):
+		try:
+			if self._loop_db is None:
+				self._loop_db = self._open()
+			row = self._loop_db.execute("SELECT value, saved_at FROM state WHERE key = ?", (key,)).fetchone()
+		except (OSError, sqlite3.Error):
+			log.exception(f"StateStore: couldn't load {key}, starting cold")
+			return None, None
+		if row is None:
+			return None, None
+		return json.loads(row[0]), row[1]
+
+	# Save a value in the background. Later saves of the same key win.
+	def save(self, key, value):
+		future = self._executor.submit(self._write, key, json.dumps(value), time.time())
+		future.add_done_callback(self._write_done)
+
+	def _write_done(self, future):
+		if future.exception() is not None:
+			log.error(f"StateStore: save failed ({future.exception()!r})")
+
+	def _open(self):
+		directory = os.path.dirname(self.path)
+		if directory:
+			os.makedirs(directory, exist_ok=True)
+		db = sqlite3.connect(self.path, timeout=10)
+		db.execute("PRAGMA journal_mode=WAL")
+		# in WAL mode this is still safe against the bot crashing, only a
+		# power cut can lose the last few saves
+		db.execute("PRAGMA synchronous=NORMAL")
+		db.executescript(SCHEMA)
+		return db
+
+	def _connect(self):
+		if self._db is None:
+			self._db = self._open()
+		return self._db
+
+	def _write(self, key, value, saved_at):
+		db = self._connect()
+		with db:
+			db.execute(
+				"INSERT INTO state VALUES (?, ?, ?) "
+				"ON CONFLICT (key) DO UPDATE SET value = excluded.value, saved_at = excluded.saved_at",
+				(key, value, saved_at)
+			)
+
+
+# Turn a wall clock time saved before a restart into this process's monotonic
+# clock, which is what the rest of the bot keeps time with
+def to_monotonic(wall_time):
+	return time.monotonic() - (time.time() - wall_time)
+
+
+def to_wall_clock(monotonic_time):
+	return time.time() - (time.monotonic() - monotonic_time)
+
+
+# the one state store for this process
+state_store = StateStore()
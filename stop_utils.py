@@ -0,0 +1,262 @@
+import os
+import time
+import logging
+import asyncio
+from enum import Enum
+
+from ec2_utils import stop_ec2_instance, hibernate_ec2_instance
+from rcon_utils import Priority
+from snapshot_utils import server_snapshot
+from fleet_utils import get_server
+from state_utils import state_store
+
+log = logging.getLogger("bot")
+
+# Upper bound on how long to give the Minecraft server to exit before stopping
+# EC2 anyway, in seconds. Normally it's done well before this.
+STOP_TIMEOUT = float(os.getenv('STOP_TIMEOUT', '120'))
+
+# How long `save-all flush` is allowed to take, in seconds
+SAVE_TIMEOUT = float(os.getenv('SAVE_TIMEOUT', '60'))
+
+# Extra time to give the JVM after RCON goes away, in seconds.
+# The server closes RCON after saving the world, so this can be short.
+STOP_GRACE = float(os.getenv('STOP_GRACE', '5'))
+
+# How often to check whether the server has finished exiting, in seconds
+STOP_POLL_INTERVAL = 1
+
+# Stops interrupted by a restart are only finished if the restart was this
+# quick, in seconds. After longer than that somebody may well have started the
+# server again.
+STOP_RESUME_MAX_AGE = float(os.getenv('STOP_RESUME_MAX_AGE', '300'))
+
+
+class StopState(Enum):
+	SAVING           = "saving the world"
+	STOPPING_SERVER  = "stopping the Minecraft server"
+	WAITING_FOR_EXIT = "waiting for the Minecraft server to exit"
+	HIBERNATING      = "hibernating EC2"
+	STOPPING_EC2     = "stopping EC2"
+	DONE             = "done"
+	CANCELLED        = "cancelled"
+	FAILED           = "failed"
+
+
+# Once Minecraft has been told to stop there's no taking it back: cancelling
+# after that would leave EC2 running (and billed) with nothing on it
+CANCELLABLE_STATES = {StopState.SAVING}
+
+FINISHED_STATES = {StopState.DONE, StopState.CANCELLED, StopState.FAILED}
+
+
+# Stops one server: save the world, stop Minecraft, wait for it to actually
+# exit (up to STOP_TIMEOUT), then stop the EC2 instance.
+# Servers set to hibernate skip stopping Minecraft: the world is saved and the
+# instance hibernated with the server still running in memory. If the instance
+# turns out not to support hibernation, the stop carries on the normal way.
+# Runs in its own task so it can be cancelled, and so several commands can wait
+# on the same stop.
+class StopPipeline:
+
+	def __init__(self, server, rcon_status, on_state_change=None):
+		self.server = server
+		self.rcon_status = rcon_status
+		self.state = None
+		self.error = None
+		self.hibernated = False
+		self.started_at = time.monotonic()
+		self._on_state_change = on_state_change
+		self._task = None
+
+	@property
+	def active(self):
+		return self._task is not None and not self._task.done()
+
+	def start(self):
+		self._task = asyncio.ensure_future(self._run())
+		return self
+
+	# Wait for the stop to finish, and return the state it ended up in
+	async def wait(self):
+		await asyncio.shield(self._task)
+		return self.state
+
+	# Cancel the stop, if it hasn't got as far as stopping Minecraft (or
+	# hibernating)
+	def cancel(self):
+		if self.state not in CANCELLABLE_STATES:
+			return False
+		self._task.cancel()
+		return True
+
+	async def _set_state(self, state):
+		self.state = state
+		log.info(f"StopPipeline: {self.server.name}: {state.value}")
+		_save_stops()
+		if self._on_state_change is not None:
+			# reporting progress is nice to have, it mustn't break the stop
+			try:
+				await self._on_state_change(self, state)
+			except Exception:
+				log.exception(f"StopPipeline: {self.server.name}: progress callback failed")
+
+	async def _run(self):
+		try:
+			if self.server.hibernate:
+				self.hibernated = await self._hibernate()
+			if not self.hibernated:
+				if self.rcon_status:
+					await self._stop_minecraft()
+				else:
+					log.info(f"StopPipeline: {self.server.name}: Minecraft server not responsive, skipping straight to stopping EC2...")
+				await self._set_state(StopState.STOPPING_EC2)
+				await stop_ec2_instance(self.server.instance_id)
+			self.server.rcon.set_machine_running(False)
+			await self._set_state(StopState.DONE)
+		except asyncio.CancelledError:
+			await self._set_state(StopState.CANCELLED)
+		except Exception as e:
+			self.error = e
+			log.exception(f"StopPipeline: {self.server.name}: stop failed")
+			await self._set_state(StopState.FAILED)
+		finally:
+			server_snapshot.invalidate()
+		log.info(f"StopPipeline: {self.server.name}: finished in {time.monotonic() - self.started_at:.1f}s")
+
+	async def _save_world(self):
+		await self._set_state(StopState.SAVING)
+		try:
+			await self.server.rcon.command("save-all flush", timeout=SAVE_TIMEOUT, priority=Priority.SHUTDOWN)
+		except (asyncio.TimeoutError, OSError) as e:
+			# stopping saves the world too, so carry on
+			log.info(f"StopPipeline: {self.server.name}: save-all failed ({e!r}), stopping anyway")
+
+	# Save the world and hibernate, leaving Minecraft running.
+	# Returns False if the instance can't hibernate.
+	async def _hibernate(self):
+		if self.rcon_status:
+			await self._save_world()
+		await self._set_state(StopState.HIBERNATING)
+		if await hibernate_ec2_instance(self.server.instance_id):
+			return True
+		log.info(f"StopPipeline: {self.server.name}: can't hibernate, stopping normally")
+		return False
+
+	async def _stop_minecraft(self):
+		client = self.server.rcon
+		# the world was just saved if a hibernate was tried first
+		if self.state != StopState.HIBERNATING:
+			await self._save_world()
+
+		await self._set_state(StopState.STOPPING_SERVER)
+		try:
+			await client.command("stop", priority=Priority.SHUTDOWN)
+		except (asyncio.TimeoutError, OSError):
+			# the server can hang up on us before it gets around to replying
+			pass
+
+		await self._set_state(StopState.WAITING_FOR_EXIT)
+		try:
+			await asyncio.wait_for(_wait_for_exit(client), STOP_TIMEOUT)
+			log.info(f"StopPipeline: {self.server.name}: Minecraft server exited after {time.monotonic() - self.started_at:.1f}s")
+			await asyncio.sleep(STOP_GRACE)
+		except asyncio.TimeoutError:
+			log.info(f"StopPipeline: {self.server.name}: Minecraft server still up after {STOP_TIMEOUT:.0f}s, stopping EC2 anyway")
+
+
+# The server closes its RCON port once it has saved everything and is on its
+# way out. Wait for our connection to drop, then until nothing is listening.
+async def _wait_for_exit(client):
+	while True:
+		await client.wait_disconnected()
+		try:
+			await client.command("list", timeout=STOP_POLL_INTERVAL, force=True, priority=Priority.SHUTDOWN)
+		except ConnectionRefusedError:
+			return
+		except (asyncio.TimeoutError, OSError):
+			pass
+		await asyncio.sleep(STOP_POLL_INTERVAL)
+
+
+# server name -> the latest StopPipeline for that server
+stop_pipelines = {}
+
+
+# The stop in progress for a server, or None
+def get_stop(server):
+	pipeline = stop_pipelines.get(server.name)
+	return pipeline if pipeline is not None and pipeline.active else None
+
+
+def is_stopping(server):
+	return get_stop(server) is not None
+
+
+# Call off the stop in progress for a server, if it isn't too late.
+# Returns StopState.CANCELLED if it was, the state it's in if it's too late,
+# or None if the server isn't being stopped.
+async def cancel_stop(server):
+	pipeline = get_stop(server)
+	if pipeline is None:
+		return None
+	if not pipeline.cancel():
+		return pipeline.state
+	return await pipeline.wait()
+
+
+# Start stopping a server, or return the stop that's already in progress
+def start_stop(server, rcon_status, on_state_change=None):
+	pipeline = get_stop(server)
+	if pipeline is None:
+		pipeline = StopPipeline(server, rcon_status, on_state_change).start()
+		stop_pipelines[server.name] = pipeline
+	return pipeline
+
+
+# Keep track of the stops this process is in the middle of, so that a stop cut
+# short by a restart can be finished afterwards
+def _save_stops():
+	state_store.save(f"stops:{state_store.scope}", {
+		name: {'state': pipeline.state.name, 'rcon_status': pipeline.rcon_status}
+		for name, pipeline in stop_pipelines.items()
+		if pipeline.state is not None and pipeline.state not in FINISHED_STATES
+	})
+
+
+# Finish any stops this process was in the middle of when it last went down,
+# if it went down recently. Each server is looked at again first, and its stop
+# is only started over if EC2 is still running and nobody is on (a Minecraft
+# server that has already been stopped counts as empty). Returns the resumed
+# StopPipelines.
+async def resume_stops(on_state_change=None):
+	saved, saved_at = state_store.load(f"stops:{state_store.scope}")
+	if not saved:
+		return []
+	age = time.time() - saved_at
+	if age > STOP_RESUME_MAX_AGE:
+		log.info(f"resume_stops: stops for {', '.join(saved)} were interrupted {age:.0f}s ago, leaving them")
+		_save_stops()
+		return []
+	try:
+		snapshots = await server_snapshot.refresh()
+	except Exception:
+		log.exception("resume_stops: couldn't check the servers, leaving the interrupted stops")
+		return []
+	pipelines = []
+	for name, stop in saved.items():
+		server = get_server(name)
+		if server is None or is_stopping(server):
+			continue
+		snapshot = snapshots[server.name]
+		state = StopState[stop['state']]
+		if not snapshot.is_running:
+			log.info(f"resume_stops: {server.name}: stop was {state.value} when the bot went down, but EC2 is {snapshot.ec2_status} now")
+		elif snapshot.rcon_status and not snapshot.is_empty:
+			log.info(f"resume_stops: {server.name}: stop was {state.value} when the bot went down, but there are players on now, leaving it running")
+		else:
+			log.info(f"resume_stops: {server.name}: stop was {state.value} when the bot went down, finishing it")
+			pipelines.append(start_stop(server, snapshot.rcon_status, on_state_change))
+	# forget the ones that weren't resumed
+	_save_stops()
+	return pipelines
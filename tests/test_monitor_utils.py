@@ -0,0 +1,50 @@
+import unittest
+from unittest import mock
+
+import monitor_utils
+from fleet_utils import Server
+from monitor_utils import InactivityMonitor
+from rcon_utils import PlayerList
+
+
+class InactivityMonitorTest(unittest.IsolatedAsyncioTestCase):
+
+	async def asyncSetUp(self):
+		self.now = 0.0
+		patcher = mock.patch.object(monitor_utils.time, "monotonic", lambda: self.now)
+		patcher.start()
+		self.addCleanup(patcher.stop)
+		self.start_stop = mock.Mock()
+		patcher = mock.patch.object(monitor_utils, "start_stop", self.start_stop)
+		patcher.start()
+		self.addCleanup(patcher.stop)
+
+		self.server = Server(name="Main", instance_id="i-test", rcon_url="localhost", rcon_password="", inactivity_timeout=30)
+		self.monitor = InactivityMonitor({self.server.name: self.server})
+		self.monitor._save = mock.Mock()
+
+	async def check(self, minutes, ec2_status, online=False, players=None):
+		self.now = minutes * 60
+		self.monitor._probe = mock.AsyncMock(return_value={
+			self.server.name: (ec2_status, online, players, False)
+		})
+		await self.monitor._check([self.server])
+
+	# A server started outside the bot gets a full timeout from when the
+	# monitor first sees it running, even if it was last seen stopped long ago
+	async def test_start_outside_the_bot_resets_idle_clock(self):
+		await self.check(0, "stopped")
+		# started from the AWS console at +50 minutes, still loading at +60
+		await self.check(60, "running")
+		self.start_stop.assert_not_called()
+		self.assertEqual(self.monitor.deadline(self.server), 90 * 60)
+
+		await self.check(80, "running", online=True, players=PlayerList(0, 20, frozenset()))
+		self.start_stop.assert_not_called()
+
+		await self.check(91, "running", online=True, players=PlayerList(0, 20, frozenset()))
+		self.start_stop.assert_called_once()
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,74 @@
+import struct
+import asyncio
+import unittest
+
+from rcon_utils import RconClient, PACKET_LOGIN, PACKET_COMMAND, PACKET_RESPONSE, RESPONSE_FRAGMENT_SIZE
+
+
+def encode(request_id, packet_type, body):
+	payload = struct.pack("<ii", request_id, packet_type) + body + b"\x00\x00"
+	return struct.pack("<i", len(payload)) + payload
+
+
+# Answers every command with responses[command], split into fragments of
+# RESPONSE_FRAGMENT_SIZE bytes like Minecraft does
+class FakeRconServer:
+
+	def __init__(self, responses):
+		self.responses = responses
+
+	async def start(self):
+		self._server = await asyncio.start_server(self._handle, "127.0.0.1", 0)
+		return self._server.sockets[0].getsockname()[1]
+
+	def close(self):
+		self._server.close()
+
+	async def _handle(self, reader, writer):
+		try:
+			while True:
+				(length,) = struct.unpack("<i", await reader.readexactly(4))
+				data = await reader.readexactly(length)
+				request_id, packet_type = struct.unpack("<ii", data[:8])
+				body = data[8:-2].decode()
+				if packet_type == PACKET_LOGIN:
+					writer.write(encode(request_id, PACKET_COMMAND, b""))
+				elif packet_type == PACKET_COMMAND:
+					response = self.responses[body].encode()
+					for start in range(0, max(len(response), 1), RESPONSE_FRAGMENT_SIZE):
+						writer.write(encode(request_id, PACKET_RESPONSE, response[start:start + RESPONSE_FRAGMENT_SIZE]))
+				else:
+					writer.write(encode(request_id, PACKET_RESPONSE, f"Unknown request {packet_type:x}".encode()))
+				await writer.drain()
+		except (asyncio.IncompleteReadError, OSError):
+			writer.close()
+
+
+class RconClientTest(unittest.IsolatedAsyncioTestCase):
+
+	async def command(self, response):
+		server = FakeRconServer({'test': response})
+		port = await server.start()
+		client = RconClient("127.0.0.1", "password", port, timeout=2)
+		try:
+			return await client.command("test")
+		finally:
+			await client.close()
+			server.close()
+
+	# fragments are split by bytes, so multi-byte characters make a full one
+	# fewer than RESPONSE_FRAGMENT_SIZE characters long
+	async def test_multibyte_response_spanning_fragments(self):
+		response = "§a" * 1000 + "x" * 2003
+		self.assertGreater(len(response.encode()), RESPONSE_FRAGMENT_SIZE)
+		self.assertEqual(await self.command(response), response)
+
+	# nothing follows a response that exactly fills its fragment, so it's the
+	# sentinel that says it's finished, rather than the timeout
+	async def test_response_exactly_one_fragment_long(self):
+		response = "x" * RESPONSE_FRAGMENT_SIZE
+		self.assertEqual(await asyncio.wait_for(self.command(response), 1), response)
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,137 @@
+import os
+import sys
+import time
+import logging
+import asyncio
+import threading
+import traceback
+from collections import deque
+from dataclasses import dataclass
+
+from metrics_utils import metrics
+
+log = logging.getLogger("bot")
+
+# How often the event loop checks in, in seconds
+WATCHDOG_INTERVAL = 0.1
+
+# A check-in this late counts as a stall, in seconds
+WATCHDOG_STALL_THRESHOLD = float(os.getenv('WATCHDOG_STALL_THRESHOLD', '0.5'))
+
+# Report at most one stall per this many seconds to the error log channel.
+# Stalls in between are still logged and counted.
+WATCHDOG_REPORT_INTERVAL = float(os.getenv('WATCHDOG_REPORT_INTERVAL', '600'))
+
+# How many of the innermost frames of the blocking stack to keep
+WATCHDOG_STACK_DEPTH = 15
+
+# Rolling windows for the stall counters, in seconds
+WATCHDOG_WINDOWS = {'1h': 3600, '24h': 86400}
+
+
+# One time the event loop stopped responding
+@dataclass
+class Stall:
+	# wall clock time it started
+	started_at: float
+	# seconds the loop was blocked for
+	duration: float
+	# where the loop thread was when the stall was noticed
+	stack: str
+
+
+# Watches the event loop from a separate thread.
+# A task on the loop checks in every WATCHDOG_INTERVAL and records how late it
+# was (the loop lag). If the loop goes quiet for longer than
+# WATCHDOG_STALL_THRESHOLD, the watchdog thread grabs the loop thread's stack,
+# which shows whatever is blocking it. Once the loop is back, the stall is
+# logged, counted, and passed to on_stall (rate limited).
+class LoopWatchdog:
+
+	def __init__(self, threshold=WATCHDOG_STALL_THRESHOLD, report_interval=WATCHDOG_REPORT_INTERVAL):
+		self.threshold = threshold
+		self.report_interval = report_interval
+		# async function taking a Stall and the number of stalls not reported
+		# since the last one
+		self.on_stall = None
+		# (monotonic time, duration) of recent stalls, for the rolling counters
+		self.stalls = deque()
+		self.max_lag = 0.0
+		self.last_stall = None
+		self._last_beat = None
+		self._stack = None
+		self._last_report = None
+		self._unreported = 0
+		self._task = None
+
+	def start(self):
+		if self._task is not None:
+			return
+		self._loop_thread = threading.get_ident()
+		self._last_beat = time.monotonic()
+		self._task = asyncio.ensure_future(self._beat())
+		threading.Thread(target=self._watch, name="watchdog", daemon=True).start()
+		log.info(f"LoopWatchdog: watching for stalls over {self.threshold * 1000:.0f}ms")
+
+	# Stall counts and total stalled time over each rolling window
+	def summary(self):
+		now = time.monotonic()
+		while self.stalls and now - self.stalls[0][0] > max(WATCHDOG_WINDOWS.values()):
+			self.stalls.popleft()
+		return {
+			name: (
+				sum(1 for at, _ in self.stalls if now - at <= window),
+				sum(duration for at, duration in self.stalls if now - at <= window)
+			)
+			for name, window in WATCHDOG_WINDOWS.items()
+		}
+
+	async def _beat(self):
+		while True:
+			before = time.monotonic()
+			await asyncio.sleep(WATCHDOG_INTERVAL)
+			now = time.monotonic()
+			self._last_beat = now
+			lag = now - before - WATCHDOG_INTERVAL
+			metrics.observe("event_loop_lag", max(lag, 0))
+			self.max_lag = max(self.max_lag, lag)
+			if lag > self.threshold:
+				await self._stalled(lag)
+
+	async def _stalled(self, lag):
+		stack, self._stack = self._stack, None
+		stall = Stall(time.time() - lag, lag, stack or "(stack not captured)")
+		self.stalls.append((time.monotonic(), lag))
+		self.last_stall = stall
+		log.warning(f"LoopWatchdog: event loop blocked for {lag * 1000:.0f}ms in:\n{stall.stack}")
+		now = time.monotonic()
+		if self._last_report is not None and now - self._last_report < self.report_interval:
+			self._unreported += 1
+			return
+		self._last_report = now
+		unreported, self._unreported = self._unreported, 0
+		if self.on_stall is not None:
+			try:
+				await self.on_stall(stall, unreported)
+			except Exception:
+				log.exception("LoopWatchdog: reporting a stall failed")
+
+	# Runs on its own thread, so it keeps going while the loop is stuck
+	def _watch(self):
+		stalled = False
+		while True:
+			time.sleep(WATCHDOG_INTERVAL)
+			behind = time.monotonic() - self._last_beat
+			if behind <= self.threshold:
+				stalled = False
+			elif not stalled:
+				# grab the stack once per stall, as soon as it's noticed
+				stalled = True
+				frame = sys._current_frames().get(self._loop_thread)
+				if frame is not None:
+					frames = traceback.extract_stack(frame)[-WATCHDOG_STACK_DEPTH:]
+					self._stack = "".join(traceback.format_list(frames))
+
+
+# the one watchdog for the bot's event loop
+loop_watchdog = LoopWatchdog()
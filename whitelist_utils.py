@@ -0,0 +1,76 @@
+import os
+import time
+import logging
+
+from rcon_utils import Priority, parse_whitelist
+
+log = logging.getLogger("bot")
+
+# How long a fetched whitelist is trusted for, in seconds. Changes made through
+# the bot invalidate it straight away; this only covers changes made elsewhere
+# (e.g. on the server console).
+WHITELIST_TTL = float(os.getenv('WHITELIST_TTL', '300'))
+
+
+# One server's whitelist, fetched once and kept as a case-insensitive index so
+# that "is this person on it?" doesn't need a round trip to the server
+class WhitelistIndex:
+
+	def __init__(self, server, ttl=WHITELIST_TTL):
+		self.server = server
+		self.ttl = ttl
+		# lowercased name -> name as the server spells it
+		self._names = None
+		self._fetched_at = 0.0
+
+	def invalidate(self):
+		self._names = None
+
+	# Every whitelisted name, sorted case-insensitively
+	async def names(self):
+		return sorted((await self._index()).values(), key=str.lower)
+
+	async def contains(self, name):
+		return name.lower() in await self._index()
+
+	async def _index(self):
+		if self._names is None or time.monotonic() - self._fetched_at > self.ttl:
+			resp = await self.server.rcon.command("whitelist list")
+			self._names = {name.lower(): name for name in parse_whitelist(resp)}
+			self._fetched_at = time.monotonic()
+		return self._names
+
+	# Add several people in one pipelined RCON exchange.
+	# Returns a list of (name, server response), leaving out anyone who was
+	# already on the whitelist.
+	async def add(self, names):
+		return await self._change("add", [name for name in names if not await self.contains(name)])
+
+	# Remove several people in one pipelined RCON exchange.
+	# Returns a list of (name, server response), leaving out anyone who wasn't
+	# on the whitelist.
+	async def remove(self, names):
+		return await self._change("remove", [name for name in names if await self.contains(name)])
+
+	async def _change(self, action, names):
+		if not names:
+			return []
+		log.info(f"WhitelistIndex: {self.server.name}: whitelist {action} {', '.join(names)}")
+		try:
+			resps = await self.server.rcon.commands(
+				[f"whitelist {action} {name}" for name in names], priority=Priority.ADMIN
+			)
+		finally:
+			# even a partial failure may have changed something
+			self.invalidate()
+		return list(zip(names, resps))
+
+
+# server name -> WhitelistIndex
+whitelists = {}
+
+
+def get_whitelist(server):
+	if server.name not in whitelists:
+		whitelists[server.name] = WhitelistIndex(server)
+	return whitelists[server.name]
@@ -0,0 +1,305 @@
+import os
+import sys
+import json
+import time
+import socket
+import logging
+import asyncio
+
+from fleet_utils import get_server
+from rcon_utils import PlayerList
+from snapshot_utils import server_snapshot
+from stop_utils import StopState, cancel_stop
+from monitor_utils import inactivity_monitor
+from feed_utils import PLAYER_FEED_CHANNEL, player_feed
+from presence_utils import presence_store
+
+log = logging.getLogger("bot")
+
+# Where the inactivity monitor runs:
+#   "spawn"    - in a worker process that the bot starts and restarts as needed
+#   "external" - in a worker process started some other way
+#                (`python3 monitor_worker.py`, e.g. from systemd)
+#   "inline"   - on the bot's own event loop, like it used to
+# The worker has its own AWS and RCON connections, so a hung call in the
+# monitor can't hold up the bot, and either side can restart without the other.
+MONITOR_WORKER = os.getenv('MONITOR_WORKER', 'spawn')
+
+# Unix socket the bot and the worker talk over
+MONITOR_SOCKET = os.getenv('MONITOR_SOCKET', 'monitor.sock')
+
+# How long to wait for the worker to answer a cancel, in seconds
+WORKER_CANCEL_TIMEOUT = 10
+
+# How long to wait before restarting a worker that exited, or reconnecting to
+# one, in seconds
+WORKER_RESTART_DELAY = 5
+WORKER_RESTART_DELAY_MAX = 60
+
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "monitor_worker.py")
+
+# The bot and the worker exchange one JSON object per line.
+#   bot -> worker: {"op": "wake", "server": name}
+#     a command started or stopped that server, so check it now
+#   bot -> worker: {"op": "cancel", "server": name}
+#     call off the monitor's stop of that server, if it isn't too late
+#   worker -> bot: {"event": "cancel", "server": name, "state": StopState name or null}
+#     the answer to a cancel: CANCELLED, the state that made it too late, or
+#     null if the monitor wasn't stopping that server
+#   worker -> bot: {"event": "stop", "server": name, "state": StopState name}
+#     the monitor is stopping a server for inactivity
+#   worker -> bot: {"event": "players", "server": name, "names": [...], "at": time}
+#     who the monitor saw on a server, for the join/leave feed
+#   worker -> bot: {"event": "presence", "server": name, "players": [count, max, [...]] or null, "at": time}
+#     a player count for the presence history, which only the bot writes
+#     (samples taken while no bot is connected are lost)
+
+
+async def send_message(writer, message):
+	writer.write((json.dumps(message) + "\n").encode())
+	await writer.drain()
+
+
+# Worker side: runs the monitor and listens for the bot on MONITOR_SOCKET.
+# Any number of bots can be connected; each one hears about every stop.
+class MonitorWorker:
+
+	def __init__(self, monitor, path=MONITOR_SOCKET):
+		self.monitor = monitor
+		self.path = path
+		self._writers = set()
+
+	async def run(self):
+		# a socket file left behind by a worker that died
+		if os.path.exists(self.path):
+			os.remove(self.path)
+		server = await asyncio.start_unix_server(self._handle, self.path)
+		self.monitor.on_stop_state = self._broadcast_stop
+		if PLAYER_FEED_CHANNEL:
+			player_feed.on_sample = self._broadcast_players
+		presence_store.on_sample = self._broadcast_presence
+		log.info(f"MonitorWorker: listening on {self.path}")
+		async with server:
+			await self.monitor.run()
+
+	async def _handle(self, reader, writer):
+		self._writers.add(writer)
+		try:
+			async for line in reader:
+				try:
+					message = json.loads(line)
+				except ValueError:
+					log.info(f"MonitorWorker: ignoring garbled message {line!r}")
+					continue
+				server = get_server(message["server"]) if "server" in message else None
+				if message.get("op") == "wake" and server is not None:
+					log.info(f"MonitorWorker: woken for {server.name}")
+					self.monitor.wake(server, touch=True)
+				elif message.get("op") == "cancel" and server is not None:
+					log.info(f"MonitorWorker: asked to cancel the stop of {server.name}")
+					state = await cancel_stop(server)
+					await send_message(writer, {'event': "cancel", 'server': server.name, 'state': state.name if state is not None else None})
+		except OSError:
+			pass
+		finally:
+			self._writers.discard(writer)
+			writer.close()
+
+	async def _broadcast_stop(self, server, state):
+		await self._broadcast({'event': "stop", 'server': server.name, 'state': state.name})
+
+	def _broadcast_players(self, server_name, names, at):
+		asyncio.ensure_future(self._broadcast({'event': "players", 'server': server_name, 'names': sorted(names), 'at': at}))
+
+	def _broadcast_presence(self, server_name, players, at):
+		asyncio.ensure_future(self._broadcast({
+			'event': "presence",
+			'server': server_name,
+			'players': [players.count, players.max, sorted(players.names)] if players is not None else None,
+			'at': at
+		}))
+
+	async def _broadcast(self, message):
+		for writer in list(self._writers):
+			try:
+				await send_message(writer, message)
+			except OSError:
+				self._writers.discard(writer)
+
+
+# Bot side: runs the monitor wherever MONITOR_WORKER says, passes wake-ups on
+# to it, and keeps track of the stops it's making.
+class MonitorLink:
+
+	def __init__(self, mode=MONITOR_WORKER, path=MONITOR_SOCKET):
+		if mode != "inline" and not hasattr(socket, "AF_UNIX"):
+			log.info("MonitorLink: no Unix sockets on this platform, running the monitor inline")
+			mode = "inline"
+		self.mode = mode
+		self.path = path
+		# server name -> StopState of the latest stop the worker reported
+		self.stop_states = {}
+		self._writer = None
+		self._task = None
+		# server name -> future for the answer to a cancel sent to the worker
+		self._cancels = {}
+
+	# Whether the monitor is in the middle of stopping a server
+	def is_stopping(self, server):
+		state = self.stop_states.get(server.name)
+		return state is not None and state not in (StopState.DONE, StopState.CANCELLED, StopState.FAILED)
+
+	# Tell the monitor a command just started or stopped a server
+	def wake(self, server):
+		if self.mode == "inline":
+			inactivity_monitor.wake(server)
+		elif self._writer is not None:
+			asyncio.ensure_future(self._send({'op': "wake", 'server': server.name}))
+		else:
+			log.info(f"MonitorLink: not connected to the monitor worker, it'll see {server.name} change at its next check")
+
+	# Call off the monitor's stop of a server, if it isn't too late. Returns the
+	# same as stop_utils.cancel_stop(). Raises ConnectionError or
+	# asyncio.TimeoutError if the worker can't be asked.
+	async def cancel_stop(self, server):
+		if self.mode == "inline":
+			return await cancel_stop(server)
+		if self._writer is None:
+			raise ConnectionError("not connected to the monitor worker")
+		future = self._cancels.get(server.name)
+		try:
+			if future is None:
+				future = self._cancels[server.name] = asyncio.get_running_loop().create_future()
+				await send_message(self._writer, {'op': "cancel", 'server': server.name})
+			return await asyncio.wait_for(asyncio.shield(future), WORKER_CANCEL_TIMEOUT)
+		finally:
+			if self._cancels.get(server.name) is future and not future.done():
+				future.cancel()
+				del self._cancels[server.name]
+
+	# Run the monitor (or the link to it) in a task of its own, restarting it if
+	# it ever fails. Only the first call does anything, so it's safe to call
+	# whenever the bot (re)connects.
+	def start(self):
+		if self._task is None:
+			self._task = asyncio.ensure_future(self._run_supervised())
+		return self._task
+
+	async def _run_supervised(self):
+		delay = WORKER_RESTART_DELAY
+		while True:
+			started = time.monotonic()
+			try:
+				await self.run()
+			except Exception:
+				log.exception(f"MonitorLink: monitor ({self.mode}) failed")
+			# back off if it keeps failing straight away
+			if time.monotonic() - started > WORKER_RESTART_DELAY_MAX:
+				delay = WORKER_RESTART_DELAY
+			log.error(f"MonitorLink: monitor ({self.mode}) stopped, restarting in {delay}s")
+			await asyncio.sleep(delay)
+			delay = min(delay * 2, WORKER_RESTART_DELAY_MAX)
+
+	async def run(self):
+		if self.mode == "inline":
+			await inactivity_monitor.run()
+		elif self.mode == "spawn":
+			tasks = [asyncio.ensure_future(self._supervise()), asyncio.ensure_future(self._stay_connected())]
+			try:
+				await asyncio.gather(*tasks)
+			finally:
+				# if one fails, the other has to go too, or restarting this
+				# would leave two of them supervising workers
+				for task in tasks:
+					task.cancel()
+		else:
+			await self._stay_connected()
+
+	async def _send(self, message):
+		try:
+			await send_message(self._writer, message)
+		except (OSError, AttributeError) as e:
+			log.info(f"MonitorLink: couldn't reach the monitor worker ({e!r})")
+
+	async def _worker_listening(self):
+		try:
+			_, writer = await asyncio.open_unix_connection(self.path)
+		except OSError:
+			return False
+		writer.close()
+		return True
+
+	# Keep a worker process running. One that's already listening (e.g. left
+	# over from before the bot restarted) is used rather than starting another.
+	# The worker is started in a session of its own and left alone when this is
+	# cancelled, so it carries on (e.g. with a stop) while the bot restarts.
+	async def _supervise(self):
+		delay = WORKER_RESTART_DELAY
+		while True:
+			if await self._worker_listening():
+				await asyncio.sleep(WORKER_RESTART_DELAY)
+				continue
+			log.info(f"MonitorLink: starting monitor worker {WORKER_SCRIPT}...")
+			started = time.monotonic()
+			process = await asyncio.create_subprocess_exec(sys.executable, WORKER_SCRIPT, start_new_session=True)
+			code = await process.wait()
+			# back off if it keeps dying straight away
+			if time.monotonic() - started > WORKER_RESTART_DELAY_MAX:
+				delay = WORKER_RESTART_DELAY
+			log.error(f"MonitorLink: monitor worker exited with code {code}, restarting in {delay}s")
+			await asyncio.sleep(delay)
+			delay = min(delay * 2, WORKER_RESTART_DELAY_MAX)
+
+	async def _stay_connected(self):
+		while True:
+			try:
+				reader, writer = await asyncio.open_unix_connection(self.path)
+			except OSError:
+				await asyncio.sleep(1)
+				continue
+			log.info(f"MonitorLink: connected to monitor worker on {self.path}")
+			self._writer = writer
+			try:
+				async for line in reader:
+					try:
+						self._handle_event(json.loads(line))
+					except (KeyError, TypeError, ValueError) as e:
+						log.info(f"MonitorLink: ignoring message {line!r} ({e!r})")
+			except (OSError, ValueError) as e:
+				log.info(f"MonitorLink: lost monitor worker ({e!r})")
+			finally:
+				self._writer = None
+				writer.close()
+				# nobody's going to answer those now
+				cancels, self._cancels = self._cancels, {}
+				for future in cancels.values():
+					if not future.done():
+						future.set_exception(ConnectionError("lost the monitor worker"))
+			await asyncio.sleep(1)
+
+	def _handle_event(self, message):
+		if message.get("event") == "stop":
+			state = StopState[message["state"]]
+			log.info(f"MonitorLink: monitor worker stopping {message['server']}: {state.value}")
+			self.stop_states[message["server"]] = state
+			server_snapshot.invalidate()
+			server = get_server(message["server"])
+			if state == StopState.DONE and server is not None:
+				server.rcon.set_machine_running(False)
+		elif message.get("event") == "cancel":
+			future = self._cancels.pop(message["server"], None)
+			if future is not None and not future.done():
+				future.set_result(StopState[message["state"]] if message["state"] is not None else None)
+		elif message.get("event") == "players":
+			player_feed.observe(message["server"], frozenset(message["names"]), message["at"])
+		elif message.get("event") == "presence":
+			players = message["players"]
+			presence_store.record(
+				message["server"],
+				PlayerList(*players[:2], frozenset(players[2])) if players is not None else None,
+				message["at"]
+			)
+
+
+# how the bot reaches the inactivity monitor
+monitor_link = MonitorLink()